@@ -0,0 +1,240 @@
+import sys, os, time, random, statistics
+from multiprocessing import Pool
+from placement import policies
+from compression import codecs, compress_block, decompress_block
+from client_transfer import write_concurrency
+
+"""
+Benchmarks that run without a cluster
+
+    python benchmark.py placement [blocks]
+        Simulates writing blocks to a cluster of datanodes of different sizes and
+        fill levels with each placement policy and prints how evenly the disks fill,
+        the most transfers any one node had at once, how many the busiest node had
+        on average over the run and how fast a policy decides.
+        It runs once with nodes that all write equally fast and once with busy nodes,
+        some of them slower to write and some serving reads all along.
+
+    python benchmark.py metadata [namenode url] [clients] [seconds]
+        Runs client processes against a running namenode, each making directories,
+        listing them and looking files up in a loop, and prints the metadata
+        operations per second. Run it with the namenode on more threads or cores
+        to see how it scales. If datanodes are alive files are created too. What
+        it made is removed at the end.
+
+    python benchmark.py compression [file] [block MB] [link MB/s]
+        Compresses the blocks of the file, or of generated log lines and of random
+        bytes, with each installed codec as the client does and prints the ratio, the
+        speed of each codec on one core and the write and read throughput a client
+        gets over a link of the given speed compared with sending the blocks as they are.
+        The client compresses blocks on as many cores as it sends blocks at once, so a
+        transfer runs at the slower of the codec on those cores and the link.
+"""
+
+# Simulated cluster
+sim_nodes = 12
+sim_racks = 3
+sim_block_size = 128 * 1024 * 1024
+sim_replicas = 3
+
+# Blocks written per step, steps a transfer takes and steps between heartbeats
+sim_blocks_per_step = 4
+sim_transfer_steps = 3
+sim_heartbeat_steps = 2
+
+# In the busy cluster every sim_slow_every-th node writes sim_slow_factor times slower
+# and the first sim_reading_nodes nodes serve sim_reads reads the whole time
+sim_slow_every = 4
+sim_slow_factor = 3
+sim_reading_nodes = 2
+sim_reads = 4
+
+
+def make_cluster( seed, busy=False ):
+    """ < key: datanode, val: heartbeat stats and the steps a transfer to it takes > """
+    rand = random.Random( seed )
+    cluster = {}
+    for i in range( sim_nodes ):
+        capacity = rand.choice( [ 2, 4, 8 ] ) * 1024 ** 4
+        slow = busy and i % sim_slow_every == sim_slow_every - 1
+        reads = sim_reads if busy and i < sim_reading_nodes else 0
+        cluster['dn{0}'.format( i )] = {'capacity': capacity, 'used': int( capacity * rand.uniform( 0.1, 0.7 ) ),
+                                         'active_transfers': reads, 'rack': 'r{0}'.format( i % sim_racks ),
+                                         'steps': sim_transfer_steps * ( sim_slow_factor if slow else 1 )}
+    return cluster
+
+
+def simulate_placement( policy_name, blocks, seed=1, busy=False ):
+    """ Runs one policy over a simulated cluster and returns its stats, peak transfers count the reads too """
+    policy = policies[policy_name]()
+    cluster = make_cluster( seed, busy )
+    nodes = sorted( cluster )
+    in_flight = []
+    peak = { dn: 0 for dn in nodes }
+    multi_rack = placed = 0
+    # the most transfers on any one node after each step, the node that holds writes back
+    busiest = []
+    decide_seconds = 0.0
+    step = 0
+    while placed < blocks:
+        if step % sim_heartbeat_steps == 0:
+            for dn in nodes:
+                policy.update( dn, dict( cluster[dn] ) )
+        for _ in range( min( sim_blocks_per_step, blocks - placed ) ):
+            start = time.perf_counter()
+            chosen = policy.choose( nodes, sim_replicas, sim_block_size )
+            decide_seconds += time.perf_counter() - start
+            assert len( set( chosen ) ) == len( chosen ), "replicas on the same node"
+            multi_rack += len( { cluster[dn]['rack'] for dn in chosen } ) > 1
+            for dn in chosen:
+                cluster[dn]['active_transfers'] += 1
+                cluster[dn]['used'] += sim_block_size
+                peak[dn] = max( peak[dn], cluster[dn]['active_transfers'] )
+                in_flight.append( ( step + cluster[dn]['steps'], dn ) )
+            placed += 1
+        busiest.append( max( cluster[dn]['active_transfers'] for dn in nodes ) )
+        step += 1
+        for done in [ t for t in in_flight if t[0] <= step ]:
+            in_flight.remove( done )
+            cluster[done[1]]['active_transfers'] -= 1
+    fill = [ cluster[dn]['used'] / cluster[dn]['capacity'] for dn in nodes ]
+    return {'policy': policy_name, 'fill_spread': max( fill ) - min( fill ), 'fill_stdev': statistics.pstdev( fill ),
+            'peak_transfers': max( peak.values() ), 'busiest': statistics.mean( busiest ), 'multi_rack': multi_rack / blocks,
+            'us_per_block': decide_seconds / blocks * 1e6 }
+
+
+def benchmark_placement( blocks=20000 ):
+    print( "{0} blocks of {1} MB, {2} replicas, {3} nodes in {4} racks".format(
+        blocks, sim_block_size // 2 ** 20, sim_replicas, sim_nodes, sim_racks ))
+    for busy, title in ( ( False, "Nodes that write equally fast" ),
+                         ( True, "Busy nodes, every {0}th writes {1} times slower and {2} serve {3} reads".format(
+                             sim_slow_every, sim_slow_factor, sim_reading_nodes, sim_reads ) ) ):
+        print( "\n" + title )
+        print( "{0:<12} {1:>12} {2:>12} {3:>15} {4:>14} {5:>11} {6:>13}".format(
+            'policy', 'fill spread', 'fill stdev', 'peak transfers', 'mean busiest', 'multi rack', 'us per block' ))
+        for name in sorted( policies ):
+            stats = simulate_placement( name, blocks, busy=busy )
+            print( "{policy:<12} {fill_spread:>12.3f} {fill_stdev:>12.3f} {peak_transfers:>15} {busiest:>14.2f} {multi_rack:>11.1%} {us_per_block:>13.1f}".format( **stats ))
+
+
+# Block size and link speed of the compression benchmark
+bench_block_mb = 8
+bench_link_mb_per_sec = 125
+
+
+def log_lines( size, seed=1 ):
+    """ size bytes of log lines like the ones a service writes, as JSON escaped text """
+    rand = random.Random( seed )
+    levels, paths = [ 'INFO', 'INFO', 'INFO', 'WARN', 'ERROR' ], [ '/file/', '/block/', '/directories/', '/heartbeat/' ]
+    lines, total = [], 0
+    while total < size:
+        line = '{{"time": "2024-05-{0:02d}T{1:02d}:{2:02d}:{3:02d}.{4:03d}Z", "level": "{5}", "path": "{6}{7}", "status": {8}, "ms": {9:.2f}}}\n'.format(
+            rand.randint( 1, 28 ), rand.randint( 0, 23 ), rand.randint( 0, 59 ), rand.randint( 0, 59 ), rand.randint( 0, 999 ),
+            rand.choice( levels ), rand.choice( paths ), rand.randint( 1, 100000 ), rand.choice( [ 200, 200, 200, 404, 500 ] ),
+            rand.expovariate( 0.1 ) )
+        lines.append( line )
+        total += len( line )
+    return ''.join( lines ).encode()[:size]
+
+
+def compression_run( data, codec, block_size, link, cores ):
+    """ Compresses and decompresses every block of data with the codec, returns its stats """
+    blocks = [ data[ i:i + block_size ] for i in range( 0, len( data ), block_size ) ]
+    sent = compressed = 0
+    compress_seconds = decompress_seconds = 0.0
+    for block in blocks:
+        start = time.perf_counter()
+        body, name = compress_block( block, codec )
+        compress_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        assert decompress_block( body, name ) == block, "block changed on the way"
+        decompress_seconds += time.perf_counter() - start
+        sent += len( body )
+        compressed += name is not None
+    ratio = sent / len( data )
+    compress, decompress = len( data ) / max( compress_seconds, 1e-9 ) / 1e6, len( data ) / max( decompress_seconds, 1e-9 ) / 1e6
+    # the link carries ratio bytes for every byte of the file
+    return {'codec': codec.name, 'compressed': compressed, 'blocks': len( blocks ), 'ratio': ratio,
+            'compress': compress, 'decompress': decompress,
+            'write': min( compress * cores, link / ratio ), 'read': min( decompress * cores, link / ratio ) }
+
+
+def benchmark_compression( file_name=None, block_mb=bench_block_mb, link=bench_link_mb_per_sec ):
+    block_size, link = int( float( block_mb ) * 1024 * 1024 ), float( link )
+    if file_name:
+        with open( file_name, 'rb' ) as f:
+            inputs = [ ( file_name, f.read() ) ]
+    else:
+        inputs = [ ( 'log lines', log_lines( 8 * block_size ) ), ( 'random', os.urandom( 4 * block_size ) ) ]
+    cores = min( os.cpu_count() or 1, write_concurrency )
+    print( "{0:g} MB blocks over a {1:.0f} MB/s link, {2} cores compressing".format( block_size / 2 ** 20, link, cores ))
+    print( "{0:<12} {1:<6} {2:>11} {3:>7} {4:>10} {5:>12} {6:>11} {7:>6} {8:>10} {9:>6}".format(
+        'data', 'codec', 'compressed', 'ratio', 'comp MB/s', 'decomp MB/s', 'write MB/s', 'gain', 'read MB/s', 'gain' ))
+    for label, data in inputs:
+        for name in sorted( codecs ):
+            stats = compression_run( data, codecs[name], block_size, link, cores )
+            print( "{0:<12} {codec:<6} {compressed:>5}/{blocks:<5} {ratio:>7.3f} {compress:>10.0f} {decompress:>12.0f} {write:>11.0f} {1:>5.2f}x {read:>10.0f} {2:>5.2f}x".format(
+                label, stats['write'] / link, stats['read'] / link, **stats ))
+
+
+def metadata_client( args ):
+    """ One client process, returns < key: operation, val: count > done in the time given """
+    import requests
+    url, client, seconds = args
+    session = requests.Session()
+    root = 'bench{0}_{1}'.format( os.getpid(), client )
+    counts = {'mkdir': 0, 'ls': 0, 'lookup': 0, 'create': 0, 'errors': 0}
+    session.get( url + '/directories/' + root + '/' )
+    can_create = 'error' not in session.post( url + '/file/', json={'file_name': 'probe', 'directory': root, 'size': 1} ).json()
+    made = []
+    deadline = time.monotonic() + seconds
+    i = 0
+    while time.monotonic() < deadline:
+        i += 1
+        name = 'd{0}'.format( i )
+        answers = [ ( 'mkdir', session.get( url + '/directories/sub/' + root + '/' + name + '/' ) ),
+                    ( 'ls', session.post( url + '/directories/', json={'directory': root + '\\' + name} ) ),
+                    ( 'lookup', session.get( url + '/file/' + root + '/probe' ) ) ]
+        made.append( name )
+        if can_create:
+            answers.append( ( 'create', session.post( url + '/file/', json={'file_name': 'f{0}'.format( i ), 'directory': root, 'size': 1} ) ) )
+        for op, response in answers:
+            counts[op] += 1
+            # without datanodes the probe file is never made and its lookup is expected to fail
+            if op == 'lookup' and not can_create:
+                continue
+            if not response.ok or 'error' in response.json():
+                counts['errors'] += 1
+    # what was made is removed, the files only exist on the namenode
+    files = [ {'directory': root, 'file_name': 'f{0}'.format( j )} for j in range( 1, i + 1 ) ] if can_create else []
+    session.delete( url + '/files/', json={'files': files + [ {'directory': root, 'file_name': 'probe'} ]} )
+    for name in made:
+        session.delete( url + '/directories/sub_dir/', json={'parent': root, 'sub_directory': name} )
+    session.delete( url + '/directories/', json={'directory': root} )
+    return counts
+
+
+def benchmark_metadata( url='http://localhost:4000', clients=8, seconds=10 ):
+    clients, seconds = int( clients ), float( seconds )
+    with Pool( clients ) as pool:
+        results = pool.map( metadata_client, [ ( url.rstrip('/'), c, seconds ) for c in range( clients ) ] )
+    totals = { op: sum( r[op] for r in results ) for op in results[0] }
+    ops = sum( n for op, n in totals.items() if op != 'errors' )
+    print( "{0} clients for {1:.0f} s against {2}".format( clients, seconds, url ))
+    for op in ( 'mkdir', 'ls', 'lookup', 'create' ):
+        print( "{0:<8} {1:>10.0f} ops/s".format( op, totals[op] / seconds ))
+    print( "{0:<8} {1:>10.0f} ops/s, {2} errors".format( 'total', ops / seconds, totals['errors'] ))
+
+
+if __name__ == '__main__':
+    if len( sys.argv ) < 2 or sys.argv[1] not in ( 'placement', 'metadata', 'compression' ):
+        print( "usage: python benchmark.py placement [blocks]" )
+        print( "       python benchmark.py metadata [namenode url] [clients] [seconds]" )
+        print( "       python benchmark.py compression [file] [block MB] [link MB/s]" )
+        sys.exit( 1 )
+    if sys.argv[1] == 'placement':
+        benchmark_placement( *[ int( a ) for a in sys.argv[2:3] ] )
+    elif sys.argv[1] == 'metadata':
+        benchmark_metadata( *sys.argv[2:5] )
+    elif sys.argv[1] == 'compression':
+        benchmark_compression( *sys.argv[2:5] )
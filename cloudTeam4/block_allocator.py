@@ -0,0 +1,44 @@
+"""
+Block id allocator for the namenode. The last id handed out is kept in a
+redis counter, so a file reserves all of its block ids with a single INCRBY
+and two writers can never be given the same ids.
+
+In a federated cluster every namenode hands out ids from its own block pool,
+the pool number sits in the high bits of the id so the ids of two namenodes
+never collide and a datanode can tell which namenode a block belongs to.
+"""
+
+
+class BlockIdAllocator:
+    """ Reserves contiguous ranges of block ids from a persistent counter """
+
+    def __init__(self, r_cache, key='nn:default:last_block_id', pool=0, pool_bits=48):
+        self.r_cache = r_cache
+        self.key = key
+        self.base = pool << pool_bits
+
+    def reserve(self, count):
+        """
+        Reserve count block ids in one round trip
+
+        :param name: count
+        :param type: int
+            The number of blocks in the file
+
+        :returns: range
+            The reserved block ids, the first id ever handed out is 1 in pool 0
+        """
+        if count <= 0:
+            return range(0)
+        last_id = self.base + self.r_cache.incrby( self.key, count )
+        return range( last_id - count + 1, last_id + 1 )
+
+    def last_reserved(self):
+        """ The highest block id handed out so far, 0 if none """
+        last_id = self.r_cache.get( self.key )
+        return self.base + int( last_id ) if last_id and int( last_id ) else 0
+
+    def advance_to(self, block_id):
+        """ Makes sure no id up to block_id is handed out again, after the namespace was restored """
+        if block_id > self.base and block_id > self.last_reserved():
+            self.r_cache.set( self.key, block_id - self.base )
@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+
+"""
+Read cache of whole blocks for the datanode, kept within a byte budget.
+
+It works like 2Q with the first-in queue left to the page cache. The first
+read of a block is served from disk and only its id is remembered in a ghost
+list. A block read again while its id is still there is loaded into the cache,
+which evicts least recently used blocks to stay within the budget. A scan
+reads every block once, so it only churns the ghost list and never pushes the
+hot blocks out.
+
+A block is only cached after it passed its checksums. Writing or deleting a
+block invalidates it, and a load that started before the invalidation is not
+cached.
+"""
+
+# Block ids remembered after their first read
+ghost_entries = 4096
+
+# A block larger than this share of the budget is never cached
+max_entry_share = 0.25
+
+
+class BlockCache:
+    """ LRU of < key: block id, val: ( bytes, checksums, codec ) > admitted on the second read """
+
+    def __init__(self, budget, ghosts=ghost_entries, max_share=max_entry_share):
+        self.budget = budget
+        self.ghosts_kept = ghosts
+        self.max_entry = int( budget * max_share )
+        self.entries = OrderedDict()
+        self.ghosts = OrderedDict()
+        # bumped by every invalidation so a load that raced with a write is dropped
+        self.versions = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'admitted': 0, 'evictions': 0, 'invalidations': 0, 'bytes_served': 0}
+
+    def lookup(self, block_id):
+        """
+        Returns ( cached bytes, checksums and codec or None, admit ). admit is True on a miss
+        when the block was read recently, the caller should load it with put.
+        """
+        block_id = int( block_id )
+        with self.lock:
+            entry = self.entries.get( block_id )
+            if entry is not None:
+                self.entries.move_to_end( block_id )
+                self.counts['hits'] += 1
+                return entry, False
+            self.counts['misses'] += 1
+            if self.budget <= 0:
+                return None, False
+            if block_id in self.ghosts:
+                del self.ghosts[block_id]
+                return None, True
+            self.ghosts[block_id] = None
+            while len( self.ghosts ) > self.ghosts_kept:
+                self.ghosts.popitem( last=False )
+            return None, False
+
+    def fits(self, size):
+        return 0 < size <= self.max_entry
+
+    def version(self, block_id):
+        with self.lock:
+            return self.versions.get( int( block_id ), 0 )
+
+    def put(self, block_id, data, checksums, version, codec=None):
+        """ Caches the block unless it is too big or was invalidated since version was taken """
+        block_id = int( block_id )
+        if not self.fits( len( data ) ):
+            return False
+        with self.lock:
+            if self.versions.get( block_id, 0 ) != version or block_id in self.entries:
+                return False
+            self.entries[block_id] = ( data, checksums, codec )
+            self.size += len( data )
+            self.counts['admitted'] += 1
+            while self.size > self.budget:
+                _, evicted = self.entries.popitem( last=False )
+                self.size -= len( evicted[0] )
+                self.counts['evictions'] += 1
+            return True
+
+    def invalidate(self, block_id):
+        """ The block was written or deleted """
+        block_id = int( block_id )
+        with self.lock:
+            self.versions[block_id] = self.versions.get( block_id, 0 ) + 1
+            entry = self.entries.pop( block_id, None )
+            if entry is not None:
+                self.size -= len( entry[0] )
+                self.counts['invalidations'] += 1
+
+    def served(self, size):
+        with self.lock:
+            self.counts['bytes_served'] += size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts['hits'] + self.counts['misses']
+            return dict( self.counts, hit_ratio=self.counts['hits'] / lookups if lookups else 0.0,
+                         blocks=len( self.entries ), bytes=self.size, budget=self.budget )
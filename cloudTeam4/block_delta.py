@@ -0,0 +1,68 @@
+import redis
+
+"""
+Changes to the blocks of a datanode since its last acknowledged block report.
+The datanode records every block it adds or removes, the reporter takes the
+changes, sends them to the namenode as a delta and forgets them once the
+namenode acks. Changes taken but not acked yet stay in flight and go out again
+with the next report, merged with anything newer.
+
+Keys in the datanode redis
+    report_added / report_removed                    changes not sent yet
+    report_inflight_added / report_inflight_removed  changes sent but not acked
+"""
+
+
+class BlockDelta:
+    """ Records added and removed blocks between block reports """
+
+    def __init__(self, r_cache):
+        self.r_cache = r_cache
+
+    def added(self, block_id):
+        pipe = self.r_cache.pipeline()
+        pipe.sadd( 'report_added', block_id )
+        pipe.srem( 'report_removed', block_id )
+        pipe.execute()
+
+    def removed(self, block_id):
+        pipe = self.r_cache.pipeline()
+        pipe.sadd( 'report_removed', block_id )
+        pipe.srem( 'report_added', block_id )
+        pipe.execute()
+
+    def take(self):
+        """
+        Moves the changes not sent yet in flight, a newer change to a block wins over an older one
+
+        :returns: tuple
+            ( added block ids, removed block ids ) of everything in flight
+        """
+        with self.r_cache.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch( 'report_added', 'report_removed' )
+                    added = pipe.smembers( 'report_added' )
+                    removed = pipe.smembers( 'report_removed' )
+                    pipe.multi()
+                    if added:
+                        pipe.srem( 'report_inflight_removed', *added )
+                        pipe.sadd( 'report_inflight_added', *added )
+                    if removed:
+                        pipe.srem( 'report_inflight_added', *removed )
+                        pipe.sadd( 'report_inflight_removed', *removed )
+                    pipe.delete( 'report_added', 'report_removed' )
+                    pipe.smembers( 'report_inflight_added' )
+                    pipe.smembers( 'report_inflight_removed' )
+                    results = pipe.execute()
+                    return sorted( int( b ) for b in results[-2] ), sorted( int( b ) for b in results[-1] )
+                except redis.WatchError:
+                    continue
+
+    def ack(self):
+        """ The namenode has the changes in flight """
+        self.r_cache.delete( 'report_inflight_added', 'report_inflight_removed' )
+
+    def reset(self):
+        """ Forgets every change, the next full report covers them """
+        self.r_cache.delete( 'report_added', 'report_removed', 'report_inflight_added', 'report_inflight_removed' )
@@ -0,0 +1,78 @@
+import time, threading
+
+"""
+Background block scanner for the datanode. It walks every stored block, reads
+it and checks it against the CRCs in its sidecar, and reports the corrupt ones
+to the namenode. Reads are capped at a few MB a second so checking never takes
+disk time away from the blocks clients are reading.
+"""
+
+# Bytes a second the scanner may read
+scan_rate = 4 * 1024 * 1024
+
+# Seconds between the start of one pass over all blocks and the next
+scan_period = 24 * 3600
+
+
+class BlockScanner:
+    """ Checks every block in storage once per period at no more than rate bytes a second """
+
+    def __init__(self, storage, report_bad, rate=scan_rate, period=scan_period):
+        """
+        :param name: report_bad
+        :param type: function
+            report_bad( block_ids ) tells the namenode about corrupt blocks
+        """
+        self.storage = storage
+        self.report_bad = report_bad
+        self.rate = rate
+        self.period = period
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.last_pass = {'blocks': 0, 'corrupt': [], 'seconds': 0.0}
+        self.thread = threading.Thread( target=self._run, daemon=True )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def throttle(self, nbytes):
+        """ Sleeps until reading nbytes more keeps the scanner under its rate """
+        self.window_bytes += nbytes
+        ahead = self.window_bytes / self.rate - ( time.monotonic() - self.window_start )
+        if ahead > 0:
+            time.sleep( ahead )
+        elif ahead < -1:
+            # an idle scanner does not build up a burst
+            self.window_start, self.window_bytes = time.monotonic(), 0
+
+    def check_block(self, block_id, throttle=None):
+        """ Returns True if the block is corrupt, a block without checksums is taken as good """
+        try:
+            bad = self.storage.verify( block_id, throttle )
+        except FileNotFoundError:
+            # deleted while being checked
+            return False
+        if bad:
+            print( "Block {0} is corrupt in chunks {1}".format( block_id, bad ))
+        return bool( bad )
+
+    def scan(self):
+        """ Checks every block once and reports the corrupt ones, returns their ids """
+        start = time.monotonic()
+        self.window_start, self.window_bytes = start, 0
+        block_ids = list( self.storage.iter_blocks() )
+        corrupt = [ b for b in block_ids if self.check_block( b, self.throttle ) ]
+        if corrupt:
+            self.report_bad( corrupt )
+        self.last_pass = {'blocks': len( block_ids ), 'corrupt': corrupt, 'seconds': time.monotonic() - start}
+        return corrupt
+
+    def _run(self):
+        while True:
+            start = time.monotonic()
+            try:
+                self.scan()
+            except Exception as a:
+                print( "Block scanner ERROR: {0}".format( a ))
+            time.sleep( max( self.period - ( time.monotonic() - start ), 0 ) )
@@ -0,0 +1,289 @@
+import os, hashlib, threading, time
+from checksum import ChunkChecksum, checksum_chunk, sidecar_suffix, encode_sidecar, decode_sidecar, split_sidecar, mismatched
+
+"""
+Block storage engine for the datanode. Blocks are kept under a data root in
+hash-sharded sub directories so no directory grows past a few thousand files.
+A block is written in binary to a temp file next to its final path and renamed
+into place once complete, so a reader never sees half a block. The CRCs of its
+chunks are computed while it is written and kept in a sidecar file next to it,
+with the codec of a block the client sent compressed.
+
+fsync policies
+    always  every block is synced before it is acknowledged
+    group   blocks written at about the same time are synced together by one
+            background thread, a writer waits for the group it joined
+    none    blocks are left to the page cache
+"""
+
+# Hex digits of the block hash used per directory level, 2 gives 256 directories per level
+shard_width = 2
+
+# Temp files end with this until they are renamed into place
+temp_suffix = '.tmp'
+
+
+class BlockStorage:
+    """ Stores blocks as files under root/<shard>/<shard>/blk_<id> """
+
+    def __init__(self, root, shard_levels=2, fsync_policy='group', preallocate=True, group_commit_interval=0.01):
+        self.root = os.path.abspath( root )
+        self.shard_levels = shard_levels
+        self.fsync_policy = fsync_policy
+        self.preallocate = preallocate and hasattr( os, 'posix_fallocate' )
+        self.committer = GroupCommitter( group_commit_interval ) if fsync_policy == 'group' else None
+        os.makedirs( self.root, exist_ok=True )
+
+    def path(self, block_id):
+        block_id = str( int( block_id ) )
+        digest = hashlib.md5( block_id.encode() ).hexdigest()
+        shards = [ digest[ i * shard_width:( i + 1 ) * shard_width ] for i in range( self.shard_levels ) ]
+        return os.path.join( self.root, *shards, 'blk_' + block_id )
+
+    def open_writer(self, block_id, size_hint=None, codec=None):
+        """ Starts writing a block, call commit() on the writer to put it in place. codec is the one the bytes are compressed with """
+        return BlockWriter( self, block_id, size_hint, codec )
+
+    def write(self, block_id, data):
+        """ Writes a whole block from bytes """
+        writer = self.open_writer( block_id, len( data ) )
+        try:
+            writer.write( data )
+        except Exception:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def sidecar_path(self, block_id):
+        return self.path( block_id ) + sidecar_suffix
+
+    def exists(self, block_id):
+        return os.path.exists( self.path( block_id ) )
+
+    def size(self, block_id):
+        return os.path.getsize( self.path( block_id ) )
+
+    def open_block(self, block_id):
+        """ Opens the block for reading in binary, raises FileNotFoundError if it is not stored here """
+        return open( self.path( block_id ), 'rb' )
+
+    def read(self, block_id):
+        with self.open_block( block_id ) as f:
+            return f.read()
+
+    def delete(self, block_id):
+        """ Deletes the block and its checksums, returns False if it was not stored here """
+        try:
+            os.remove( self.path( block_id ) )
+        except FileNotFoundError:
+            return False
+        try:
+            os.remove( self.sidecar_path( block_id ) )
+        except FileNotFoundError:
+            pass
+        return True
+
+    def checksums(self, block_id):
+        """ Returns ( chunk size, list of chunk CRCs ) of the block, or None if it has no checksums """
+        try:
+            with open( self.sidecar_path( block_id ), 'rb' ) as f:
+                return decode_sidecar( f.read() )
+        except FileNotFoundError:
+            return None
+
+    def codec(self, block_id):
+        """ The name of the codec the block is compressed with, None if it is stored as it was written """
+        try:
+            with open( self.sidecar_path( block_id ), 'rb' ) as f:
+                return split_sidecar( f.read() )[0]
+        except FileNotFoundError:
+            return None
+
+    def verify(self, block_id, throttle=None):
+        """
+        Reads the whole block and checks it against its checksums. throttle( bytes )
+        is called after every chunk read so a background caller can cap its rate.
+
+        :returns: list
+            The indexes of the chunks that do not match, empty if the block is good
+            or None if the block has no checksums
+        """
+        sums = self.checksums( block_id )
+        if sums is None:
+            return None
+        chunk, crcs = sums
+        checksum = ChunkChecksum( chunk )
+        with self.open_block( block_id ) as f:
+            while True:
+                data = f.read( chunk )
+                if not data:
+                    break
+                checksum.update( data )
+                if throttle:
+                    throttle( len( data ) )
+        return mismatched( checksum.digest(), crcs )
+
+    def iter_blocks(self):
+        """ Yields the id of every stored block, used to rebuild the block list at start up """
+        for dir_path, _, files in os.walk( self.root ):
+            for name in files:
+                if name.startswith( 'blk_' ) and name[4:].isdigit():
+                    yield int( name[4:] )
+
+    def commit(self, files):
+        """ 
+        Closes each ( fd, temp path, final path ) and renames the temp files into place in order,
+        made durable according to the fsync policy. The fds are always closed, even when this raises.
+        """
+        if self.committer:
+            self.committer.commit( files )
+            return
+        try:
+            if self.fsync_policy == 'always':
+                for fd, _, _ in files:
+                    os.fsync( fd )
+        finally:
+            for fd, _, _ in files:
+                os.close( fd )
+        for _, temp_path, final_path in files:
+            os.replace( temp_path, final_path )
+        if self.fsync_policy == 'always':
+            for dir_path in { os.path.dirname( final_path ) for _, _, final_path in files }:
+                sync_directory( dir_path )
+
+
+class BlockWriter:
+    """ 
+    Writes one block to a temp file that is renamed into place on commit, 
+    after the sidecar with the CRCs of its chunks
+    """
+
+    def __init__(self, storage, block_id, size_hint=None, codec=None):
+        self.storage = storage
+        self.codec = codec
+        self.final_path = storage.path( block_id )
+        self.temp_path = self.final_path + temp_suffix
+        self.sidecar_path = storage.sidecar_path( block_id )
+        self.sidecar_temp_path = self.sidecar_path + temp_suffix
+        self.checksum = ChunkChecksum( checksum_chunk )
+        os.makedirs( os.path.dirname( self.final_path ), exist_ok=True )
+        self.fd = os.open( self.temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644 )
+        self.size = 0
+        self.preallocated = 0
+        if storage.preallocate and size_hint:
+            try:
+                os.posix_fallocate( self.fd, 0, size_hint )
+                self.preallocated = size_hint
+            except OSError:
+                pass
+
+    def write(self, data):
+        write_all( self.fd, data )
+        self.checksum.update( data )
+        self.size += len( data )
+
+    def commit(self):
+        """ Syncs the block according to the fsync policy and renames it into place, returns its size """
+        sidecar_fd = None
+        try:
+            if self.preallocated > self.size:
+                os.ftruncate( self.fd, self.size )
+            sidecar_fd = os.open( self.sidecar_temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644 )
+            write_all( sidecar_fd, encode_sidecar( checksum_chunk, self.checksum.digest(), self.codec ) )
+            # the sidecar is in place before the block so a block is never seen without its checksums
+            files = [ ( sidecar_fd, self.sidecar_temp_path, self.sidecar_path ), ( self.fd, self.temp_path, self.final_path ) ]
+            sidecar_fd, self.fd = None, None
+            self.storage.commit( files )
+        except Exception:
+            if sidecar_fd is not None:
+                os.close( sidecar_fd )
+            self.abort()
+            raise
+        return self.size
+
+    def abort(self):
+        """ Drops the partly written block """
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+        for path in ( self.temp_path, self.sidecar_temp_path ):
+            try:
+                os.remove( path )
+            except FileNotFoundError:
+                pass
+
+
+class GroupCommitter:
+    """
+    Syncs the blocks of many writers together. A writer hands over its temp files
+    and waits; every interval one thread syncs all the files handed over since
+    the last round, renames them into place, syncs each directory touched once
+    and then wakes the writers.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = []
+        self.cond = threading.Condition()
+        self.thread = threading.Thread( target=self._run, daemon=True )
+        self.thread.start()
+
+    def commit(self, files):
+        done = threading.Event()
+        entry = { 'files': files, 'done': done, 'error': None }
+        with self.cond:
+            self.pending.append( entry )
+            self.cond.notify()
+        done.wait()
+        if entry['error']:
+            raise entry['error']
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            # let more writers join the group
+            time.sleep( self.interval )
+            with self.cond:
+                group, self.pending = self.pending, []
+            renamed_dirs = set()
+            for entry in group:
+                try:
+                    try:
+                        for fd, _, _ in entry['files']:
+                            if hasattr( os, 'fdatasync' ):
+                                os.fdatasync( fd )
+                            else:
+                                os.fsync( fd )
+                    finally:
+                        for fd, _, _ in entry['files']:
+                            os.close( fd )
+                    for _, temp_path, final_path in entry['files']:
+                        os.replace( temp_path, final_path )
+                        renamed_dirs.add( os.path.dirname( final_path ) )
+                except OSError as a:
+                    entry['error'] = a
+            for dir_path in renamed_dirs:
+                try:
+                    sync_directory( dir_path )
+                except OSError:
+                    pass
+            for entry in group:
+                entry['done'].set()
+
+
+def write_all( fd, data ):
+    view = memoryview( data )
+    while view:
+        written = os.write( fd, view )
+        view = view[written:]
+
+
+def sync_directory( dir_path ):
+    """ fsync on the directory makes new entries in it durable """
+    fd = os.open( dir_path, os.O_RDONLY )
+    try:
+        os.fsync( fd )
+    finally:
+        os.close( fd )
@@ -1,24 +1,28 @@
 import redis, json, time
-import requests as r
-from connect import connect_to_host, redis_host_nn
-from namenode import get_next_available_dn, replica_count
-from datetime import datetime
-from dateutil import parser
-from datetime import timedelta
+from connect import connect_to_host, get_session, redis_host_nn, namespace_id
+from metadata_store import MetadataStore
+from namenode import choose_datanodes, placement, replica_count, block_size, NodeAvailability
+from liveness import dead
+from replication_manager import ReplicationManager, RebuildManager
+from erasure import ErasurePolicy, block_groups
 
 """ 
-    Checker for Namenode uses the redis cache to access the block list 
+    Checker for Namenode uses the metadata store to access the block list 
     and file dir then it can run while loops to check for things like 
-    under replicated blocks 
-    
+    under replicated blocks. Lost blocks of erasure coded files are 
+    rebuilt from the rest of their group instead of copied.
+
+    Only the blocks that lost a replica are checked, the ones of a datanode
+    that died and the ones block reports take off a datanode. Every block
+    is checked once in a while to find any that no event was sent for.
 """
 default_env = "Dev"
 
-# Time that Under Replicated Blocks Should Be Checked 
-under_rep_time = 20
+# Time between checks of every block, blocks that lose a replica are checked right away
+audit_time = 600
 
-# Determines how long before a databode is considered dead
-time_past_heartbeat = 20
+# Time between rounds of starting queued copies and checking the pending ones
+schedule_time = 1
 
 # Replication Factor
 replication_factor = replica_count
@@ -26,139 +30,185 @@ replication_factor = replica_count
 # Redis is an In-Memory but Persistent on Disk DB
 r_cache = redis.Redis(host=redis_host_nn,port=6379)
 
+# Same per-key layout the namenode writes
+store = MetadataStore( r_cache, namespace_id )
 
-def add_to_memory( obj, var_name ):
-    values = json.dumps( obj )
-    r_cache.set( var_name, values )
-
-
-def get_from_memory( var_name ):
-    cached_data =  r_cache.get(var_name)
-    cached_data_as_dict = json.loads( cached_data )
-    return cached_data_as_dict
 
-
-def are_blocks_under_replicated( ):
+def are_blocks_under_replicated( block_list ):
     """ Check if any blocks are under replicated """
     under_rep_blocks = []
-    block_list = get_from_memory('block_list')
     for block, dns in block_list.items(): 
         # the block has less datanodes then the replication num 
         if len(dns) < replication_factor:
             under_rep_blocks.append( block )
-    if len(under_rep_blocks) == 0:
-        print( "Are they under : No")
-    else:
-        print( "Are they under : Yes {0}".format( under_rep_blocks ))
+    print( "Under replicated blocks: {0} of {1}".format( len( under_rep_blocks ), len( block_list ) ))
     return under_rep_blocks
 
 
-def any_datanodes_dead():
-    """ See if any datanodes are dead"""
-    dead = []
-    heartbeats = get_from_memory("heartbeats")
-    for k, v in heartbeats.items():
-        cur_time = datetime.now()
-        prev_time = parser.parse(v)
-        time_passed =  cur_time - prev_time
-        # Have not heard from node for over 30 sec
-        if time_passed > timedelta(seconds=time_past_heartbeat):
-            print( "Data node {0} is dead.".format( k ))
-            # Mark as dead and remove from block list
-            dead.append( k )
-            remove_dead_dns_from_bl( k )
-    return dead
-    
-
-def update_block_list_with_reports():
-    """ Update block list with block report temp list """
-    temp = {}
-    block_temp = get_from_memory('block_temp')
-    # Use the block reports to update the list
-    for dn, blocks in block_temp.items(): 
-        for b in blocks:
-            # add to the dn list for each block
-            temp.setdefault( str(b), [] ).append( dn )
-       
-    # Check if a block is missing from all block reports
-    block_list = get_from_memory('block_list')
-    for b, dn in block_list.items():
-        if b not in temp:
-            temp.setdefault( b, [] )
-    try:
-        add_to_memory( temp , 'block_list' )
-    except redis.exceptions.ReadOnlyError:
-        print('\n\n\n\n\n\n\n\n')
-        print(block_list)
-        raise
-    return temp
+def handle_datanode_state( dn, state ):
+    """ Copies only go to alive datanodes, a dead one is taken off the block list. Returns the blocks a dead one held. """
+    NodeAvailability.update_state( dn, state )
+    if state == dead:
+        print( "Data node {0} is dead.".format( dn ))
+        blocks = remove_dead_dns_from_bl( dn )
+        replication.node_dead( dn )
+        rebuilds.node_dead( dn )
+        return blocks
+    return []
+
+
+def choose_copy_target( exclude ):
+    """ An alive datanode for a new replica, not one that has the block or is receiving too many copies """
+    chosen = choose_datanodes( 1, exclude=exclude )
+    return chosen[0] if chosen else None
+
+
+def read_block_list():
+    """ The namenode keeps the block list up to date as block reports arrive, the checker only reads it """
+    block_list = store.get_block_locations( store.all_block_ids() )
+    # blocks of files deleted since the ids were read are skipped
+    return { b: dns for b, dns in block_list.items() if dns is not None }
+
+
+def check_blocks( block_list, full=False ):
+    """ 
+    Queues the blocks of the block list that are under replicated and rebuilds the lost ones,
+    full is True when the block list has every block
+    """
+    # copies are placed with the disk and load the datanodes last reported
+    for dn, stats in store.get_datanode_stats().items():
+        placement.update( dn, stats )
+    # blocks of erasure coded files have one replica each, lost ones are rebuilt from their group
+    striped = store.get_striping( block_list )
+    replicated = { b: dns for b, dns in block_list.items() if b not in striped }
+    if full:
+        are_blocks_under_replicated( replicated )
+    replication.scan( replicated, full=full )
+    rebuilds.scan( find_lost_blocks( block_list, striped ) )
+
+
+def find_lost_blocks( block_list, striped ):
+    """
+    Blocks of erasure coded files that no alive datanode has, with the rest of their group
+
+    :param name: striped
+    :param type: dict
+        What store.get_striping returns for the blocks of the block list
+
+    :returns: dict
+        < key: block id, val: ( [ ( block id, alive datanodes ) of the group ], policy, bytes in the group ) >
+    """
+    alive = replication.alive
+    lost, unrecoverable = {}, []
+    for block, ( name, size, file_blocks ) in striped.items():
+        if any( alive( dn ) for dn in block_list.get( block, [] ) ):
+            continue
+        policy = ErasurePolicy( name )
+        for ids, group_size in block_groups( file_blocks, policy, size, block_size ):
+            if int( block ) in ids:
+                break
+        # only some blocks may have been looked up, the rest of the group is
+        missing = [ str( b ) for b in ids if str( b ) not in block_list ]
+        locations = dict( block_list, **store.get_block_locations( missing ) ) if missing else block_list
+        group = [ ( str( b ), [ dn for dn in locations.get( str( b ) ) or [] if alive( dn ) ] ) for b in ids ]
+        # blocks past the end of a short group hold nothing and need no datanode
+        lengths = policy.block_lengths( group_size )
+        if sum( 1 for ( _, dns ), length in zip( group, lengths ) if dns or not length ) < policy.k:
+            unrecoverable.append( block )
+            continue
+        lost[block] = ( group, policy.name, group_size )
+    if unrecoverable:
+        print( "Blocks of erasure coded files with fewer than k blocks of their group left {0}".format( unrecoverable ))
+    return lost
 
 
 def check_for_under_replicated_blocks():
     """ 
         Periodically update the block list and check for under replicated blocks 
         new block replicas should be created when the number of block replicas falls
-        below N
+        below N. The replication manager copies them most urgent first.
     """ 
+    # Datanode state changes and lost replicas come from the namenode instead of polling heartbeats
+    events = store.datanode_events()
+    for dn, state in store.get_datanode_states().items():
+        handle_datanode_state( dn, state )
+    # blocks that lost a replica since the last round
+    changed = set()
+    next_audit = time.monotonic()
+    next_round = time.monotonic()
     while True:
-        time.sleep( under_rep_time )
-        # update your block list with the report info
-        block_list_l = update_block_list_with_reports()
-        dead_nodes = any_datanodes_dead()
-
-        # check if any blocks are under replicated
-        list_under = are_blocks_under_replicated()
-        # send message to working datanodes to copy their block to another one
-        ask_to_copy_underreplicated_block( list_under , block_list_l )
+        message = events.get_message( timeout=max( min( next_audit, next_round ) - time.monotonic(), 0 ) )
+        if message:
+            event = json.loads( message['data'] )
+            if 'removed' in event:
+                changed.update( event['removed'] )
+            else:
+                # a datanode died so its blocks are checked right away
+                changed.update( handle_datanode_state( event['id'], event['state'] ) )
+        now = time.monotonic()
+        if now >= next_audit:
+            # every block, in case an event was missed or a block was written with too few replicas
+            check_blocks( read_block_list(), full=True )
+            changed = set()
+            next_audit = now + audit_time
+        if now >= next_round:
+            changed |= replication.take_rescan() | rebuilds.take_rescan()
+            if changed:
+                # blocks of files deleted since are skipped
+                locations = store.get_block_locations( sorted( changed, key=int ) )
+                check_blocks( { b: dns for b, dns in locations.items() if dns is not None } )
+                changed = set()
+            # send message to working datanodes to copy their block to another one
+            replication.check_pending()
+            replication.schedule()
+            rebuilds.check_pending()
+            store.set_replication_stats( dict( replication.stats(), rebuilds=rebuilds.stats() ) )
+            next_round = now + schedule_time
 
 
 def remove_dead_dns_from_bl( dead_dn ):
-    block_list = get_from_memory('block_list')
-    for b, dns in block_list.items():
-        for dn in dns:
-            if dn == dead_dn:
-                dns.remove( dead_dn )
-        block_list[b] = dns
-    print( "Changed block list {0}".format( block_list ))
-    add_to_memory( block_list , 'block_list' )
-    
-
-def ask_to_copy_underreplicated_block( list_under , block_list ):
-    """ Add calls to the datanodes to copy blocks that are under replicated """
-    # check the current dn 
-    print( "BLOCKS")
-    print( block_list )
-    for l in list_under:
-        if l in block_list:
-            try:
-                # Cet the first dn and ask them to forward their copy
-                dn_with_block = block_list[l][0]
-                print( "Dn with this Block is {0}".format( dn_with_block ))
-                copy_node = get_next_available_dn()
-                
-                # Can't be a node that it is allready on:
-                if copy_node == dn_with_block:
-                    copy_node = get_next_available_dn()
-                print( "Copy block {0} the next available dn {1}".format(l, copy_node ))
-                forward_data( dn_with_block, copy_node, str(l))
-            except:
-                print( "Could not forward the under replicated block.")
-
-
+    held = store.drop_datanode( dead_dn )
+    print( "Removed {0} from the replicas of {1} blocks".format( dead_dn, len( held ) ))
+    return held
 
 
 def forward_data( dn_with_block, copy_node, block_name ):
-    """ Connects to dn and asks it to make a copy to send to the copy_node """
+    """ Connects to dn and asks it to make a copy to send to the copy_node, returns True if it was sent """
     route = connect_to_host(dn_with_block, default_env)   + '/copy_block_data/'
-    response = r.post( route, json={'copy_node': copy_node, 'block_name': block_name})
+    response = get_session( dn_with_block, default_env ).post( route, json={'copy_node': copy_node, 'block_name': str(block_name)})
+    if response:
+        response = response.json()
+        if 'error' in response:
+            print( response['error'])
+            return False
+        print( response['message'])
+        return True
+    print("ERROR: DATANODE {0} IS OFFLINE. ENVIRONMENT IS {1}".format(copy_node, default_env))
+    return False
+
+
+def send_rebuild( target, block_name, group, policy, size ):
+    """ Asks the target datanode to rebuild the lost block from the rest of its group, returns True once it has """
+    route = connect_to_host( target, default_env ) + '/rebuild_block/'
+    response = get_session( target, default_env ).post( route, json={'block_name': str(block_name), 'policy': policy,
+                                                                     'size': size, 'group': group} )
     if response:
         response = response.json()
         if 'error' in response:
             print( response['error'])
-        else:
-            print( response['message'])
-    else:
-        print("ERROR: DATANODE {0} IS OFFLINE. ENVIRONMENT IS {1}".format(copy_node, default_env))
+            return False
+        print( response['message'])
+        return True
+    print("ERROR: DATANODE {0} IS OFFLINE. ENVIRONMENT IS {1}".format( target, default_env ))
+    return False
+
+
+# Copies under replicated blocks within per datanode limits
+replication = ReplicationManager( replication_factor, choose_copy_target, forward_data, store.get_block_locations )
+replication.alive = lambda dn: NodeAvailability.data_nodes.get( dn, True )
+
+# Rebuilds lost blocks of erasure coded files
+rebuilds = RebuildManager( choose_copy_target, send_rebuild, store.get_block_locations )
 
 
 if __name__ == '__main__':
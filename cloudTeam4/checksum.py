@@ -0,0 +1,96 @@
+import struct, zlib
+
+"""
+Checksums of block data. A block is checked in chunks of checksum_chunk bytes,
+each with its own CRC32, so a reader can verify just the chunks it reads. The
+CRCs of a block are kept in a sidecar file next to it, the chunk size followed
+by one CRC per chunk, all as big endian unsigned 32 bit ints. The sidecar of a
+compressed block starts with codec_magic, one byte with the length of the name
+of its codec and the name.
+"""
+
+# Bytes covered by one CRC
+checksum_chunk = 64 * 1024
+
+# The sidecar of blk_7 is blk_7.crc
+sidecar_suffix = '.crc'
+
+# Starts the sidecar of a compressed block, a chunk size never does
+codec_magic = b'CODC'
+
+
+class ChunkChecksum:
+    """ Computes the CRC of every chunk of a block as its bytes arrive, in pieces of any size """
+
+    def __init__(self, chunk=checksum_chunk):
+        self.chunk = chunk
+        self.crcs = []
+        self.crc = 0
+        self.filled = 0
+
+    def update(self, data):
+        view = memoryview( data )
+        while view:
+            take = min( len( view ), self.chunk - self.filled )
+            self.crc = zlib.crc32( view[:take], self.crc )
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.chunk:
+                self.crcs.append( self.crc )
+                self.crc, self.filled = 0, 0
+
+    def digest(self):
+        """ The CRCs of the chunks so far, the last one may be short """
+        return self.crcs + ( [ self.crc ] if self.filled else [] )
+
+
+def chunk_crcs( data, chunk=checksum_chunk ):
+    checksum = ChunkChecksum( chunk )
+    checksum.update( data )
+    return checksum.digest()
+
+
+def mismatched( found, expected, first_chunk=0 ):
+    """ Returns the indexes of the chunks whose CRCs differ, a missing or extra chunk counts as bad """
+    bad = [ first_chunk + i for i, ( a, b ) in enumerate( zip( found, expected ) ) if a != b ]
+    if len( found ) != len( expected ):
+        bad.append( first_chunk + min( len( found ), len( expected ) ) )
+    return bad
+
+
+def bad_chunks( data, first_chunk, expected, chunk=checksum_chunk ):
+    """ Checks data that starts at chunk first_chunk of a block, returns the indexes of the bad chunks """
+    return mismatched( chunk_crcs( data, chunk ), expected, first_chunk )
+
+
+def encode_sidecar( chunk, crcs, codec=None ):
+    prefix = b''
+    if codec:
+        name = codec.encode()
+        prefix = codec_magic + struct.pack( '>B', len( name ) ) + name
+    return prefix + struct.pack( '>I{0}I'.format( len( crcs ) ), chunk, *crcs )
+
+
+def split_sidecar( raw ):
+    """ Returns ( codec name or None, the rest of the sidecar ) """
+    if not raw.startswith( codec_magic ):
+        return None, raw
+    length = raw[ len( codec_magic ) ]
+    start = len( codec_magic ) + 1
+    return raw[ start:start + length ].decode(), raw[ start + length: ]
+
+
+def decode_sidecar( raw ):
+    """ Returns ( chunk size, list of CRCs ) """
+    _, raw = split_sidecar( raw )
+    chunk, = struct.unpack_from( '>I', raw )
+    return chunk, list( struct.unpack_from( '>{0}I'.format( ( len( raw ) - 4 ) // 4 ), raw, 4 ) )
+
+
+def format_crcs( crcs ):
+    """ CRCs as a header value, 'a1b2c3d4,0f0e0d0c' """
+    return ','.join( '{0:08x}'.format( c ) for c in crcs )
+
+
+def parse_crcs( value ):
+    return [ int( c, 16 ) for c in value.split(',') ] if value else []
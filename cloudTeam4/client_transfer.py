@@ -0,0 +1,301 @@
+import os, time, threading
+from concurrent.futures import ThreadPoolExecutor
+from erasure import block_groups, gather_blocks
+from compression import compress_block
+
+"""
+Parallel block transfers for the client. Blocks of a file are uploaded by a
+bounded pool of workers, each to the primary datanode the namenode picked for
+it, so a large file uses every datanode and many connections at once. Reads
+fetch many blocks at once from their replicas and write each one where it
+belongs in the file as it arrives, a block that cannot be read leaves a hole.
+
+With a codec each block is read into memory and compressed before it is sent,
+unless a sample of it shows it would barely shrink, then it is sent as it is.
+
+An erasure coded file is sent and read one block group at a time, all k + m
+blocks of a group at once. The client computes the parity blocks before it
+sends them and, when a data block cannot be read, decodes it from parity blocks.
+"""
+
+# Blocks uploaded at the same time
+write_concurrency = 8
+
+# Uploads at the same time to one primary datanode
+per_datanode_uploads = 3
+
+# Blocks past the ones being uploaded that the OS is asked to read ahead
+read_ahead_blocks = 2
+
+# Blocks fetched at the same time
+read_concurrency = 8
+
+
+class BlockSlice:
+    """
+    File-like view of one block of a file opened with os.open. requests reads it in
+    small pieces while uploading so the block is sent without loading it into memory.
+    It reads with os.pread so many slices of the same file can be sent at once.
+    """
+    def __init__(self, fd, offset, length):
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+        self.sent = 0
+
+    def __len__(self):
+        return self.length - self.sent
+
+    def read(self, size=-1):
+        remaining = self.length - self.sent
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = os.pread( self.fd, size, self.offset + self.sent )
+        self.sent += len( data )
+        return data
+
+
+def read_ahead( fd, offset, length ):
+    """ Asks the OS to start reading a block into the page cache before it is uploaded """
+    if hasattr( os, 'posix_fadvise' ):
+        try:
+            os.posix_fadvise( fd, offset, length, os.POSIX_FADV_WILLNEED )
+        except OSError:
+            pass
+
+
+def upload_blocks( file_name, block_size, sorted_blocks, blocks_to_dns, write_block,
+                   concurrency=write_concurrency, per_datanode=per_datanode_uploads, codec=None ):
+    """
+    Uploads every block of the file with a pool of workers
+
+    :param name: sorted_blocks
+    :param type: list
+        The block ids in file order, block i starts at i * block_size
+
+    :param name: blocks_to_dns
+    :param type: dict
+        < key: block id as str, val: list of datanodes, the first one is the primary >
+
+    :param name: write_block
+    :param type: function
+        write_block( primary, file_name, block_id, copy_nodes, body ) sends one block
+        and returns True if every replica was written, with a codec it is also given
+        codec=name of the codec the body is compressed with or None
+
+    :param name: codec
+    :param type: compression.Codec
+        The codec to compress blocks with, None sends them as they are
+
+    :returns: dict
+        {'blocks': 3, 'failed': [9], 'bytes': 3000000, 'seconds': 1.2, 'mb_per_sec': 2.5,
+         'sent': 1000000, 'compressed': 3}
+    """
+    file_size = os.path.getsize( file_name )
+    fd = os.open( file_name, os.O_RDONLY )
+    # At most concurrency uploads running and read_ahead_blocks waiting for a worker
+    window = threading.BoundedSemaphore( concurrency + read_ahead_blocks )
+    dn_limits = {}
+    failed = []
+    sent = [ 0, 0 ]
+    lock = threading.Lock()
+
+    def upload( index, block_id ):
+        try:
+            offset = index * block_size
+            length = min( block_size, file_size - offset )
+            data_nodes = blocks_to_dns[str(block_id)]
+            primary, copy_nodes = data_nodes[0], data_nodes[1:]
+            with lock:
+                dn_limit = dn_limits.setdefault( primary, threading.BoundedSemaphore( per_datanode ) )
+            if codec is None:
+                body, sent_with, extra = BlockSlice( fd, offset, length ), None, {}
+            else:
+                # compressed before the datanode limit is taken so the datanode is not kept waiting
+                body, sent_with = compress_block( os.pread( fd, length, offset ), codec )
+                extra = {'codec': sent_with}
+            with dn_limit:
+                print("Writing block {0} to {1} and copy to {2} ...".format( block_id, primary, copy_nodes ) )
+                if not write_block( primary, file_name, block_id, copy_nodes, body, **extra ):
+                    with lock:
+                        failed.append( block_id )
+            with lock:
+                sent[0] += len( body ) if sent_with else length
+                sent[1] += 1 if sent_with else 0
+        except Exception as a:
+            print( "Client ERROR: block {0} was not written: {1}".format( block_id, a ))
+            with lock:
+                failed.append( block_id )
+        finally:
+            window.release()
+
+    start = time.time()
+    try:
+        with ThreadPoolExecutor( max_workers=concurrency ) as pool:
+            for index, block_id in enumerate( sorted_blocks ):
+                window.acquire()
+                read_ahead( fd, index * block_size, block_size )
+                pool.submit( upload, index, block_id )
+    finally:
+        os.close( fd )
+    seconds = max( time.time() - start, 1e-6 )
+    return {'blocks': len( sorted_blocks ), 'failed': sorted( failed ), 'bytes': file_size,
+            'seconds': seconds, 'mb_per_sec': file_size / seconds / 1e6, 'sent': sent[0], 'compressed': sent[1] }
+
+
+def download_blocks( new_file_name, block_size, blocks_and_dns, fetch_block, concurrency=read_concurrency ):
+    """
+    Fetches every block of a file with a pool of workers and writes them to new_file_name.
+    Block i is written at i * block_size as soon as it arrives, a block that cannot be read
+    leaves a hole of zeros so the blocks after it stay where they belong. An error writing
+    the file is raised once the blocks being fetched are done.
+
+    :param name: block_size
+    :param type: int
+        The size of every block of the file but the last
+
+    :param name: blocks_and_dns
+    :param type: dict
+        < key: block id as str, val: list of datanodes with a replica >
+
+    :param name: fetch_block
+    :param type: function
+        fetch_block( block_id, nodes ) returns the bytes of the block from one of the nodes
+
+    :returns: dict
+        {'blocks': 3, 'failed': [9], 'bytes': 3000000, 'seconds': 1.2, 'mb_per_sec': 2.5}
+    """
+    sorted_blocks = sorted( blocks_and_dns, key=int )
+    fd = os.open( new_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644 )
+    failed, errors = [], []
+    written = [ 0 ]
+    lock = threading.Lock()
+
+    def fetch( index, block_id ):
+        try:
+            data = fetch_block( block_id, blocks_and_dns[block_id] )
+        except Exception as a:
+            print( "Client ERROR: block {0} could not be read: {1}".format( block_id, a ))
+            with lock:
+                failed.append( int( block_id ) )
+            return
+        try:
+            os.pwrite( fd, data, index * block_size )
+        except OSError as a:
+            with lock:
+                errors.append( a )
+            return
+        with lock:
+            written[0] += len( data )
+
+    start = time.time()
+    try:
+        # the pool holds at most concurrency blocks in memory, the ones being fetched
+        with ThreadPoolExecutor( max_workers=concurrency ) as pool:
+            for index, block_id in enumerate( sorted_blocks ):
+                pool.submit( fetch, index, block_id )
+    finally:
+        os.close( fd )
+    if errors:
+        raise errors[0]
+    seconds = max( time.time() - start, 1e-6 )
+    return {'blocks': len( sorted_blocks ), 'failed': sorted( failed ), 'bytes': written[0],
+            'seconds': seconds, 'mb_per_sec': written[0] / seconds / 1e6 }
+
+
+def upload_striped( file_name, block_size, sorted_blocks, blocks_to_dns, policy, write_block ):
+    """
+    Encodes every block group of an erasure coded file and uploads its data and parity blocks,
+    each to its own datanode
+
+    :param name: policy
+    :param type: ErasurePolicy
+        The policy of the file, sorted_blocks holds k + m block ids per group
+
+    :param name: write_block
+    :param type: function
+        Like upload_blocks, the blocks are sent without copy nodes
+
+    :returns: dict
+        {'blocks': 9, 'failed': [9], 'bytes': 3000000, 'seconds': 1.2, 'mb_per_sec': 2.5}
+    """
+    file_size = os.path.getsize( file_name )
+    failed = []
+    start = time.time()
+    with open( file_name, 'rb' ) as f, ThreadPoolExecutor( max_workers=policy.width ) as pool:
+        for ids, size in block_groups( sorted_blocks, policy, file_size, block_size ):
+            blocks = policy.encode( f.read( size ) )
+
+            def upload( block_id, body ):
+                try:
+                    datanode = blocks_to_dns[str(block_id)][0]
+                    print( "Writing block {0} of {1} bytes to {2} ...".format( block_id, len( body ), datanode ))
+                    return write_block( datanode, file_name, block_id, [], body )
+                except Exception as a:
+                    print( "Client ERROR: block {0} was not written: {1}".format( block_id, a ))
+                    return False
+
+            written = list( pool.map( upload, ids, blocks ) )
+            failed += [ b for b, ok in zip( ids, written ) if not ok ]
+    seconds = max( time.time() - start, 1e-6 )
+    return {'blocks': len( sorted_blocks ), 'failed': sorted( failed ), 'bytes': file_size,
+            'seconds': seconds, 'mb_per_sec': file_size / seconds / 1e6 }
+
+
+def download_striped( new_file_name, block_size, blocks_and_dns, striping, policy, fetch_block ):
+    """
+    Reads every block group of an erasure coded file and writes the file to new_file_name. The data
+    blocks of a group are read at once and the ones that fail, or have no datanode left, are decoded
+    from parity blocks. A group that cannot be read leaves a hole of zeros, the file keeps its size.
+
+    :param name: striping
+    :param type: dict
+        {'policy': "RS-6-3-1024k", 'size': 1200} from the namenode
+
+    :param name: fetch_block
+    :param type: function
+        fetch_block( block_id, nodes ) returns the bytes of the block from one of the nodes
+
+    :returns: dict
+        {'blocks': 9, 'failed': [9], 'decoded': 1, 'bytes': 3000000, 'seconds': 1.2, 'mb_per_sec': 2.5}
+    """
+    start = time.time()
+    failed, decoded, written = [], 0, 0
+    group_bytes = policy.group_bytes( block_size )
+    fd = os.open( new_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644 )
+    try:
+        with ThreadPoolExecutor( max_workers=policy.width ) as pool:
+            for g, ( ids, size ) in enumerate( block_groups( blocks_and_dns, policy, striping['size'], block_size ) ):
+                try:
+                    data, was_decoded = read_block_group( policy, ids, size, blocks_and_dns, fetch_block, pool )
+                    decoded += was_decoded
+                except Exception as a:
+                    print( "Client ERROR: block group {0} could not be read: {1}".format( ids, a ))
+                    failed += ids[:policy.k]
+                    continue
+                os.pwrite( fd, data, g * group_bytes )
+                written += len( data )
+        # a last group that could not be read is a hole at the end too
+        os.ftruncate( fd, int( striping['size'] ) )
+    finally:
+        os.close( fd )
+    seconds = max( time.time() - start, 1e-6 )
+    return {'blocks': len( blocks_and_dns ), 'failed': sorted( failed ), 'decoded': decoded, 'bytes': written,
+            'seconds': seconds, 'mb_per_sec': written / seconds / 1e6 }
+
+
+def read_block_group( policy, ids, size, blocks_and_dns, fetch_block, pool=None ):
+    """
+    Reads the size bytes of the file in one block group, decoding data blocks that cannot be read
+
+    :returns: tuple
+        ( bytes, True if parity blocks were needed )
+    """
+    nodes = [ blocks_and_dns[str(b)] for b in ids ]
+    lengths = policy.block_lengths( size )
+    found = gather_blocks( policy, lengths, lambda i: fetch_block( str( ids[i] ), nodes[i] ),
+                           skip=[ i for i in range( policy.width ) if not nodes[i] and lengths[i] ], pool=pool )
+    decoded = any( i not in found for i in range( policy.k ) )
+    if decoded:
+        found = dict( enumerate( policy.decode( found, size ) ) )
+    return policy.join( [ found[i] for i in range( policy.k ) ], size ), decoded
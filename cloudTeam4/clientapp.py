@@ -1,14 +1,19 @@
 
 import boto3
 import logging.handlers
-import os, math, sys, random, time
-import requests as r
+import os, math, sys, random, time, threading
 from flask_restful import Resource, reqparse
 from flask import Flask,request,jsonify
 from datetime import datetime
 from botocore.exceptions import ClientError
-from connect import connect_to_host
-import random
+from connect import connect_to_host, get_session, namenode_for, namenodes
+from client_transfer import upload_blocks, download_blocks, write_concurrency, per_datanode_uploads, read_concurrency
+from client_transfer import upload_striped, download_striped, read_block_group
+from erasure import ErasurePolicy, block_groups
+from replica_selector import ReplicaSelector, hedged_read
+from checksum import bad_chunks, parse_crcs, checksum_chunk
+from location_cache import LocationCache
+from compression import get_codec, default_codec, codec_header, decompress_block
 
 """ 
 Client handles the user interactions with the 
@@ -19,13 +24,29 @@ default_env = "LIVE"
 
 bucket_name = "hdfs-group4"
 
+# Latency and errors of each datanode, used to pick the replica to read
+replica_selector = ReplicaSelector()
+
+# Files sent to the namenode per batch request when the user names several
+namenode_batch_size = 1000
+
+# Blocks and datanodes of recently read files, so reading them again skips the namenode
+location_cache = LocationCache()
+
+# Codec blocks are compressed with before they are sent, from SDFS_COMPRESSION
+block_codec = get_codec( default_codec )
+
+
+class BlockNotFound(IOError):
+    """ A datanode does not have the block the namenode said it has """
+
 
 def start_sufs():
     """ Obtain initial input from client"""
     print("SUFS Initiated... Please indicate whether you'd like to \n")
     
     while True: 
-        command = input("\nwrite, read, list, delete, exit, mkdir, rmdir, ls, download, or exit: \n")
+        command = input("\nwrite, read, list, delete, exit, mkdir, rmdir, ls, policy, download, or exit: \n")
         if command == '' or command == 'exit':
             print("Thank You")
             break
@@ -44,10 +65,15 @@ def get_file_size( file_name ):
         return 0
 
 
-def clientapp_get_block_lists_to_write(directory, file_name, size):
-    """ Returns the necessary block information from name_node to write files to SUFS"""
-    route = connect_to_host("name", default_env) + '/file/'
-    response = r.post(route  , json={'file_name': file_name, 'directory': directory, 'size':size })
+def clientapp_get_block_lists_to_write(directory, file_name, size, policy=None):
+    """ Returns the necessary block information from name_node to write files to SUFS, 
+        policy is an erasure coding policy or "replicated" instead of the one of the directory"""
+    namenode = namenode_for( directory )
+    route = connect_to_host(namenode, default_env) + '/file/'
+    request_body = {'file_name': file_name, 'directory': directory, 'size':size }
+    if policy:
+        request_body['policy'] = policy
+    response = get_session( namenode, default_env ).post(route  , json=request_body)
     if response:
         response = response.json()
         if "error" in response:
@@ -64,11 +90,80 @@ def clientapp_get_block_lists_to_write(directory, file_name, size):
             block_data['block_count'] = int(block_count)
             block_data['block_size'] = int(block_size)
             block_data['data_blocks'] = blocks
+            block_data['striping'] = response.get('striping')
             return block_data
     else:
         print( "ERROR: NAMENODE IS OFFLINE. ENVIRONMENT IS {0}.".format( default_env ))
 
 
+def namenode_batch( method, route, files ):
+    """
+    Sends the files to a batch endpoint of the namenode that owns their directory, 
+    namenode_batch_size at a time
+
+    :returns: list
+        The result of each file in order, None for every file of a batch the namenode did not answer
+    """
+    results = [ None ] * len( files )
+    by_namenode = {}
+    for i, f in enumerate( files ):
+        by_namenode.setdefault( namenode_for( f['directory'] ), [] ).append( i )
+    for namenode, indexes in by_namenode.items():
+        for start in range( 0, len( indexes ), namenode_batch_size ):
+            batch = indexes[start:start + namenode_batch_size]
+            response = get_session( namenode, default_env ).request( method, connect_to_host( namenode, default_env ) + route,
+                                                                     json={'files': [ files[i] for i in batch ]} )
+            if not response:
+                print( "ERROR: NAMENODE IS OFFLINE. ENVIRONMENT IS {0}.".format( default_env ))
+                continue
+            response = response.json()
+            if "error" in response:
+                print( "NameNode {0}".format( response['error'] ))
+                continue
+            for i, result in zip( batch, response['results'] ):
+                # every file of a lookup is read with the block size of the batch
+                if 'block_size' in response and 'message' in result:
+                    result['block_size'] = response['block_size']
+                results[i] = result
+    return results
+
+
+def clientapp_get_block_lists_to_write_batch(directory, file_names):
+    """ Returns ( file name, block information ) of every file the namenode gave blocks to, one request per batch """
+    files = [ {'directory': directory, 'file_name': f, 'size': get_file_size( f )} for f in file_names ]
+    files = [ f for f in files if f['size'] > 0 ]
+    written = []
+    for f, response in zip( files, namenode_batch( 'POST', '/files/', files ) ):
+        if response is None:
+            continue
+        if "error" in response:
+            print( "NameNode {0}".format( response['error'] ))
+            continue
+        written.append( ( f['file_name'], {'file_name': f['file_name'], 'file_size': f['size'],
+                                           'block_count': int( response['block_count'] ), 'block_size': int( response['block_size'] ),
+                                           'data_blocks': response['blocks_and_dns'], 'striping': response.get('striping')} ) )
+    return written
+
+
+def clientapp_get_block_names_batch(file_names, directory, use_cache=True):
+    """ Returns the blocks and datanodes of every file like clientapp_get_block_names, one request per batch for the files not cached """
+    results = [ location_cache.get( ( directory, f ) ) if use_cache else None for f in file_names ]
+    missing = [ i for i, result in enumerate( results ) if result is None ]
+    answers = namenode_batch( 'POST', '/files/lookup/', [ {'directory': directory, 'file_name': file_names[i]} for i in missing ] )
+    for i, answer in zip( missing, answers ):
+        if answer and "error" not in answer:
+            location_cache.put( ( directory, file_names[i] ), answer )
+        results[i] = answer
+    return results
+
+
+def client_delete_files_from_namenode(directory, file_names):
+    """ Deletes the files from the namenode and returns their blocks like client_delete_file_from_namenode, one request per batch """
+    for f in file_names:
+        location_cache.invalidate( ( directory, f ) )
+    return namenode_batch( 'DELETE', '/files/', [ {'directory': directory, 'file_name': f} for f in file_names ] )
+
+
 def download_file( file_name ):
     """ Downloads a file from s3 returns True if it exist, False otherwise """
     try:
@@ -104,8 +199,10 @@ def client_delete_file_from_namenode(directory, file_name):
         and returns a list of block_ids where blocks of
         data associated with the given file_name can be passed
         to the delete functions for the datanodes """
-    route = connect_to_host("name", default_env) + '/file/'
-    response = r.delete(route + directory + "/" + file_name )
+    location_cache.invalidate( ( directory, file_name ) )
+    namenode = namenode_for( directory )
+    route = connect_to_host(namenode, default_env) + '/file/'
+    response = get_session( namenode, default_env ).delete(route + directory + "/" + file_name )
     if response:
         return response.json()        
     else:
@@ -113,22 +210,32 @@ def client_delete_file_from_namenode(directory, file_name):
         return 0
 
 
-def clientapp_get_block_names(file_name, directory):
+def clientapp_get_block_names(file_name, directory, use_cache=True):
     """This function returns a list of block_ids where blocks of
         data associated with the given file_name can be passed
-        to the read functions"""
-    route = connect_to_host("name", default_env)  + '/file/'
-    response = r.get(route + directory + "/" + file_name)
+        to the read functions. A recent answer of the namenode
+        is taken from the cache unless use_cache is False"""
+    if use_cache:
+        cached = location_cache.get( ( directory, file_name ) )
+        if cached is not None:
+            return cached
+    namenode = namenode_for( directory )
+    route = connect_to_host(namenode, default_env)  + '/file/'
+    response = get_session( namenode, default_env ).get(route + directory + "/" + file_name)
     if response:
-        return response.json()        
+        response = response.json()
+        if "error" not in response:
+            location_cache.put( ( directory, file_name ), response )
+        return response
     else:
         print( "ERROR: NAMENODE IS OFFLINE. ENVIRONMENT IS {0}.".format( default_env ))
 
 
 def remove_directory( directory ):
     """ Removes the specified directory, if it is empty """
-    route = connect_to_host( "name", default_env ) + '/directories/'
-    response = r.delete( route , json={'directory': directory} )
+    namenode = namenode_for( directory )
+    route = connect_to_host( namenode, default_env ) + '/directories/'
+    response = get_session( namenode, default_env ).delete( route , json={'directory': directory} )
     if response:
         response = response.json()
         if "error" in response:
@@ -139,8 +246,9 @@ def remove_directory( directory ):
 
 def remove_subdir(parent, sub_dir):
     """Removes a child driectory from a parent directory"""
-    route = connect_to_host("name", default_env) + '/directories/sub_dir/'
-    response = r.delete( route, json={'parent': parent, 'sub_directory': sub_dir} )
+    namenode = namenode_for( parent )
+    route = connect_to_host(namenode, default_env) + '/directories/sub_dir/'
+    response = get_session( namenode, default_env ).delete( route, json={'parent': parent, 'sub_directory': sub_dir} )
     if response:
         response = response.json()
         if "error" in response:
@@ -161,37 +269,64 @@ def clientapp_write_file(blocks_info):
     for block_id in blocks_to_dns.keys():
         block_l.append( int( block_id ))
     block_l.sort()
+    if blocks_info.get('striping'):
+        # Erasure coded, parity blocks are computed here and every block goes to its own datanode
+        return write_striped_file( file_name, block_size, block_l, blocks_to_dns, ErasurePolicy( blocks_info['striping']['policy'] ) )
     # Read the file in chunks and send to datanodes
     read_blocks_and_send_to_dns( file_name, block_size, block_l , blocks_to_dns )
 
 
-def write_request_to_dn( cur_data_node, file_name, block_id , copy_node, block_body ):
+def write_request_to_dn( cur_data_node, file_name, block_id , copy_node, block_body, codec=None ):
+    """ 
+    Sends the raw bytes of the block to the datanode, block_body is bytes or a BlockSlice
+    and codec the one it is compressed with, if any.
+    Returns True if the block was written to the datanode and all the copy nodes.
+    """
     route = connect_to_host( cur_data_node, default_env ) + '/block/'
-    response = r.post(route + file_name + "/" + str(block_id) , json={'block_body': block_body, 'copy_node': copy_node})
+    headers = {'Content-Type': 'application/octet-stream'}
+    if codec:
+        headers[codec_header] = codec
+    response = get_session( cur_data_node, default_env ).post(route + file_name + "/" + str(block_id), data=block_body, params={'copy_node': copy_node}, 
+                      headers=headers)
     if response:
         response = response.json()
         if "error" in response:
             print("DataNode {0}".format(  response['error'] ))
         else:
             print( response['message'] )
+            return True
     else:
         print( "ERROR: DATANODE {0} IS OFFLINE. ENVIRONMENT IS {1}.".format( cur_data_node, default_env ))
+    return False
 
 
-def read_blocks_and_send_to_dns( file_name, block_size, sorted_blocks , blocks_to_dns ):
+def read_blocks_and_send_to_dns( file_name, block_size, sorted_blocks , blocks_to_dns, 
+                                 concurrency=write_concurrency, per_datanode=per_datanode_uploads, codec=block_codec ):
+    """ Uploads the raw bytes of the blocks to their datanodes, many blocks at once, compressed with the codec """
     if download_is_complete( file_name ):
-        with open(file_name) as f:
-            index = 0
-            # For each block chunk write to a datanode
-            for piece in read_in_chunks(f, block_size):
-                block_id = sorted_blocks[index]
-                data_nodes = blocks_to_dns[str(block_id)]
-                cur_data_node = data_nodes[0]
-                data_nodes.pop(0)
-                copy_node = data_nodes
-                print("Writing to {0} and copy to {1} ...".format( cur_data_node, copy_node ) )
-                write_request_to_dn( cur_data_node, file_name, block_id , copy_node, piece )
-                index += 1
+        stats = upload_blocks( file_name, block_size, sorted_blocks, blocks_to_dns, write_request_to_dn, 
+                               concurrency, per_datanode, codec )
+        if stats['failed']:
+            print( "Client ERROR: blocks {0} were not written to all their datanodes.".format( stats['failed'] ))
+        print( "Wrote {0} blocks, {1:.1f} MB in {2:.2f} s at {3:.1f} MB/s".format( 
+            stats['blocks'], stats['bytes'] / 1e6, stats['seconds'], stats['mb_per_sec'] ))
+        if codec:
+            print( "Sent {0:.1f} MB, {1} blocks compressed with {2}".format( stats['sent'] / 1e6, stats['compressed'], codec.name ))
+        return stats
+    else:
+        print("Client ERROR: Download took over 2 minutes.")
+
+
+def write_striped_file( file_name, block_size, sorted_blocks, blocks_to_dns, policy ):
+    """ Uploads an erasure coded file one block group at a time """
+    if download_is_complete( file_name ):
+        stats = upload_striped( file_name, block_size, sorted_blocks, blocks_to_dns, policy, write_request_to_dn )
+        if stats['failed']:
+            print( "Client ERROR: blocks {0} were not written, the file is readable while no more than {1} blocks of a group are missing.".format( 
+                stats['failed'], policy.m ))
+        print( "Wrote {0} blocks of {1}, {2:.1f} MB in {3:.2f} s at {4:.1f} MB/s".format( 
+            stats['blocks'], policy.name, stats['bytes'] / 1e6, stats['seconds'], stats['mb_per_sec'] ))
+        return stats
     else:
         print("Client ERROR: Download took over 2 minutes.")
 
@@ -206,7 +341,7 @@ def clientapp_delete_file(blocks_dns):
     for block_id, data_node_list in blocks_and_dns.items():
         for dn in data_node_list:
             route = connect_to_host( dn, default_env ) + '/block/'
-            response = r.delete( route + block_id + "/" )
+            response = get_session( dn, default_env ).delete( route + block_id + "/" )
             if response:
                 response = response.json()
                 if "error" in response:
@@ -217,46 +352,270 @@ def clientapp_delete_file(blocks_dns):
                 print( "ERROR: DATANODE {0} IS OFFLINE. ENVIRONMENT IS {1}.".format( dn, default_env ))
 
 
-def clientapp_read_file(file_name, blocks):
+def fetch_block_from_dn( dn, block_id, started, cancelled ):
+    """ Returns the raw bytes of the block from the datanode, stops early if cancelled is set """
+    route = connect_to_host(dn, default_env ) + '/block/'
+    response = get_session( dn, default_env ).get(route + str(block_id) + '/raw', stream=True)
+    with response:
+        if response.status_code == 404:
+            raise BlockNotFound( "Datanode {0} does not have block {1}".format( dn, block_id ) )
+        if not response.ok:
+            raise IOError( "Datanode {0} could not send block {1}".format( dn, block_id ) )
+        started()
+        chunks = []
+        for chunk in response.iter_content( 64 * 1024 ):
+            if cancelled.is_set():
+                raise IOError( "Read of block {0} from {1} cancelled".format( block_id, dn ) )
+            chunks.append( chunk )
+    data = b''.join( chunks )
+    check_block_data( response, data, 0, dn, block_id )
+    return decompress_block( data, response.headers.get( codec_header ) )
+
+
+def read_range_from_dn( dn, block_id, offset, length ):
+    """ 
+    Returns length bytes of the block starting at offset. The range asked for is widened 
+    to whole checksum chunks so every byte returned is checked, only those chunks are sent.
+    A compressed block is sent whole and decompressed here.
+    """
+    start = offset - offset % checksum_chunk
+    end = -( -( offset + length ) // checksum_chunk ) * checksum_chunk
+    route = connect_to_host(dn, default_env ) + '/block/'
+    response = get_session( dn, default_env ).get(route + str(block_id) + '/raw', 
+                                                  headers={'Range': 'bytes={0}-{1}'.format( start, end - 1 )})
+    if response.status_code == 404:
+        raise BlockNotFound( "Datanode {0} does not have block {1}".format( dn, block_id ) )
+    if response.status_code not in ( 200, 206 ):
+        raise IOError( "Datanode {0} could not send block {1} bytes {2}-{3}".format( dn, block_id, offset, offset + length - 1 ) )
+    codec = response.headers.get( codec_header )
+    if codec:
+        check_block_data( response, response.content, 0, dn, block_id )
+        return decompress_block( response.content, codec )[ offset:offset + length ]
+    check_block_data( response, response.content, start, dn, block_id )
+    return response.content[ offset - start:offset - start + length ]
+
+
+def check_block_data( response, data, offset, dn, block_id ):
+    """ 
+    Checks bytes read from offset of a block against the chunk CRCs the datanode sent with them.
+    On a mismatch the datanode is asked to check its copy and an IOError is raised so another replica is read.
+    Blocks written before checksums were kept have none and are not checked.
+    """
+    crcs = response.headers.get('X-Checksums')
+    if crcs is None:
+        return
+    chunk = int( response.headers['X-Checksum-Chunk'] )
+    first = int( response.headers['X-Checksum-First'] )
+    if first * chunk != offset:
+        raise IOError( "Datanode {0} sent checksums of block {1} that do not line up with the data".format( dn, block_id ) )
+    bad = bad_chunks( data, first, parse_crcs( crcs ), chunk )
+    if bad:
+        try:
+            route = connect_to_host( dn, default_env ) + '/block/'
+            get_session( dn, default_env ).post( route + str(block_id) + '/verify' )
+        except Exception as a:
+            print( a )
+        raise IOError( "Block {0} from {1} failed its checksums in chunks {2}".format( block_id, dn, bad ) )
+
+
+def clientapp_read_range( blocks, offset, length, file_name=None, directory=None ):
+    """
+    Reads length bytes of a file starting at offset, fetching only the parts
+    of the blocks that hold them. blocks is the answer of clientapp_get_block_names.
+
+    With the file name and directory, blocks may come from the location cache. If a
+    datanode does not have a block the cached answer is dropped and, if the range
+    could not be read, it is read again with a fresh answer from the namenode.
+    """
+    stale = threading.Event()
+
+    def missing():
+        if directory is not None and not stale.is_set():
+            stale.set()
+            location_cache.invalidate( ( directory, file_name ) )
+
+    try:
+        return read_file_range( blocks, offset, length, missing )
+    except IOError:
+        if not stale.is_set():
+            raise
+    fresh = clientapp_get_block_names( file_name, directory, use_cache=False )
+    if not fresh or "error" in fresh:
+        raise IOError( "{0} could not be looked up again: {1}".format( file_name, fresh and fresh['error'] ))
+    print( "Blocks of {0} moved since they were cached, reading them again".format( file_name ))
+    return read_file_range( fresh, offset, length )
+
+
+def read_file_range( blocks, offset, length, missing=None ):
+    """ Reads length bytes of a file starting at offset, missing() is called when a datanode does not have a block """
+    if blocks.get('striping'):
+        return read_striped_range( blocks, offset, length, missing )
+    block_size = int( blocks['block_size'] )
+    sorted_blocks = sorted( blocks['message'].items(), key=lambda b: int(b[0]) )
+    data = []
+    while length > 0:
+        index, block_offset = divmod( offset, block_size )
+        if index >= len( sorted_blocks ):
+            break
+        block_id, nodes = sorted_blocks[index]
+        part_length = min( length, block_size - block_offset )
+        part = read_range_from_dns( block_id, nodes, block_offset, part_length, missing )
+        data.append( part )
+        if len( part ) < part_length:
+            break
+        offset += part_length
+        length -= part_length
+    return b''.join( data )
+
+
+def read_range_from_dns( block_id, nodes, offset, length, missing=None ):
+    """ Returns length bytes of the block starting at offset from the first datanode that can send them """
+    for dn in replica_selector.rank( nodes ):
+        try:
+            return read_range_from_dn( dn, block_id, offset, length )
+        except Exception as a:
+            print( a )
+            replica_selector.record_error( dn )
+            if isinstance( a, BlockNotFound ) and missing:
+                missing()
+    raise IOError( "No datanode could send block {0}".format( block_id ) )
+
+
+def read_striped_range( blocks, offset, length, missing=None ):
+    """
+    Reads length bytes of an erasure coded file starting at offset. Each cell is read from
+    its data block, if that fails the whole block group is read and decoded.
+    """
+    policy = ErasurePolicy( blocks['striping']['policy'] )
+    size, block_size = int( blocks['striping']['size'] ), int( blocks['block_size'] )
+    groups = block_groups( blocks['message'], policy, size, block_size )
+    group_bytes = policy.group_bytes( block_size )
+    length = min( length, size - offset )
+    data, decoded = [], {}
+    while length > 0:
+        g, group_offset = divmod( offset, group_bytes )
+        ids, group_size = groups[g]
+        index, block_offset = policy.locate( group_offset )
+        # a cell is the most one data block holds in a row
+        part_length = min( length, policy.cell - group_offset % policy.cell )
+        if g in decoded:
+            part = decoded[g][ group_offset:group_offset + part_length ]
+        else:
+            try:
+                part = read_range_from_dns( ids[index], blocks['message'][str(ids[index])], block_offset, part_length, missing )
+            except IOError as a:
+                print( "{0}, decoding block group {1}".format( a, g ))
+                decoded[g] = read_block_group( policy, ids, group_size, blocks['message'],
+                                               lambda block_id, nodes: read_block_from_dns( block_id, nodes, missing ) )[0]
+                part = decoded[g][ group_offset:group_offset + part_length ]
+        data.append( part )
+        offset += part_length
+        length -= part_length
+    return b''.join( data )
+
+
+def read_block_from_dns( block_id, nodes, missing=None ):
+    """ Returns the raw bytes of the block from the fastest healthy datanode that has it """
+
+    def fetch( dn, block_id, started, cancelled ):
+        try:
+            return fetch_block_from_dn( dn, block_id, started, cancelled )
+        except BlockNotFound:
+            if missing:
+                missing()
+            raise
+
+    return hedged_read( block_id, nodes, fetch, replica_selector )
+
+
+def clientapp_read_file(file_name, blocks, concurrency=read_concurrency, directory=None):
     """
     The read function takes in a file_name and a list of 
     datablocks supplied by the name_node which then sends 
     requests to the corresponding data_nodes to access block
-    data.
+    data. Many blocks are fetched at once and written to the
+    file in block order.
+
+    With the directory, blocks may come from the location cache. If a datanode
+    does not have a block the cached answer is dropped and, if some block could
+    not be read, the file is read again with a fresh answer from the namenode.
     """ 
-    new_file_name =  "local_" + file_name 
-    f = open( new_file_name,"w")
-    b = blocks['message']
+    key = ( directory, file_name )
+    stale = threading.Event()
 
-    for block_id, nodes in b.items():
-        block_id = int(block_id)
+    def fetch( dn, block_id, started, cancelled ):
+        try:
+            return fetch_block_from_dn( dn, block_id, started, cancelled )
+        except BlockNotFound:
+            if directory is not None and not stale.is_set():
+                stale.set()
+                location_cache.invalidate( key )
+            raise
 
-    for block_id, nodes in sorted(b.items()):
-        dn = random.choice(nodes)
-        route = connect_to_host(dn, default_env ) + '/block/'
-        variables = r.get(route + str(block_id) + '/').json()
-        text = str(variables['block_body'])
-        f.write(text)
-    f.close()
+    def read_block( block_id, nodes ):
+        return hedged_read( block_id, nodes, fetch, replica_selector )
+
+    new_file_name =  "local_" + file_name 
+    if blocks.get('striping'):
+        # Erasure coded, a block that cannot be read is decoded from the rest of its group
+        stats = download_striped( new_file_name, int( blocks['block_size'] ), blocks['message'], blocks['striping'],
+                                  ErasurePolicy( blocks['striping']['policy'] ), read_block )
+        if stats['decoded']:
+            print( "Decoded {0} block groups of {1} from parity blocks".format( stats['decoded'], file_name ))
+    else:
+        stats = download_blocks( new_file_name, int( blocks['block_size'] ), blocks['message'], read_block, concurrency )
+    if stats['failed'] and stale.is_set():
+        fresh = clientapp_get_block_names( file_name, directory, use_cache=False )
+        if not fresh or "error" in fresh:
+            print( "Client ERROR: {0} could not be looked up again: {1}".format( file_name, fresh and fresh['error'] ))
+        else:
+            if fresh.get('generation') != blocks.get('generation'):
+                print( "{0} was written again since it was cached, reading the new file".format( file_name ))
+            else:
+                print( "Blocks of {0} moved since they were cached, reading them again".format( file_name ))
+            return clientapp_read_file( file_name, fresh, concurrency )
+    if stats['failed']:
+        print( "Client ERROR: blocks {0} could not be read.".format( stats['failed'] ))
+    print( "Read {0} blocks, {1:.1f} MB in {2:.2f} s at {3:.1f} MB/s".format( 
+        stats['blocks'], stats['bytes'] / 1e6, stats['seconds'], stats['mb_per_sec'] ))
+    return stats
 
 
 def list_all_in_directory( directory ):
-    """ Lists all the files of the specified directory """
-    route = connect_to_host( "name", default_env ) + '/directories/'
-    response = r.post(route , json={'directory': directory})
+    """ Lists all the files of the specified directory, the top level directories of every namenode for the root """
+    top_level = not [ name for name in directory.split( '\\' ) if name ]
+    for namenode in ( namenodes() if top_level else [ namenode_for( directory ) ] ):
+        route = connect_to_host( namenode, default_env ) + '/directories/'
+        response = get_session( namenode, default_env ).post(route , json={'directory': directory})
+        if response:
+            response = response.json()
+            if "error" in response:
+                print("Namenode {0}".format(  response['error'] ))
+            else:
+                print( response['message'] )
+        else:
+            print( "ERROR: NAMENODE IS OFFLINE. ENVIRONMENT IS {0}.".format( default_env ))
+ 
+
+def clientapp_makedir(directory_name):
+    namenode = namenode_for( directory_name )
+    route = connect_to_host(namenode, default_env) + '/directories/' + directory_name + '/'
+    response = get_session( namenode, default_env ).get( route )
     if response:
         response = response.json()
         if "error" in response:
-            print("Namenode {0}".format(  response['error'] ))
+            print("Namenode {0}".format( response['error'] ))
         else:
             print( response['message'] )
     else:
-        print( "ERROR: NAMENODE IS OFFLINE. ENVIRONMENT IS {0}.".format( default_env ))
- 
+        print("ERROR: NAMENODE IS OFFLINE. ENVIRONMENT IS {0}.".format( default_env))
 
-def clientapp_makedir(directory_name):
-    route = connect_to_host("name", default_env) + '/directories/' + directory_name + '/'
-    response = r.get( route )
+
+def clientapp_set_policy(directory, policy):
+    """ Sets the erasure coding policy of the directory, like RS-6-3, "replicated" or none """
+    namenode = namenode_for( directory )
+    route = connect_to_host(namenode, default_env) + '/directories/policy/'
+    response = get_session( namenode, default_env ).put( route, json={'directory': directory, 'policy': policy} )
     if response:
         response = response.json()
         if "error" in response:
@@ -268,8 +627,9 @@ def clientapp_makedir(directory_name):
 
 
 def clientapp_make_sub(parent, directory_name):
-    route = connect_to_host("name", default_env) + '/directories/sub/' + parent + '/' + directory_name + '/'
-    response = r.get(route)
+    namenode = namenode_for( parent )
+    route = connect_to_host(namenode, default_env) + '/directories/sub/' + parent + '/' + directory_name + '/'
+    response = get_session( namenode, default_env ).get(route)
     if response:
         response = response.json()
         if "error" in response:
@@ -296,42 +656,64 @@ def clinetapp_get_user_input(user_input):
     """
     try:
         if user_input == 'write':
-            file_name = input("Please enter the file to write: ")
+            file_names = input("Please enter the files to write, seperated with spaces: ").split()
             directory = input("Enter the path, seperated with \ (ex: test\data): ")
-            size = get_file_size( file_name )
-            if size > 0:
-                block_info = clientapp_get_block_lists_to_write(directory, file_name, size)
-                if block_info != 0:
+            if len( file_names ) > 1:
+                for file_name, block_info in clientapp_get_block_lists_to_write_batch(directory, file_names):
                     clientapp_write_file(block_info)
+            elif file_names:
+                file_name = file_names[0]
+                size = get_file_size( file_name )
+                if size > 0:
+                    block_info = clientapp_get_block_lists_to_write(directory, file_name, size)
+                    if block_info != 0:
+                        clientapp_write_file(block_info)
 
         elif user_input == "read":
-            file_name = input("Please enter the file to read: ")
+            file_names = input("Please enter the files to read, seperated with spaces: ").split()
             directory = input("Enter the path, seperated with \ (ex: test\data): ")
-            blocks = clientapp_get_block_names(file_name, directory)
-            if "error" in blocks:
-                print( blocks["error"] )
+            if len( file_names ) > 1:
+                all_blocks = clientapp_get_block_names_batch(file_names, directory)
             else:
-                clientapp_read_file(file_name, blocks)
-
-        elif user_input == "delete":
-            file_name = input("Please enter the file to delete: ")
-            directory = input("Enter the path, seperated with \ (ex: test\data): ")
-            blocks = client_delete_file_from_namenode( directory, file_name )
-            if blocks:
+                all_blocks = [ clientapp_get_block_names(file_name, directory) for file_name in file_names ]
+            for file_name, blocks in zip( file_names, all_blocks ):
+                if not blocks:
+                    continue
                 if "error" in blocks:
                     print( blocks["error"] )
                 else:
-                    print( "Deleting {0} ....".format( blocks['blocks_and_dns'] ))
-                    clientapp_delete_file(blocks)
+                    clientapp_read_file(file_name, blocks, directory=directory)
+
+        elif user_input == "delete":
+            file_names = input("Please enter the files to delete, seperated with spaces: ").split()
+            directory = input("Enter the path, seperated with \ (ex: test\data): ")
+            if len( file_names ) > 1:
+                all_blocks = client_delete_files_from_namenode( directory, file_names )
+            else:
+                all_blocks = [ client_delete_file_from_namenode( directory, file_name ) for file_name in file_names ]
+            for blocks in all_blocks:
+                if blocks:
+                    if "error" in blocks:
+                        print( blocks["error"] )
+                    else:
+                        print( "Deleting {0} ....".format( blocks['blocks_and_dns'] ))
+                        clientapp_delete_file(blocks)
                 
         elif user_input == "list":
-            file_name = input("Please enter the file to list: ")
+            file_names = input("Please enter the files to list, seperated with spaces: ").split()
             directory = input("Enter the path, seperated with \ (ex: test\data): ")
-            blocks = clientapp_get_block_names(file_name, directory)
-            if "error" in blocks:
-                print(blocks)
+            # a listing shows where the blocks are now, so it always asks the namenode
+            if len( file_names ) > 1:
+                all_blocks = clientapp_get_block_names_batch(file_names, directory, use_cache=False)
             else:
-               clientapp_list_blocks(file_name, blocks)
+                all_blocks = [ clientapp_get_block_names(file_name, directory, use_cache=False) for file_name in file_names ]
+            for file_name, blocks in zip( file_names, all_blocks ):
+                if not blocks:
+                    continue
+                if "error" in blocks:
+                    print(blocks)
+                else:
+                   clientapp_list_blocks(file_name, blocks)
 
         elif user_input == "mkdir":
             sub = input("is this a sub directory? (y/n) ")
@@ -353,6 +735,11 @@ def clinetapp_get_user_input(user_input):
                 directory = input("please specify the directory you'd like to remove: ")
                 remove_directory( directory )
 
+        elif user_input == "policy":
+            directory = input("Enter the path, seperated with \ (ex: test\data): ")
+            policy = input("Erasure coding policy like RS-6-3, replicated, or nothing to use the parent's: ")
+            clientapp_set_policy( directory, policy.strip() )
+
         elif user_input == "ls":
             directory = input("Enter the path, seperated with \ (ex: test\data): ")
             list_all_in_directory( directory )
@@ -368,7 +755,7 @@ def clinetapp_get_user_input(user_input):
                 print( "Can not download from s3")
 
         else: 
-             print("Please indicate either write, read, list, delete, exit, mkdir, rmdir, ls, download, or exit")
+             print("Please indicate either write, read, list, delete, exit, mkdir, rmdir, ls, policy, download, or exit")
     except Exception as e:
         return jsonify({"error": str(e)})
 
@@ -0,0 +1,133 @@
+import os, zlib
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+Block compression for the client. A block is compressed once by the client
+before it is sent, so the write pipeline copies and the datanodes store the
+compressed bytes. The datanode keeps the name of the codec with the checksums
+of the block and sends it with the block, the client decompresses what it reads.
+
+Before a block is compressed a few pieces of it are, if those barely shrink the
+block is sent as it is, so data that is already compressed costs next to nothing.
+zlib is always there, lz4 and zstd are used when their packages are installed.
+"""
+
+# Codec the client writes blocks with, none, auto, zlib, lz4 or zstd. auto is the first installed of zstd, lz4 and zlib
+default_codec = os.environ.get( 'SDFS_COMPRESSION', 'none' )
+
+# Header that carries the codec of a block between the client and the datanodes
+codec_header = 'X-Block-Codec'
+
+# Pieces of a block compressed to guess how well all of it compresses, and the bytes of each
+sample_count = 8
+sample_bytes = 4096
+
+# A block is sent compressed only if that saves at least this share of its bytes
+min_saving = 0.1
+
+# Blocks smaller than this are always sent as they are
+min_block_bytes = 4096
+
+# Compression levels, both of them favour speed over ratio
+zlib_level = 1
+zstd_level = 3
+
+
+class Codec:
+    """ A named pair of compress and decompress functions """
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _zstd_compress( data ):
+    # compressor objects are not thread safe and blocks are compressed by a pool of workers
+    return zstandard.ZstdCompressor( level=zstd_level ).compress( data )
+
+
+def _zstd_decompress( data ):
+    return zstandard.ZstdDecompressor().decompress( data )
+
+
+# Every codec a block may be written with, installed or not
+codec_names = ( 'zlib', 'lz4', 'zstd' )
+
+# The installed codecs < key: name, val: Codec >
+codecs = {'zlib': Codec( 'zlib', lambda data: zlib.compress( data, zlib_level ), zlib.decompress )}
+if lz4 is not None:
+    codecs['lz4'] = Codec( 'lz4', lz4.frame.compress, lz4.frame.decompress )
+if zstandard is not None:
+    codecs['zstd'] = Codec( 'zstd', _zstd_compress, _zstd_decompress )
+
+
+def get_codec( name ):
+    """
+    The codec to write blocks with
+
+    :param name: name
+    :param type: str
+        none, auto or the name of a codec
+
+    :returns: Codec
+        None for none, raises ValueError if the codec is unknown or not installed
+    """
+    name = ( name or 'none' ).strip().lower()
+    if name == 'none':
+        return None
+    if name == 'auto':
+        return next( codecs[n] for n in ( 'zstd', 'lz4', 'zlib' ) if n in codecs )
+    if name not in codec_names:
+        raise ValueError( "Unknown codec {0}, use none, auto or one of {1}".format( name, ', '.join( codec_names ) ) )
+    if name not in codecs:
+        raise ValueError( "Codec {0} is not installed".format( name ) )
+    return codecs[name]
+
+
+def sample( data ):
+    """ sample_count pieces of the block spread evenly over it """
+    if len( data ) <= sample_count * sample_bytes:
+        return bytes( data )
+    step = ( len( data ) - sample_bytes ) // ( sample_count - 1 )
+    return b''.join( data[ i * step:i * step + sample_bytes ] for i in range( sample_count ) )
+
+
+def worth_compressing( data ):
+    """ True if the sample of the block shrinks by at least min_saving with fast zlib """
+    piece = sample( data )
+    return len( zlib.compress( piece, 1 ) ) <= len( piece ) * ( 1 - min_saving )
+
+
+def compress_block( data, codec ):
+    """
+    Compresses the block if that is worth it
+
+    :returns: tuple
+        ( bytes to send, name of the codec or None if the block is sent as it is )
+    """
+    if codec is None or len( data ) < min_block_bytes or not worth_compressing( data ):
+        return data, None
+    compressed = codec.compress( data )
+    if len( compressed ) > len( data ) * ( 1 - min_saving ):
+        return data, None
+    return compressed, codec.name
+
+
+def decompress_block( data, name ):
+    """ The block as it was written, raises IOError if its codec is not installed here or the bytes do not decompress """
+    if not name:
+        return data
+    if name not in codecs:
+        raise IOError( "Block is compressed with {0} which is not installed".format( name ) )
+    try:
+        return codecs[name].decompress( data )
+    except Exception as a:
+        raise IOError( "Block does not decompress with {0}: {1}".format( name, a ) )
@@ -1,12 +1,170 @@
+import os, time, threading, zlib
 import requests as r
+from requests.adapters import HTTPAdapter
+
+""" 
+Connection configuration
+
+A federated cluster has several namenodes, each owning part of the namespace
+with its own pool of block ids. They are listed in SDFS_NAMESPACES in a fixed
+order, the position of a namespace is its block pool, so new ones are only
+ever added at the end
+    SDFS_NAMESPACES=ns0=http://namenode0:4000,ns1=http://namenode1:4000
+A top level directory belongs to the namespace it is mounted on in SDFS_MOUNTS,
+the others are spread over the namespaces by a hash of their name
+    SDFS_MOUNTS=logs=ns1,users=ns0
+Without SDFS_NAMESPACES there is one namenode, the "name" service.
+"""
+
+# Seconds a resolved host is used before it is resolved and probed again
+host_ttl = 300
+
+# Keep-alive connections kept open to each host
+pool_size = 32
+
+# Seconds the fixed host of a datanode missing from the membership table is used, it may register any moment
+fallback_ttl = 1
+
+# Resolved hosts < key: (service, environment), val: (host, time it expires) >
+_hosts = {}
+
+# Pooled sessions < key: host, val: requests.Session >
+_sessions = {}
+
+# Datanode addresses from the namenode membership table < key: environment, val: ( {datanode: address}, time loaded ) >
+_members = {}
+
+# Seconds between loads of the membership table when a datanode is not in it
+members_retry = 1
+
+# Namenodes of a federated cluster [ ( namespace, address ) ] in block pool order
+namespaces = [ tuple( entry.split( '=', 1 ) ) for entry in os.environ.get( 'SDFS_NAMESPACES', '' ).split( ',' ) if '=' in entry ]
+
+# Top level directories mounted on a namespace < key: directory, val: namespace >
+mounts = dict( entry.split( '=', 1 ) for entry in os.environ.get( 'SDFS_MOUNTS', '' ).split( ',' ) if '=' in entry )
+
+# Namespace of this namenode, None when there is only one
+namespace_id = os.environ.get( 'SDFS_NAMESPACE_ID' )
+
+# Block ids of block pool p are p << block_pool_bits plus a counter, the pool of a block is in its id
+block_pool_bits = 48
+
+_lock = threading.Lock()
+
+
+class HostSession(r.Session):
+    """ Keep-alive session for one host, forgets the resolved host when it cannot be reached """
+
+    def __init__(self, host):
+        super().__init__()
+        self.host = host
+        adapter = HTTPAdapter( pool_connections=1, pool_maxsize=pool_size )
+        self.mount( 'http://', adapter )
+        self.mount( 'https://', adapter )
+
+    def request(self, *args, **kwargs):
+        try:
+            return super().request( *args, **kwargs )
+        except r.exceptions.ConnectionError:
+            invalidate_host( self.host )
+            raise
 
-""" Connection configuration"""
 
 def connect_to_host( service, environment ):
-    if environment == "LIVE":
-        return connect_to_host_live( service )
-    else:
-        return connect_to_host_dev( service )
+    """ 
+    Returns the host of the service, resolved once and cached until host_ttl runs out or it fails.
+    A datanode that is not registered yet gets its fixed host for fallback_ttl only.
+    """
+    key = ( service, environment )
+    with _lock:
+        cached = _hosts.get( key )
+    if cached and time.monotonic() < cached[1]:
+        return cached[0]
+    host, ttl = None, host_ttl
+    if namespaces and ( service == "name" or service in dict( namespaces ) ):
+        # the first namenode also answers what any namenode can, like the membership table
+        host = dict( namespaces ).get( service, namespaces[0][1] )
+    elif service not in ( "name", "client" ):
+        host = lookup_datanode( service, environment )
+        if host is None:
+            ttl = fallback_ttl
+    if host is None and environment == "LIVE":
+        host = connect_to_host_live( service )
+    elif host is None:
+        host = connect_to_host_dev( service )
+    with _lock:
+        _hosts[key] = ( host, time.monotonic() + ttl )
+    return host
+
+
+def namenode_for( path ):
+    """ Returns the service of the namenode that owns the path, by its top level directory """
+    if not namespaces:
+        return "name"
+    names = [ name for name in path.split( '\\' ) if name ]
+    top = names[0] if names else ''
+    if top in mounts:
+        return mounts[top]
+    return namespaces[ zlib.crc32( top.encode('utf-8') ) % len( namespaces ) ][0]
+
+
+def namenodes():
+    """ Returns the service of every namenode, datanodes register with all of them """
+    return [ ns for ns, _ in namespaces ] or [ "name" ]
+
+
+def block_pool( namespace ):
+    """ The block pool of the namespace, 0 when there is only one namenode """
+    if not namespaces or namespace is None:
+        return 0
+    return [ ns for ns, _ in namespaces ].index( namespace )
+
+
+def namenode_for_block( block_id ):
+    """ Returns the service of the namenode whose pool the block id is from """
+    if not namespaces:
+        return "name"
+    return namespaces[ int( block_id ) >> block_pool_bits ][0]
+
+
+def get_session( service, environment ):
+    """ Returns the pooled keep-alive session for the host of the service """
+    host = connect_to_host( service, environment )
+    with _lock:
+        session = _sessions.get( host )
+        if session is None:
+            session = _sessions[host] = HostSession( host )
+    return session
+
+
+def invalidate_host( host ):
+    """ Forgets every service resolved to the host so the next call resolves it again """
+    with _lock:
+        for key in [ k for k, v in _hosts.items() if v[0] == host ]:
+            del _hosts[key]
+            # a datanode that moved is looked up in a fresh membership table
+            _members.pop( key[1], None )
+
+
+def lookup_datanode( datanode, environment ):
+    """ 
+    Returns the address the datanode registered with the namenode, None if it is not registered 
+    or the namenode cannot be reached. The table is loaded once and kept for host_ttl.
+    """
+    with _lock:
+        members, loaded = _members.get( environment, ( {}, 0 ) )
+    age = time.monotonic() - loaded
+    if age >= host_ttl or ( datanode not in members and age >= members_retry ):
+        try:
+            route = connect_to_host( "name", environment ) + '/datanodes/'
+            table = get_session( "name", environment ).get( route ).json()['datanodes']
+            members = { dn: info['address'] for dn, info in table.items() }
+        except Exception as a:
+            print( "Could not load the datanodes from the namenode: {0}".format( a ))
+        with _lock:
+            _members[environment] = ( members, time.monotonic() )
+    return members.get( datanode )
+
 
 def connect_to_host_dev( service ):
     if service[0] == "d":
@@ -25,13 +183,13 @@ def connect_to_host_dev( service ):
 def connect_to_host_live( service ):
     if service == "dn0":
         print( "Live on dn0")
-        host = "http://35.165.104.182:5000" 
+        host = "http://35.165.104.182:5000"
     elif service == "dn1":
         print( "Live on dn1")
         host = "http://52.12.167.133:5000"
     elif service == "dn2":
         print( "Live on dn2")
-        host = "http://54.213.245.226:5000" 
+        host = "http://54.213.245.226:5000"
     elif service == "client":
         host = "http://52.38.61.85:4000"
     elif service == "dn3":
@@ -44,4 +202,4 @@ def connect_to_host_live( service ):
 # Current DN Configs
 redis_host_dn = 'redisservice' #'34.215.63.33'
 redis_host_nn = 'redisservice' #'54.188.135.209'
-datanode_id = "dn0"
\ No newline at end of file
+datanode_id = os.environ.get( 'SDFS_DATANODE_ID', "dn0" )
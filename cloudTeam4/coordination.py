@@ -0,0 +1,180 @@
+import os, threading, time, uuid
+import redis
+
+"""
+Coordination of the worker processes of a namenode through redis. Every
+worker serves requests, one of them is the leader and is the only one that
+writes the edit log and times out the datanodes.
+
+The leader holds a lease, a redis key with its token that expires unless it is
+renewed. When the leader stops renewing it, because its process died or hangs,
+another worker takes the lease once it expired. A leader that finds its lease
+taken stops its process rather than write the edit log next to the new leader.
+
+Namespace changes of all workers are serialized by a shared lock, a thread
+lock within the worker and a short lived redis key across the workers, renewed
+while it is held so only a worker that died or hangs holding it lets it run
+out. A worker waiting for the key blocks on a list the holder pushes to when
+it lets go, rather than asking for the key over and over.
+"""
+
+# Seconds the leader's lease lasts without a renewal, and between renewals
+lease_seconds = 10
+renew_seconds = 2
+
+# Seconds the namespace lock lasts without a renewal, a worker that died holding it does not block the others longer
+lock_lease_seconds = 10
+
+# Seconds a worker waits for the namespace lock to be let go before it tries again, in case the holder died
+lock_wait_seconds = 1
+
+
+class Leadership:
+    """ Takes and renews the lease of one redis key, calls on_elected once it holds it """
+
+    def __init__(self, r_cache, key, on_elected, on_lost, lease=lease_seconds, renew=renew_seconds):
+        """
+        :param name: on_elected
+        :param type: function
+            Called in a thread of its own when this worker becomes the leader, the lease is renewed meanwhile
+
+        :param name: on_lost
+        :param type: function
+            Called when another worker took the lease, or it could not be renewed before it ran out
+        """
+        self.r_cache = r_cache
+        self.key = key
+        self.on_elected = on_elected
+        self.on_lost = on_lost
+        self.lease = lease
+        self.renew = renew
+        self.token = '{0}:{1}'.format( os.getpid(), uuid.uuid4().hex )
+        self.is_leader = False
+        self.renewed = 0.0
+        self.thread = threading.Thread( target=self._run, daemon=True )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def try_acquire(self):
+        """ Takes the lease if it is free or renews it if this worker holds it, returns True if it holds it """
+        if self.r_cache.set( self.key, self.token, nx=True, ex=self.lease ):
+            return True
+        with self.r_cache.pipeline() as pipe:
+            try:
+                pipe.watch( self.key )
+                if _decode( pipe.get( self.key ) ) != self.token:
+                    return False
+                pipe.multi()
+                pipe.expire( self.key, self.lease )
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def leader(self):
+        """ The token of the worker holding the lease, pid:random, None if no worker does """
+        return _decode( self.r_cache.get( self.key ) )
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            try:
+                held = self.try_acquire()
+            except redis.RedisError as a:
+                print( "Leader lease ERROR: {0}".format( a ))
+                # redis may come back before the lease runs out
+                held = None
+            if held:
+                self.renewed = now
+                if not self.is_leader:
+                    self.is_leader = True
+                    print( "Worker {0} is the leader".format( os.getpid() ))
+                    threading.Thread( target=self._elected, daemon=True ).start()
+            elif self.is_leader and ( held is False or now - self.renewed >= self.lease ):
+                self.is_leader = False
+                self.on_lost()
+            time.sleep( self.renew )
+
+    def _elected(self):
+        try:
+            self.on_elected()
+        except Exception as a:
+            # a leader that cannot lead gives the lease up to another worker
+            print( "Leader ERROR: {0}".format( a ))
+            self.is_leader = False
+            self.on_lost()
+
+
+class SharedLock:
+    """ A lock held by one thread of one worker at a time """
+
+    def __init__(self, r_cache, key, lease=lock_lease_seconds, wait=lock_wait_seconds):
+        self.r_cache = r_cache
+        self.key = key
+        # list with at most one element, pushed when the lock is let go
+        self.free_key = key + ':free'
+        self.lease = lease
+        self.wait = wait
+        self.token = '{0}:{1}'.format( os.getpid(), uuid.uuid4().hex )
+        # the threads of the worker queue here, only one of them at a time asks redis
+        self.local = threading.Lock()
+        self.held = False
+        # started by the first holder, a thread would not survive the fork of the worker
+        self.renewer = None
+
+    def __enter__(self):
+        self.local.acquire()
+        try:
+            while not self.r_cache.set( self.key, self.token, nx=True, px=int( self.lease * 1000 ) ):
+                # a push since the set failed is still in the list, the wait returns at once
+                self.r_cache.blpop( self.free_key, timeout=self.wait )
+        except BaseException:
+            self.local.release()
+            raise
+        self.held = True
+        if self.renewer is None:
+            self.renewer = threading.Thread( target=self._renew, daemon=True )
+            self.renewer.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.held = False
+        try:
+            pipe = self.r_cache.pipeline()
+            pipe.getdel( self.key )
+            pipe.rpush( self.free_key, 1 )
+            pipe.ltrim( self.free_key, 0, 0 )
+            held = _decode( pipe.execute()[0] )
+            if held != self.token:
+                # the lease ran out and another worker took the lock, it is put back for it
+                print( "Namespace lock was held longer than its lease of {0} s".format( self.lease ))
+                if held is not None:
+                    self.r_cache.set( self.key, held, nx=True, px=int( self.lease * 1000 ) )
+        finally:
+            self.local.release()
+
+    def _renew(self):
+        while True:
+            time.sleep( self.lease / 3 )
+            if not self.held:
+                continue
+            with self.r_cache.pipeline() as pipe:
+                try:
+                    # let go of meanwhile, the watch fails the renewal
+                    pipe.watch( self.key )
+                    if _decode( pipe.get( self.key ) ) == self.token:
+                        pipe.multi()
+                        pipe.pexpire( self.key, int( self.lease * 1000 ) )
+                        pipe.execute()
+                except redis.WatchError:
+                    pass
+                except redis.RedisError as a:
+                    print( "Namespace lock renewal ERROR: {0}".format( a ))
+
+
+def _decode( value ):
+    if isinstance( value, bytes ):
+        return value.decode('utf-8')
+    return value
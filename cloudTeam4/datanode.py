@@ -1,13 +1,21 @@
 import boto3
-import requests as r
 import json
 import os, math, sys, random
 from flask_restful import Resource, reqparse
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from werkzeug.wsgi import wrap_file
 from datetime import datetime
 import time, redis
 from botocore.exceptions import ClientError
-from connect import redis_host_dn,  datanode_id, connect_to_host
+from connect import redis_host_dn,  datanode_id, connect_to_host, get_session, namenodes, namenode_for_block
+from write_pipeline import PipelineForwarder
+from block_storage import BlockStorage
+from block_scanner import BlockScanner
+from checksum import format_crcs, bad_chunks, parse_crcs
+from block_delta import BlockDelta
+from block_cache import BlockCache
+from erasure import ErasurePolicy, gather_blocks
+from compression import codec_header, codec_names, decompress_block
 
 
 """
@@ -25,6 +33,29 @@ blocks = []
 # Env to connect to
 default_env = "Dev"
 
+# Bytes read from a request and written to disk at a time
+chunk_size = 64 * 1024
+
+# Content type of raw block bytes
+octet_stream = 'application/octet-stream'
+
+# Where blocks are stored, how many levels of hash-sharded directories, and when they are synced to disk
+data_root = os.environ.get( 'SDFS_DATA_ROOT', 'blocks' )
+shard_levels = int( os.environ.get( 'SDFS_SHARD_LEVELS', 2 ) )
+fsync_policy = os.environ.get( 'SDFS_FSYNC_POLICY', 'group' )
+preallocate = os.environ.get( 'SDFS_PREALLOCATE', '1' ) == '1'
+
+storage = BlockStorage( data_root, shard_levels, fsync_policy, preallocate )
+
+# Bytes a second and seconds between passes of the background block scanner
+scan_rate = int( os.environ.get( 'SDFS_SCAN_RATE', 4 * 1024 * 1024 ) )
+scan_period = int( os.environ.get( 'SDFS_SCAN_PERIOD', 24 * 3600 ) )
+
+# Bytes of memory for blocks read more than once, 0 turns the cache off
+block_cache_bytes = int( os.environ.get( 'SDFS_BLOCK_CACHE_BYTES', 256 * 1024 * 1024 ) )
+
+block_cache = BlockCache( block_cache_bytes )
+
 
 @app.route('/block/<string:file_name>/<string:block_name>', methods =['POST'])
 def write_block( file_name ,block_name ):
@@ -34,6 +65,18 @@ def write_block( file_name ,block_name ):
     /block/notes.txt/33
 
     { "block_body" : "Hello friends", "copy_node": ["dn0","dn1"] }
+
+    A body sent as application/octet-stream is the raw block, it is streamed to disk
+    in chunks and the copy nodes are given as query parameters
+    /block/notes.txt/33?copy_node=dn0&copy_node=dn1
+
+    Each chunk is passed on to the first copy node while it is being written, that node
+    passes it on to the next one, and the answer is sent once the whole pipeline has acked
+    {'message': "...", 'replicas': ['dn2', 'dn0', 'dn1']}
+
+    A block the client compressed comes with the codec in a header, which is kept 
+    with the block and passed down the pipeline
+    X-Block-Codec: zstd
     
     :param name: file_name 
     :param type: str
@@ -58,21 +101,49 @@ def write_block( file_name ,block_name ):
         {'hello'}
     """ 
     try:
-        response = request.data.decode('utf-8') 
-        if response:
-            dn = json.loads( response )
-            block_text = dn['block_body']
-            copy_nodes = dn['copy_node']
-            write_file_locally( block_name  , block_text )
-            for copy in copy_nodes:
-                forward_data( file_name, block_name, copy, block_text)
-            blocks = add_to_block_list( block_name )
+        if request.mimetype == octet_stream:
+            transfer_started()
+            try:
+                return write_block_stream( file_name, block_name )
+            finally:
+                transfer_finished()
+        else:
+            response = request.data.decode('utf-8') 
+            if response:
+                dn = json.loads( response )
+                block_text = dn['block_body']
+                copy_nodes = dn['copy_node']
+                write_file_locally( block_name  , block_text )
+                for copy in copy_nodes:
+                    forward_data( file_name, block_name, copy )
+                add_to_block_list( block_name )
 
     except Exception as a:
         return jsonify({"error": "ERROR: {0}".format( str(a) ) })
     return {'message': "Block text written to {0} and block {1}".format( datanode_id, block_name )}
 
 
+def write_block_stream( file_name, block_name ):
+    """ Writes the raw block of the request and passes it down the pipeline, returns the answer for the client """
+    copy_nodes = request.args.getlist('copy_node')
+    codec = request_codec()
+    forwarder = None
+    if copy_nodes:
+        route = connect_to_host( copy_nodes[0], default_env ) + '/block/' + file_name + '/' + block_name
+        forwarder = PipelineForwarder( route, copy_nodes[1:], copy_nodes[0], get_session( copy_nodes[0], default_env ),
+                                       { codec_header: codec } if codec else None ).start()
+    write_stream_locally( block_name, request.stream, forwarder, request.content_length, codec )
+    add_to_block_list( block_name )
+    replicas = [ datanode_id ]
+    if forwarder:
+        ack = forwarder.finish()
+        if 'error' in ack:
+            return jsonify({"error": "ERROR: Block {0} written to {1} but the pipeline failed at {2}: {3}".format( 
+                block_name, datanode_id, copy_nodes[0], ack['error'] ), 'replicas': replicas + ack.get('replicas', []) })
+        replicas += ack['replicas']
+    return {'message': "Block {0} written to {1}".format( block_name, replicas ), 'replicas': replicas }
+
+
 @app.route("/block/<string:block_name>/", methods=["DELETE"])
 def delete_block(block_name):
     """ 
@@ -86,8 +157,9 @@ def delete_block(block_name):
             Block 1 deleted from dn0, current blocks [2,3]
             Confirms which block was deleted from which datanode
     """
-    file_name = block_name + "_file.txt"
-    if delete_file( file_name ):
+    deleted = storage.delete( block_name )
+    block_cache.invalidate( block_name )
+    if deleted:
         blocks_l = remove_from_block_list( block_name )
     else:
         return jsonify({"error": "ERROR: File does not exist." }) 
@@ -115,9 +187,12 @@ def copy_block_data():
             vals = json.loads( response )
             copy_node = vals['copy_node']
             block_id = vals['block_name']
-            file_name = block_id + "_file.txt"
-            file_content = open( file_name,'rb').read()
-            forward_data( file_name, block_id, copy_node, file_content)
+            file_name = "blk_" + block_id
+            # a corrupt replica is reported instead of being copied
+            if scanner.check_block( block_id ):
+                report_bad_blocks( [ int( block_id ) ] )
+                return jsonify({"error": "ERROR: Block {0} on {1} is corrupt.".format( block_id, datanode_id ) })
+            forward_data( file_name, block_id, copy_node )
         else:
             return jsonify({"error": "ERROR: No response received." })
     except Exception as a:
@@ -125,6 +200,61 @@ def copy_block_data():
     return {'message': "Block data {0} forwarded to {1}".format( file_name, copy_node )}
 
 
+@app.route("/rebuild_block/", methods=["POST"])
+def rebuild_block():
+    """
+    The checker asks this datanode to rebuild a lost block of an erasure coded file. The
+    datanode reads k other blocks of its group from their datanodes, decodes the lost one
+    from them and keeps it, the next block report tells the namenode.
+    { "block_name": "40", "policy": "RS-6-3-1024k", "size": 75497472, "group": [["36", ["dn0"]], ["37", ["dn3"]], ...] }
+
+    :param name: size
+    :param type: int
+        The bytes of the file in the group
+
+    :param name: group
+    :param type: list
+        Every block of the group in order with the datanodes that have it
+
+    :returns: dict
+        {'message': "Block 40 rebuilt on dn2 from blocks ['36', '37', '38', '39', '41', '42']"}
+    """
+    try:
+        vals = json.loads( request.data.decode('utf-8') )
+        block_name = str( int( vals['block_name'] ) )
+        policy = ErasurePolicy( vals['policy'] )
+        size = int( vals['size'] )
+        group = [ ( str( b ), dns ) for b, dns in vals['group'] ]
+        index = [ b for b, _ in group ].index( block_name )
+        transfer_started()
+        try:
+            found = gather_blocks( policy, policy.block_lengths( size ), lambda i: fetch_group_block( *group[i] ), skip=[ index ] )
+            storage.write( block_name, policy.decode( found, size )[index] )
+        finally:
+            transfer_finished()
+        block_cache.invalidate( block_name )
+        add_to_block_list( block_name )
+    except Exception as a:
+        return jsonify({"error": "ERROR: {0}".format( str(a) ) })
+    return {'message': "Block {0} rebuilt on {1} from blocks {2}".format( block_name, datanode_id, [ group[i][0] for i in sorted( found ) ] )}
+
+
+def fetch_group_block( block_name, dns ):
+    """ The raw bytes of another block of the group from one of its datanodes, checked against its checksums """
+    for dn in dns:
+        try:
+            response = get_session( dn, default_env ).get( connect_to_host( dn, default_env ) + '/block/' + block_name + '/raw' )
+            if response.status_code != 200:
+                raise IOError( "Datanode {0} could not send block {1}".format( dn, block_name ) )
+            crcs = response.headers.get('X-Checksums')
+            if crcs and bad_chunks( response.content, 0, parse_crcs( crcs ), int( response.headers['X-Checksum-Chunk'] ) ):
+                raise IOError( "Block {0} from {1} failed its checksums".format( block_name, dn ) )
+            return response.content
+        except Exception as a:
+            print( a )
+    raise IOError( "No datanode could send block {0}".format( block_name ) )
+
+
 @app.route('/forward_block/<string:file_name>/<string:block_name>', methods =['POST'])
 def get_from_dn( file_name , block_name ):
     """
@@ -142,18 +272,26 @@ def get_from_dn( file_name , block_name ):
     # Pay load
     :param name: block_body 
     :param type: str
-        The text of the block
+        The text of the block, or the raw block sent as application/octet-stream
 
     :returns:
         Block text "hello friend" written to blocks [4]
     """ 
     try:
-        response = request.data.decode('utf-8') 
-        if response:
-            dn = json.loads( response )
-            block_text = dn['block_body']
-            write_file_locally( block_name  , block_text )
+        if request.mimetype == octet_stream:
+            transfer_started()
+            try:
+                write_stream_locally( block_name, request.stream, size_hint=request.content_length, codec=request_codec() )
+            finally:
+                transfer_finished()
             add_to_block_list( block_name )
+        else:
+            response = request.data.decode('utf-8') 
+            if response:
+                dn = json.loads( response )
+                block_text = dn['block_body']
+                write_file_locally( block_name  , block_text )
+                add_to_block_list( block_name )
     except Exception as a:
         return jsonify({"error": str(a) })
     return {'message': "Block text written to dn {0} and block {1}".format( datanode_id, block_name )}
@@ -171,62 +309,236 @@ def read_block(block_name):
 
     :returns: dict
         {Block body: "hello friend" }
+        or the raw bytes of the block when the request accepts application/octet-stream
 
     """
+    if request.accept_mimetypes.best == octet_stream:
+        return read_block_raw( block_name )
     try:
-        file_name = block_name + "_file.txt"
-        file_content = open(file_name,'rb').read()
+        file_content = decompress_block( storage.read( block_name ), storage.codec( block_name ) )
     except Exception as a:
         return jsonify({"error":str(a)})
-    return {'block_body':file_content}
+    return {'block_body':file_content.decode('utf-8', 'replace')}
 
 
-def delete_file( file_name ):
-    """ Delete a file locally, if it exists return True else False """
-    if os.path.exists(file_name):
-        protected = ["namenode.py", "datanode.py", "heartbeat_report.py"]
-        if file_name not in protected:
-            os.remove(file_name)
-        return True
+@app.route('/block/<string:block_name>/raw', methods=['GET'])
+def read_block_raw(block_name):
+    """
+    Data node is asked for the raw bytes of a block, or of part of it
+    /block/33/raw
+    /block/33/raw?offset=4096&length=4096
+    or with a header  Range: bytes=4096-8191
+
+    The bytes are sent straight from the block file through the server's file 
+    wrapper, so servers that support it use sendfile and nothing is copied here.
+    A whole block read again soon after is kept in the block cache and sent from 
+    memory, a range is always sent from disk and never loads the block into the cache.
+
+    A compressed block is sent as it is stored with its codec in a header, always 
+    whole since a range of the compressed bytes is of no use to the reader
+    X-Block-Codec: zstd
+
+    The CRCs of the chunks the bytes fall in are sent in headers so the reader
+    can check them, a reader that asks for whole chunks can check everything it got
+    X-Checksum-Chunk: 65536  X-Checksum-First: 0  X-Checksums: a1b2c3d4,0f0e0d0c
+
+    :returns: bytes
+        200 with the whole block, 206 with the requested range, 
+        404 if the block is not here and 416 if the range is outside the block
+    """
+    ranged = 'offset' in request.args or 'length' in request.args or request.range is not None
+    cached = None if ranged else cached_block( block_name )
+    try:
+        size = len( cached[0] ) if cached else storage.size( block_name )
+    except (FileNotFoundError, ValueError):
+        return jsonify({"error": "ERROR: Block {0} not found on {1}".format( block_name, datanode_id )}), 404
+    codec = cached[2] if cached else storage.codec( block_name )
+
+    start, length, partial = 0, size, False
+    if codec:
+        # the whole compressed block is sent whatever range was asked for
+        pass
+    elif 'offset' in request.args or 'length' in request.args:
+        start = int( request.args.get('offset', 0) )
+        length = int( request.args.get('length', size - start) )
+        partial = True
+    elif request.range:
+        block_range = request.range.range_for_length( size )
+        if block_range is None:
+            start, length = size, -1
+        else:
+            start, length = block_range[0], block_range[1] - block_range[0]
+        partial = True
+    if start < 0 or length < 0 or start > size:
+        response = jsonify({"error": "ERROR: Range is outside block {0} of {1} bytes".format( block_name, size )})
+        response.status_code = 416
+        response.headers['Content-Range'] = "bytes */{0}".format( size )
+        return response
+    length = min( length, size - start )
+
+    if cached:
+        body = [ cached[0] ]
+        block_cache.served( length )
     else:
-        return False
+        body = wrap_file( request.environ, BlockRange( storage.open_block( block_name ), start, length ), chunk_size )
+    response = Response( body, status=206 if partial else 200, mimetype=octet_stream, direct_passthrough=True )
+    transfer_started()
+    response.call_on_close( transfer_finished )
+    response.content_length = length
+    response.headers['Accept-Ranges'] = 'none' if codec else 'bytes'
+    if codec:
+        response.headers[codec_header] = codec
+    if partial and length > 0:
+        response.headers['Content-Range'] = "bytes {0}-{1}/{2}".format( start, start + length - 1, size )
+    sums = cached[1] if cached else storage.checksums( block_name )
+    if sums:
+        chunk, crcs = sums
+        first, last = start // chunk, ( start + length - 1 ) // chunk
+        response.headers['X-Checksum-Chunk'] = str( chunk )
+        response.headers['X-Checksum-First'] = str( first )
+        response.headers['X-Checksums'] = format_crcs( crcs[ first:last + 1 ] )
+    return response
+
+
+def cached_block( block_name ):
+    """
+    The block from the block cache, loaded into it when it was read recently
+
+    :returns: tuple
+        ( bytes, checksums, codec ), None if the block is not cached and is read from disk
+    """
+    try:
+        cached, admit = block_cache.lookup( block_name )
+    except ValueError:
+        return None
+    if cached or not admit:
+        return cached
+    version = block_cache.version( block_name )
+    try:
+        if not block_cache.fits( storage.size( block_name ) ):
+            return None
+        data, sums, codec = storage.read( block_name ), storage.checksums( block_name ), storage.codec( block_name )
+    except (FileNotFoundError, ValueError):
+        return None
+    # a corrupt block is left on disk for the reader and the scanner to find
+    if sums and bad_chunks( data, 0, sums[1], sums[0] ):
+        return None
+    block_cache.put( block_name, data, sums, version, codec )
+    return data, sums, codec
+
+
+@app.route('/block/<string:block_name>/verify', methods=['POST'])
+def verify_block(block_name):
+    """
+    A reader found a block from this datanode did not match its checksums. The
+    datanode checks its copy itself and reports it to the namenode if it is corrupt.
+    /block/33/verify
+
+    :returns: dict
+        {'corrupt': True}
+    """
+    try:
+        corrupt = scanner.check_block( block_name )
+        if corrupt:
+            report_bad_blocks( [ int( block_name ) ] )
+    except Exception as a:
+        return jsonify({"error": "ERROR: {0}".format( str(a) ) })
+    return {'corrupt': corrupt}
+
+
+class BlockRange:
+    """ 
+    File-like window of an open block file. read() stops at the end of the range and
+    fileno() lets the server sendfile it, starting at the current position for Content-Length bytes.
+    """
+    def __init__(self, block_file, start, length):
+        self.block_file = block_file
+        self.block_file.seek( start )
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.block_file.read( size )
+        self.remaining -= len( data )
+        return data
+
+    def fileno(self):
+        return self.block_file.fileno()
+
+    def close(self):
+        self.block_file.close()
+
 
 def add_to_block_list(block_name):
-    blocks_l = get_from_memory('block_data')
-    if not blocks_l:
-        blocks_l = []
+    """ Adds the block to the block list, a redis set so blocks written at the same time never drop each other """
     if isinstance(block_name, str):
         block_name = block_name.replace('b','').replace('_', '')
-    if int(block_name) not in blocks_l:
-        blocks_l.append(int(block_name))
-    add_to_memory( blocks_l, 'block_data')
-    return blocks_l
+    r_cache.sadd( 'block_data', int(block_name) )
+    block_delta.added( int(block_name) )
 
 
 def remove_from_block_list(block_name):
-    blocks_l = get_from_memory('block_data')
     if isinstance(block_name, str):
         block_name = block_name.replace('b','').replace('_', '')
     block_id = int( block_name )
-    if block_id in blocks_l:
-        blocks_l.remove( block_id )
-    add_to_memory( blocks_l, 'block_data')
-    return blocks_l
+    r_cache.srem( 'block_data', block_id )
+    block_delta.removed( block_id )
+    return block_list()
+
+
+def block_list():
+    """ The ids of the blocks on this datanode """
+    return sorted( int( b ) for b in r_cache.smembers( 'block_data' ) )
 
 
 @app.route('/variables/', methods =['GET'])
 def endpoint_variables():
     try:
-        blocks = get_from_memory('block_data')
+        blocks = block_list()
     except:
         blocks = []
-    return { 'blocks': blocks }
+    return { 'blocks': blocks, 'last_scan': scanner.last_pass, 'block_cache': block_cache.stats() }
 
 
-def forward_data( file_name, block_id, copy_node, block_body):
-    """ Forward data to the copy node""" 
+def report_bad_blocks( block_ids ):
+    """ 
+    Tells the namenode which blocks here are corrupt. The namenode answers with the ones 
+    that have a good replica elsewhere, those are deleted so the checker copies a good one back.
+    """
+    answer = {'delete': []}
+    # each block goes to the namenode of its block pool
+    for namenode in namenodes():
+        owned = [ b for b in block_ids if namenode_for_block( b ) == namenode ]
+        if not owned:
+            continue
+        route = connect_to_host( namenode, default_env ) + '/bad_block/'
+        deleted = get_session( namenode, default_env ).post( route, json={'id': datanode_id, 'blocks': owned} ).json().get( 'delete', [] )
+        for block_id in deleted:
+            storage.delete( block_id )
+            block_cache.invalidate( block_id )
+            remove_from_block_list( str( block_id ) )
+        answer['delete'] += deleted
+    return answer
+
+
+# Checks the blocks in the background and reports the corrupt ones to the namenode
+scanner = BlockScanner( storage, report_bad_blocks, scan_rate, scan_period )
+
+
+def forward_data( file_name, block_id, copy_node ):
+    """ Forward the block on disk to the copy node as raw bytes, a compressed block stays compressed """ 
     route = connect_to_host( copy_node, default_env ) + '/forward_block/'
-    print( r.post(route + file_name + "/" + block_id, json={'block_body': block_body}).json() )
+    headers = {'Content-Type': octet_stream}
+    codec = storage.codec( block_id )
+    if codec:
+        headers[codec_header] = codec
+    with storage.open_block( block_id ) as block:
+        response = get_session( copy_node, default_env ).post(route + file_name + "/" + block_id, data=block, headers=headers)
+    answer = response.json()
+    print( answer )
+    if 'error' in answer:
+        raise IOError( "{0} could not write block {1}: {2}".format( copy_node, block_id, answer['error'] ) )
 
 
 @app.route('/', methods =['GET'])
@@ -235,20 +547,65 @@ def endpoint():
 
 
 
+def transfer_started():
+    """ Counts the blocks being sent or received, the heartbeat reports them so busy nodes get fewer new blocks """
+    r_cache.incr( 'active_transfers' )
+
+
+def transfer_finished():
+    r_cache.decr( 'active_transfers' )
+
+
+def request_codec():
+    """ The codec of the block in the request, None if it is not compressed """
+    codec = request.headers.get( codec_header )
+    if codec and codec not in codec_names:
+        raise ValueError( "Unknown codec {0}".format( codec ) )
+    return codec or None
+
+
 def write_file_locally( block_name, block_text):
     """
     Used to write a block_text locally on this node
     """
-    new_file_name = block_name + "_file.txt"
     text = str(block_text)
-    f = open( new_file_name,"w")
-    f.write(text)
-    f.close()
+    storage.write( block_name, text.encode('utf-8') )
+    block_cache.invalidate( block_name )
+
+
+def write_stream_locally( block_name, stream, forwarder=None, size_hint=None, codec=None ):
+    """
+    Used to write raw block bytes from a stream locally on this node, one chunk 
+    at a time so the whole block is never held in memory. Each chunk is handed 
+    to the forwarder of the write pipeline before it is written. The block only
+    appears in storage once all of it is written. codec is the one the client
+    compressed the bytes with, they are stored as they are.
+    """
+    writer = storage.open_writer( block_name, size_hint, codec )
+    try:
+        while True:
+            chunk = stream.read( chunk_size )
+            if not chunk:
+                break
+            if forwarder:
+                forwarder.send( chunk )
+            writer.write( chunk )
+    except Exception:
+        writer.abort()
+        if forwarder:
+            forwarder.abort()
+        raise
+    committed = writer.commit()
+    block_cache.invalidate( block_name )
+    return committed
 
  
 # Redis is an In-Memory but Persistent on Disk DB
 r_cache = redis.Redis( host=redis_host_dn, port=6379)
 
+# Blocks added and removed since the last block report
+block_delta = BlockDelta( r_cache )
+
 
 def add_to_memory( obj, var_name ):
     values = json.dumps( obj )
@@ -264,5 +621,13 @@ def get_from_memory( var_name ):
 if __name__ == '__main__':
     # Save the data node id to share with the heartbeat_datanode.py
     add_to_memory( datanode_id , 'datanode_id')
-    add_to_memory( blocks, 'block_data')
-    app.run(host='0.0.0.0',port=5000,debug=True)
\ No newline at end of file
+    # The block list starts with the blocks already in storage
+    r_cache.delete( 'block_data' )
+    for block_id in storage.iter_blocks():
+        r_cache.sadd( 'block_data', block_id )
+    # the first report after a start up is a full one
+    block_delta.reset()
+    r_cache.set( 'active_transfers', 0 )
+    scanner.start()
+    # no debug reloader, it runs this block a second time and so a second scanner
+    app.run(host='0.0.0.0',port=5000,threaded=True)
\ No newline at end of file
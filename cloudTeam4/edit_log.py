@@ -0,0 +1,522 @@
+import os, json, threading, time
+from block_storage import write_all, sync_directory
+from metadata_store import path_sep, split_path
+
+"""
+Write ahead edit log and namespace images for the namenode. Every change to
+the namespace is appended to the log with the next transaction id before the
+client is answered. Edits are JSON lines in segment files, one flusher thread
+writes and syncs everything appended while the previous sync ran, so many
+requests share one fdatasync.
+
+Now and then the log is rolled and the closed segments are merged with the
+last image into a new image, a compact snapshot of the namespace as of one
+transaction id. A restart loads the newest image and replays the edits after
+it, old images and segments are deleted once a newer image covers them.
+
+Files in the meta directory
+    edits_<first txid>.log     edit segment, one json record per line
+    fsimage_<txid>.img         image, a header line then one line per directory and file
+
+Edit records
+    {"txid": 7, "op": "mkdir", "path": "test\\data"}
+    {"txid": 8, "op": "rmdir", "path": "test\\data"}
+    {"txid": 9, "op": "create", "directory": "test", "name": "a.txt", "blocks": [[1, ["dn0", "dn1"]], [2, ["dn1"]]]}
+    {"txid": 10, "op": "delete", "directory": "test", "name": "a.txt"}
+    {"txid": 11, "op": "setpolicy", "path": "test\\cold", "policy": "RS-6-3-1024k"}
+
+An erasure coded file is created with its striping, "striping": {"policy": "RS-6-3-1024k", "size": 1200}
+
+A namenode served by several worker processes has one edit log, written by
+the leader worker, see coordination.py. The workers append their edits to a
+redis list, in txid order since they hold the namespace lock, and wait until
+the leader published that it synced them. The first edit in the list is the
+one after edits_synced, the leader moves the list to its log a batch at a time,
+so the edits of every worker share one fdatasync, and only takes an edit off
+the list once it is synced so a new leader writes it if the old one died first.
+
+Redis keys of the shared log, under the prefix of the namespace
+    txid                    transaction id of the last edit, incremented with the push of the edit
+    edits                   list < json edit records without their txid, not yet synced by the leader >
+    edits_wake              list the leader waits on for new edits
+    edits_synced            txid of the last edit the leader synced, also published on the channel of that name
+    edits_recovered         set by a leader once it recovered the namespace, cleared when the namenode starts
+"""
+
+# Image of the namespace written after this many edits, or after checkpoint_interval seconds with any edit
+checkpoint_edits = 100000
+checkpoint_interval = 3600
+
+# Seconds between checks of the checkpointer
+checkpoint_check = 10
+
+# Images kept, the edits after the oldest of them are kept too
+images_kept = 2
+
+# Edits of the shared log the leader moves to the log at once
+shared_batch = 1000
+
+# Seconds a worker waits for the leader to sync its edit before it gives up, and between checks
+shared_sync_timeout = 30
+shared_sync_check = 1.0
+
+segment_prefix = 'edits_'
+segment_suffix = '.log'
+image_prefix = 'fsimage_'
+image_suffix = '.img'
+
+
+class EditLog:
+    """ Appends namespace edits with group commit and checkpoints them into images """
+
+    def __init__(self, directory, checkpoint_edits=checkpoint_edits, checkpoint_interval=checkpoint_interval):
+        self.directory = os.path.abspath( directory )
+        self.checkpoint_edits = checkpoint_edits
+        self.checkpoint_interval = checkpoint_interval
+        os.makedirs( self.directory, exist_ok=True )
+        images = self.images()
+        self.image_txid = images[-1][0] if images else 0
+        self.last_txid = max( self.image_txid, self._repair_last_segment() )
+        self.synced_txid = self.last_txid
+        self.last_checkpoint = time.monotonic()
+        # ( txid, line ) appended and not written yet
+        self.buffer = []
+        self.flushing = False
+        self.error = None
+        self.fd = None
+        self.cond = threading.Condition()
+        self.checkpoint_lock = threading.Lock()
+
+    def start(self):
+        """ Starts the flusher and the checkpointer """
+        threading.Thread( target=self._flush, daemon=True ).start()
+        threading.Thread( target=self._checkpoints, daemon=True ).start()
+        return self
+
+    def is_empty(self):
+        """ True if nothing was ever logged nor imaged """
+        return self.last_txid == 0 and not self.images()
+
+    # Appending
+
+    def append(self, op, **args):
+        """
+        Adds an edit, it is durable once sync returns for its txid
+
+        :returns: int
+            The transaction id of the edit
+        """
+        with self.cond:
+            if self.error:
+                raise IOError( "The edit log could not be written: {0}".format( self.error ) )
+            self.last_txid += 1
+            record = dict( txid=self.last_txid, op=op, **args )
+            self.buffer.append( ( self.last_txid, json.dumps( record ) + '\n' ) )
+            self.cond.notify_all()
+            return self.last_txid
+
+    def sync(self, txid):
+        """ Waits until the edit and every edit before it are on disk """
+        with self.cond:
+            while self.synced_txid < txid:
+                if self.error:
+                    raise IOError( "The edit log could not be written: {0}".format( self.error ) )
+                self.cond.wait()
+
+    def _flush(self):
+        while True:
+            with self.cond:
+                while not self.buffer:
+                    self.cond.wait()
+                group, self.buffer = self.buffer, []
+                self.flushing = True
+            try:
+                if self.fd is None:
+                    # a segment is named after its first edit
+                    self.fd = os.open( self.segment_path( group[0][0] ), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644 )
+                    sync_directory( self.directory )
+                write_all( self.fd, ''.join( line for _, line in group ).encode('utf-8') )
+                if hasattr( os, 'fdatasync' ):
+                    os.fdatasync( self.fd )
+                else:
+                    os.fsync( self.fd )
+            except OSError as a:
+                print( "Edit log ERROR: {0}".format( a ))
+                with self.cond:
+                    self.error = a
+            with self.cond:
+                self.flushing = False
+                if not self.error:
+                    self.synced_txid = group[-1][0]
+                self.cond.notify_all()
+
+    def roll(self):
+        """ Closes the segment being written once everything in it is synced, the next edit starts a new one """
+        with self.cond:
+            while self.buffer or self.flushing:
+                self.cond.wait()
+            if self.fd is not None:
+                os.close( self.fd )
+                self.fd = None
+            return self.last_txid
+
+    # Reading
+
+    def segments(self):
+        """ Returns [ ( first txid, path ) ] oldest first """
+        return _listing( self.directory, segment_prefix, segment_suffix )
+
+    def images(self):
+        """ Returns [ ( txid, path ) ] oldest first """
+        return _listing( self.directory, image_prefix, image_suffix )
+
+    def segment_path(self, first_txid):
+        return os.path.join( self.directory, '{0}{1:020d}{2}'.format( segment_prefix, first_txid, segment_suffix ) )
+
+    def first_txid(self):
+        """ The oldest edit still in the log, None if there is no segment """
+        segments = self.segments()
+        return segments[0][0] if segments else None
+
+    def read_edits(self, after_txid, upto_txid=None):
+        """ Yields the records after after_txid up to upto_txid in order, raises IOError on a gap """
+        expected = after_txid + 1
+        segments = self.segments()
+        for i, ( first, path ) in enumerate( segments ):
+            # a segment ends right before the next one starts
+            if i + 1 < len( segments ) and segments[i + 1][0] <= expected:
+                continue
+            if upto_txid is not None and first > upto_txid:
+                break
+            for record in _read_segment( path ):
+                if record['txid'] < expected:
+                    continue
+                if upto_txid is not None and record['txid'] > upto_txid:
+                    return
+                if record['txid'] != expected:
+                    raise IOError( "The edit log has no edit {0}, the next is {1}".format( expected, record['txid'] ) )
+                yield record
+                expected += 1
+        if upto_txid is not None and expected <= upto_txid:
+            raise IOError( "The edit log ends at {0}, before {1}".format( expected - 1, upto_txid ) )
+
+    def _repair_last_segment(self):
+        """ Cuts a half written last line off the newest segment and returns the txid of its last edit """
+        segments = self.segments()
+        if not segments:
+            return 0
+        path = segments[-1][1]
+        last_txid, good_bytes = segments[-1][0] - 1, 0
+        with open( path, 'rb' ) as f:
+            for line in f:
+                try:
+                    record = json.loads( line.decode('utf-8') )
+                except ValueError:
+                    break
+                if not line.endswith( b'\n' ):
+                    break
+                last_txid, good_bytes = record['txid'], good_bytes + len( line )
+        if good_bytes < os.path.getsize( path ):
+            print( "Edit log: cutting a torn edit off {0} after txid {1}".format( path, last_txid ))
+            with open( path, 'r+b' ) as f:
+                f.truncate( good_bytes )
+                os.fsync( f.fileno() )
+        return last_txid
+
+    # Images
+
+    def load_namespace(self, upto_txid=None):
+        """ The newest image with the edits after it applied """
+        images = self.images()
+        namespace = load_image( images[-1][1] ) if images else Namespace()
+        for record in self.read_edits( namespace.txid, upto_txid ):
+            namespace.apply( record )
+        return namespace
+
+    def write_image(self, namespace):
+        """ Saves the namespace as the image of its txid """
+        path = os.path.join( self.directory, '{0}{1:020d}{2}'.format( image_prefix, namespace.txid, image_suffix ) )
+        temp_path = path + '.tmp'
+        with open( temp_path, 'w', encoding='utf-8' ) as f:
+            f.write( json.dumps( {'txid': namespace.txid, 'last_block_id': namespace.last_block_id,
+                                  'dirs': len( namespace.dirs ), 'files': len( namespace.files )} ) + '\n' )
+            for record in namespace.records():
+                f.write( json.dumps( record ) + '\n' )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.replace( temp_path, path )
+        sync_directory( self.directory )
+        with self.cond:
+            self.image_txid = max( self.image_txid, namespace.txid )
+            self.last_txid = max( self.last_txid, namespace.txid )
+            self.synced_txid = max( self.synced_txid, namespace.txid )
+        return path
+
+    def checkpoint(self):
+        """ Rolls the log and merges the closed segments into a new image, returns its txid """
+        with self.checkpoint_lock:
+            end_txid = self.roll()
+            self.last_checkpoint = time.monotonic()
+            if end_txid <= self.image_txid:
+                return self.image_txid
+            start = time.monotonic()
+            namespace = self.load_namespace( end_txid )
+            self.write_image( namespace )
+            self.purge()
+            print( "Checkpoint at txid {0}: {1} directories, {2} files in {3:.2f} s".format(
+                namespace.txid, len( namespace.dirs ), len( namespace.files ), time.monotonic() - start ))
+            return namespace.txid
+
+    def purge(self):
+        """ Deletes the images older than the images kept and the segments they cover """
+        images = self.images()
+        for _, path in images[:-images_kept]:
+            os.remove( path )
+        oldest_txid = images[-images_kept:][0][0] if images else 0
+        segments = self.segments()
+        for i, ( first, path ) in enumerate( segments[:-1] ):
+            if segments[i + 1][0] - 1 <= oldest_txid:
+                os.remove( path )
+
+    def _checkpoints(self):
+        while True:
+            time.sleep( checkpoint_check )
+            edits = self.last_txid - self.image_txid
+            due = time.monotonic() - self.last_checkpoint >= self.checkpoint_interval
+            if edits >= self.checkpoint_edits or ( edits and due ):
+                try:
+                    self.checkpoint()
+                except Exception as a:
+                    print( "Checkpoint ERROR: {0}".format( a ))
+
+
+class SharedEditLog:
+    """ The edit log of a namenode with many workers, appended to in redis and written by the leader """
+
+    def __init__(self, r_cache, prefix, batch=shared_batch, timeout=shared_sync_timeout):
+        self.r_cache = r_cache
+        self.txid_key = prefix + 'txid'
+        self.edits_key = prefix + 'edits'
+        self.wake_key = prefix + 'edits_wake'
+        self.synced_key = prefix + 'edits_synced'
+        self.recovered_key = prefix + 'edits_recovered'
+        self.batch = batch
+        self.timeout = timeout
+        self.synced_txid = 0
+        self.cond = threading.Condition()
+        # the EditLog, only in the leader
+        self.log = None
+
+    def start(self):
+        """ Follows how far the leader synced the log """
+        threading.Thread( target=self._follow, daemon=True ).start()
+        return self
+
+    def ready(self):
+        """ True once a leader of this start of the namenode recovered the namespace in redis """
+        return self.r_cache.exists( self.recovered_key )
+
+    def reset(self):
+        """ Called before the workers start, they wait for a leader to recover the namespace again """
+        self.r_cache.delete( self.recovered_key )
+
+    # Every worker
+
+    def append(self, op, **args):
+        """ Adds an edit, called with the namespace lock held. Returns its txid, it is durable once sync returns for it """
+        return self.append_all( [ ( op, args ) ] )
+
+    def append_all(self, edits):
+        """ Adds the edits [ ( op, args ) ] in order with one round trip, returns the txid of the last one """
+        # a worker that dies now leaves neither a txid without its edit nor an edit without its txid
+        pipe = self.r_cache.pipeline()
+        pipe.incrby( self.txid_key, len( edits ) )
+        pipe.rpush( self.edits_key, *[ json.dumps( dict( op=op, **args ) ) for op, args in edits ] )
+        pipe.rpush( self.wake_key, 1 )
+        return pipe.execute()[0]
+
+    def sync(self, txid):
+        """ Waits until the leader synced the edit and every edit before it """
+        deadline = time.monotonic() + self.timeout
+        with self.cond:
+            while self.synced_txid < txid:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise IOError( "The edit log could not be written: no leader synced edit {0} in {1} s".format( txid, self.timeout ) )
+                self.cond.wait( min( left, shared_sync_check ) )
+
+    def _synced(self, txid):
+        with self.cond:
+            if txid > self.synced_txid:
+                self.synced_txid = txid
+                self.cond.notify_all()
+
+    def _follow(self):
+        events = self.r_cache.pubsub( ignore_subscribe_messages=True )
+        events.subscribe( self.synced_key )
+        while True:
+            try:
+                message = events.get_message( timeout=shared_sync_check )
+                if message:
+                    self._synced( int( message['data'] ) )
+                else:
+                    # a message lost while redis reconnected is caught up with here
+                    synced = self.r_cache.get( self.synced_key )
+                    self._synced( int( synced ) if synced else 0 )
+            except Exception as a:
+                print( "Edit log follower ERROR: {0}".format( a ))
+                time.sleep( shared_sync_check )
+
+    # The leader
+
+    def lead(self, log):
+        """
+        Makes this worker write the shared log to log, called with the namespace lock held. The
+        edits an old leader did not sync are written first, then log and redis end at the same txid
+        """
+        self.log = log
+        while self.write_queued() == self.batch:
+            pass
+
+    def publish_synced(self):
+        """ Tells every worker the log is synced up to its last edit, after the leader recovered the namespace """
+        pipe = self.r_cache.pipeline( transaction=False )
+        pipe.set( self.synced_key, self.log.last_txid )
+        pipe.set( self.recovered_key, self.log.last_txid )
+        pipe.publish( self.synced_key, self.log.last_txid )
+        pipe.execute()
+        self._synced( self.log.last_txid )
+
+    def start_writer(self):
+        threading.Thread( target=self._write, daemon=True ).start()
+
+    def write_queued(self):
+        """ Moves up to batch queued edits to the log and syncs them, returns how many there were """
+        pipe = self.r_cache.pipeline()
+        # a wake after this is for an edit the next round reads
+        pipe.delete( self.wake_key )
+        pipe.get( self.synced_key )
+        pipe.lrange( self.edits_key, 0, self.batch - 1 )
+        _, synced, records = pipe.execute()
+        if not records:
+            return 0
+        if synced is None or int( synced ) > self.log.last_txid:
+            raise IOError( "The edit log ends at {0} before the shared log, synced to {1}".format( self.log.last_txid, synced ))
+        first_txid = int( synced ) + 1
+        txid = None
+        for i, record in enumerate( records ):
+            # written by a leader that stopped before it took it off the list
+            if first_txid + i <= self.log.last_txid:
+                continue
+            record = json.loads( record )
+            txid = self.log.append( record.pop( 'op' ), **record )
+        if txid is not None:
+            self.log.sync( txid )
+        pipe = self.r_cache.pipeline()
+        pipe.ltrim( self.edits_key, len( records ), -1 )
+        pipe.set( self.synced_key, first_txid + len( records ) - 1 )
+        pipe.publish( self.synced_key, first_txid + len( records ) - 1 )
+        pipe.execute()
+        self._synced( self.log.last_txid )
+        return len( records )
+
+    def _write(self):
+        while True:
+            try:
+                if self.write_queued() < self.batch:
+                    self.r_cache.blpop( self.wake_key, timeout=1 )
+            except Exception as a:
+                print( "Edit log ERROR: {0}".format( a ))
+                time.sleep( shared_sync_check )
+
+
+class Namespace:
+    """ The directories and files as the edits describe them, used for images and restore """
+
+    def __init__(self):
+        self.txid = 0
+        # block ids only grow, deleted files keep theirs from being handed out again
+        self.last_block_id = 0
+        self.dirs = set()
+        # < key: ( directory, file name ), val: list of block ids >
+        self.files = {}
+        # < key: directory, val: erasure coding policy >
+        self.policies = {}
+        # < key: ( directory, file name ), val: {'policy', 'size'} > of the erasure coded files
+        self.striped = {}
+
+    def apply(self, record):
+        op = record['op']
+        if op == 'mkdir':
+            names = split_path( record['path'] )
+            for i in range( len( names ) ):
+                self.dirs.add( path_sep.join( names[:i + 1] ) )
+        elif op == 'rmdir':
+            self.dirs.discard( normalize( record['path'] ) )
+            self.policies.pop( normalize( record['path'] ), None )
+        elif op == 'create':
+            blocks = [ int( b ) for b, _ in record['blocks'] ]
+            key = ( normalize( record['directory'] ), record['name'] )
+            self.files[key] = blocks
+            if record.get( 'striping' ):
+                self.striped[key] = record['striping']
+            self.last_block_id = max( [ self.last_block_id ] + blocks )
+        elif op == 'delete':
+            key = ( normalize( record['directory'] ), record['name'] )
+            self.files.pop( key, None )
+            self.striped.pop( key, None )
+        elif op == 'setpolicy':
+            if record['policy']:
+                self.policies[ normalize( record['path'] ) ] = record['policy']
+            else:
+                self.policies.pop( normalize( record['path'] ), None )
+        else:
+            raise ValueError( "Unknown edit {0}".format( op ) )
+        self.txid = record['txid']
+
+    def records(self):
+        """ Directories parents first, then files """
+        for path in sorted( self.dirs, key=lambda p: ( p.count( path_sep ), p ) ):
+            yield dict( {'d': path}, **( {'policy': self.policies[path]} if path in self.policies else {} ) )
+        for key, blocks in self.files.items():
+            yield dict( {'f': [ key[0], key[1], blocks ]}, **( {'striping': self.striped[key]} if key in self.striped else {} ) )
+
+
+def load_image( path ):
+    namespace = Namespace()
+    with open( path, encoding='utf-8' ) as f:
+        header = json.loads( f.readline() )
+        namespace.txid, namespace.last_block_id = header['txid'], header['last_block_id']
+        for line in f:
+            record = json.loads( line )
+            if 'd' in record:
+                namespace.dirs.add( record['d'] )
+                if 'policy' in record:
+                    namespace.policies[ record['d'] ] = record['policy']
+            else:
+                directory, name, blocks = record['f']
+                namespace.files[ ( directory, name ) ] = blocks
+                if 'striping' in record:
+                    namespace.striped[ ( directory, name ) ] = record['striping']
+    return namespace
+
+
+def normalize( path ):
+    """ test\\data\\ and \\test\\data are both test\\data """
+    return path_sep.join( split_path( path ) )
+
+
+def _read_segment( path ):
+    with open( path, encoding='utf-8' ) as f:
+        for line in f:
+            if not line.endswith( '\n' ):
+                break
+            yield json.loads( line )
+
+
+def _listing( directory, prefix, suffix ):
+    found = []
+    for name in os.listdir( directory ):
+        if name.startswith( prefix ) and name.endswith( suffix ) and name[len( prefix ):-len( suffix )].isdigit():
+            found.append( ( int( name[len( prefix ):-len( suffix )] ), os.path.join( directory, name ) ) )
+    return sorted( found )
@@ -0,0 +1,289 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+"""
+Reed-Solomon erasure coding of files, an alternative to keeping replica_count
+copies of every block. A policy RS-<k>-<m>-<cell>k cuts the file into block
+groups of k data blocks, computes m parity blocks for each group and puts the
+k + m blocks on k + m distinct datanodes with one replica each. Any k blocks of
+a group are enough to rebuild the others, so RS-6-3 survives three lost
+datanodes at a storage overhead of 50% instead of 200%.
+
+Inside a group the file is striped: cell i of the group goes to data block
+i % k, so a stripe is k cells side by side, one per data block, and the parity
+cells of a stripe are computed from those k cells. Data blocks are cut off
+after their last byte of the file, parity blocks are as long as the first data
+block and the missing tail of a shorter data block counts as zeros.
+
+Arithmetic is in GF(2^8) with numpy on 8 bytes at a time. A block is doubled
+in the field with shifts and masks of uint64 words, and multiplying it by a
+constant XORs together the doublings for the bits set in the constant, so
+each doubling of a data block serves every parity block. The parity rows
+of the generator are a Cauchy matrix, so every k x k submatrix of the whole
+generator is invertible and any k surviving blocks decode.
+"""
+
+# Reducing polynomial of GF(2^8), x^8 + x^4 + x^3 + x^2 + 1
+field_polynomial = 0x11d
+
+# Cell size of a policy that does not name one
+default_cell = 1024 * 1024
+
+# Words of 8 bytes multiplied at a time, small enough to stay in the CPU cache
+multiply_words = 16 * 1024
+
+# Policy name of a directory whose files are replicated even if a parent is erasure coded
+replicated = 'replicated'
+
+
+def _tables():
+    exp = np.zeros( 512, dtype=np.int32 )
+    log = np.zeros( 256, dtype=np.int32 )
+    x = 1
+    for i in range( 255 ):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= field_polynomial
+    exp[255:510] = exp[:255]
+    # products of every pair of bytes, a zero factor gives zero
+    products = exp[ log[:, None] + log[None, :] ].astype( np.uint8 )
+    products[0, :] = 0
+    products[:, 0] = 0
+    return exp, log, products
+
+
+gf_exp, gf_log, gf_mul = _tables()
+
+
+def gf_inverse( a ):
+    if a == 0:
+        raise ZeroDivisionError( "0 has no inverse in GF(2^8)" )
+    return int( gf_exp[ 255 - gf_log[a] ] )
+
+
+def invert_matrix( matrix ):
+    """ Inverts a square matrix over GF(2^8) by Gauss-Jordan elimination, raises ValueError if it is singular """
+    n = len( matrix )
+    rows = [ [ int( v ) for v in row ] + [ 1 if i == j else 0 for j in range( n ) ] for i, row in enumerate( matrix ) ]
+    for col in range( n ):
+        pivot = next( ( r for r in range( col, n ) if rows[r][col] ), None )
+        if pivot is None:
+            raise ValueError( "The matrix is singular" )
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inverse( rows[col][col] )
+        rows[col] = [ int( gf_mul[scale, v] ) for v in rows[col] ]
+        for r in range( n ):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [ v ^ int( gf_mul[factor, p] ) for v, p in zip( rows[r], rows[col] ) ]
+    return np.array( [ row[n:] for row in rows ], dtype=np.uint8 )
+
+
+_low_bits = np.uint64( 0x7f7f7f7f7f7f7f7f )
+_byte_ones = np.uint64( 0x0101010101010101 )
+_reduction = np.uint64( field_polynomial & 0xff )
+
+
+def _double( words ):
+    """ Every byte of the uint64 words times 2 in GF(2^8) """
+    carry = ( words >> np.uint64( 7 ) ) & _byte_ones
+    return ( ( words & _low_bits ) << np.uint64( 1 ) ) ^ ( carry * _reduction )
+
+
+def multiply( matrix, cells ):
+    """ matrix ( r x n ) times cells ( n x length uint8 ) over GF(2^8), returns r x length uint8 """
+    length = cells.shape[1]
+    padded = -( -length // 8 ) * 8
+    if padded != length:
+        cells = np.hstack( [ cells, np.zeros( ( cells.shape[0], padded - length ), dtype=np.uint8 ) ] )
+    words = np.ascontiguousarray( cells ).view( np.uint64 )
+    out = np.zeros( ( len( matrix ), words.shape[1] ), dtype=np.uint64 )
+    # doublings of a column are only needed up to the highest bit of its coefficients
+    bits = [ int( max( matrix[:, j] ) ).bit_length() for j in range( words.shape[0] ) ]
+    for start in range( 0, words.shape[1], multiply_words ):
+        end = start + multiply_words
+        for j in range( words.shape[0] ):
+            power = words[j, start:end]
+            for bit in range( bits[j] ):
+                if bit:
+                    power = _double( power )
+                for i in range( len( matrix ) ):
+                    if ( int( matrix[i, j] ) >> bit ) & 1:
+                        out[i, start:end] ^= power
+    return out.view( np.uint8 )[:, :length]
+
+
+class ErasurePolicy:
+    """ A Reed-Solomon policy like RS-6-3-1024k, k data blocks and m parity blocks per group striped in cells """
+
+    def __init__(self, name):
+        parts = name.split( '-' )
+        try:
+            if parts[0] != 'RS' or len( parts ) not in ( 3, 4 ):
+                raise ValueError
+            self.k, self.m = int( parts[1] ), int( parts[2] )
+            self.cell = int( parts[3][:-1] ) * 1024 if len( parts ) == 4 and parts[3].endswith( 'k' ) else default_cell
+            if len( parts ) == 4 and not parts[3].endswith( 'k' ):
+                raise ValueError
+        except ValueError:
+            raise ValueError( "Unknown erasure coding policy {0}, use RS-<data>-<parity> or RS-<data>-<parity>-<cell>k".format( name ) )
+        if self.k < 1 or self.m < 1 or self.k + self.m > 255 or self.cell <= 0:
+            raise ValueError( "Erasure coding policy {0} needs 1 or more data and parity blocks, 255 at most".format( name ) )
+        self.name = 'RS-{0}-{1}-{2}k'.format( self.k, self.m, self.cell // 1024 )
+        self.width = self.k + self.m
+        # identity rows for the data blocks, then a Cauchy matrix 1 / ( x_i + y_j ) for the parity blocks
+        parity = [ [ gf_inverse( ( self.k + i ) ^ j ) for j in range( self.k ) ] for i in range( self.m ) ]
+        self.generator = np.vstack( [ np.eye( self.k, dtype=np.uint8 ), np.array( parity, dtype=np.uint8 ) ] )
+
+    def group_bytes(self, block_size):
+        """ Bytes of the file in one block group, every data block holds whole cells up to block_size """
+        return self.k * max( block_size - block_size % self.cell, self.cell )
+
+    def block_lengths(self, size):
+        """ Length of each of the k + m blocks of a group that holds size bytes of the file """
+        stripes, rest = divmod( size, self.k * self.cell )
+        data = [ stripes * self.cell + min( max( rest - i * self.cell, 0 ), self.cell ) for i in range( self.k ) ]
+        return data + [ data[0] ] * self.m
+
+    def _columns(self, size):
+        """ Columns of a block once the last stripe is padded to whole cells """
+        return -( -size // ( self.k * self.cell ) ) * self.cell
+
+    def encode(self, data):
+        """ Returns the k data blocks and m parity blocks of a group as bytes """
+        size = len( data )
+        columns = self._columns( size )
+        padded = np.zeros( self.k * columns, dtype=np.uint8 )
+        padded[:size] = np.frombuffer( data, dtype=np.uint8 )
+        # cell i of the group goes to data block i % k
+        cells = padded.reshape( -1, self.k, self.cell ).transpose( 1, 0, 2 ).reshape( self.k, columns )
+        parity = multiply( self.generator[self.k:], cells )
+        lengths = self.block_lengths( size )
+        return [ cells[i, :lengths[i]].tobytes() for i in range( self.k ) ] + \
+               [ parity[i, :lengths[self.k + i]].tobytes() for i in range( self.m ) ]
+
+    def decode(self, blocks, size):
+        """
+        Rebuilds every block of a group from any k of them
+
+        :param name: blocks
+        :param type: dict
+            < key: index of the block in the group, val: its bytes >, k or more of them
+
+        :returns: list
+            The k + m blocks of the group as bytes
+        """
+        lengths = self.block_lengths( size )
+        if len( blocks ) < self.k:
+            raise IOError( "Only {0} of the {1} blocks needed to decode the group are left".format( len( blocks ), self.k ) )
+        if all( i in blocks for i in range( self.width ) ):
+            return [ blocks[i] for i in range( self.width ) ]
+        used = sorted( blocks, key=lambda i: ( i >= self.k, i ) )[:self.k]
+        columns = lengths[self.k]
+        cells = np.zeros( ( self.k, columns ), dtype=np.uint8 )
+        for row, i in enumerate( used ):
+            cells[row, :len( blocks[i] )] = np.frombuffer( blocks[i], dtype=np.uint8 )[:columns]
+        if used == list( range( self.k ) ):
+            data = cells
+        else:
+            data = multiply( invert_matrix( self.generator[used] ), cells )
+        parity = multiply( self.generator[self.k:], data ) if any( i not in blocks for i in range( self.k, self.width ) ) else None
+        rebuilt = []
+        for i in range( self.width ):
+            if i in blocks:
+                rebuilt.append( blocks[i] )
+            elif i < self.k:
+                rebuilt.append( data[i, :lengths[i]].tobytes() )
+            else:
+                rebuilt.append( parity[i - self.k, :lengths[i]].tobytes() )
+        return rebuilt
+
+    def join(self, data_blocks, size):
+        """ The size bytes of the file held by the k data blocks of a group """
+        columns = self._columns( size )
+        cells = np.zeros( ( self.k, columns ), dtype=np.uint8 )
+        for i, block in enumerate( data_blocks ):
+            cells[i, :len( block )] = np.frombuffer( block, dtype=np.uint8 )
+        return cells.reshape( self.k, -1, self.cell ).transpose( 1, 0, 2 ).reshape( -1 )[:size].tobytes()
+
+    def locate(self, offset):
+        """ Returns ( index of the data block, offset in it ) of a byte at offset in the group """
+        stripe, rest = divmod( offset, self.k * self.cell )
+        index, in_cell = divmod( rest, self.cell )
+        return index, stripe * self.cell + in_cell
+
+
+def parse_policy( name ):
+    """ The policy for a name, None for replication """
+    if not name or name == replicated:
+        return None
+    return ErasurePolicy( name )
+
+
+def block_groups( blocks, policy, size, block_size ):
+    """
+    Splits the blocks of an erasure coded file into its groups
+
+    :param name: blocks
+    :param type: list
+        The block ids of the file in order, k + m per group
+
+    :returns: list
+        ( block ids of the group, bytes of the file in the group ) of every group
+    """
+    group_bytes = policy.group_bytes( block_size )
+    blocks = sorted( int( b ) for b in blocks )
+    return [ ( blocks[start:start + policy.width], min( group_bytes, size - g * group_bytes ) )
+             for g, start in enumerate( range( 0, len( blocks ), policy.width ) ) ]
+
+
+def gather_blocks( policy, lengths, fetch, skip=(), pool=None ):
+    """
+    Fetches k blocks of a group, the data blocks first and parity blocks for the ones
+    that fail, several at a time. Blocks of no bytes are not fetched.
+
+    :param name: fetch
+    :param type: function
+        fetch( index ) returns the bytes of the block at index in the group or raises
+
+    :param name: skip
+    :param type: iterable
+        Indexes of blocks known to be lost
+
+    :returns: dict
+        < key: index in the group, val: bytes >, k or more of them
+
+    Raises IOError if fewer than k blocks could be fetched
+    """
+    found, failed = {}, set( skip )
+    lock = threading.Lock()
+    candidates = [ i for i in range( policy.width ) if i not in failed ]
+
+    def get( index ):
+        try:
+            data = fetch( index ) if lengths[index] else b''
+        except Exception as a:
+            print( "Block {0} of the group could not be read: {1}".format( index, a ))
+            with lock:
+                failed.add( index )
+            return
+        with lock:
+            found[index] = data
+
+    own_pool = pool is None
+    pool = pool or ThreadPoolExecutor( max_workers=policy.width )
+    try:
+        while len( found ) < policy.k:
+            untried = [ i for i in candidates if i not in found and i not in failed ]
+            wanted = untried[:policy.k - len( found )]
+            if not wanted:
+                raise IOError( "Only {0} of the {1} blocks needed to decode the group could be read".format( len( found ), policy.k ) )
+            for future in [ pool.submit( get, i ) for i in wanted ]:
+                future.result()
+    finally:
+        if own_pool:
+            pool.shutdown()
+    return found
@@ -0,0 +1,46 @@
+import os
+
+"""
+Gunicorn settings for the namenode
+
+    gunicorn -c gunicorn.conf.py namenode:app
+
+The namenode runs a worker process per core. The state they share is in
+redis: the namespace, the heartbeats and stats of the datanodes, the namespace
+lock and the edit log the workers append to. One worker holds the leader lease
+and is the only one that writes the edit log to disk and times out datanodes,
+see coordination.py. Each worker serves its requests with a pool of threads;
+a request spends most of its time waiting on redis or the edit log sync,
+during which the other threads run. Idle keep-alive connections of the
+datanodes and clients wait in the worker's poller rather than holding a
+thread, so hundreds of datanodes heartbeating do not take threads away from
+metadata calls.
+"""
+
+bind = '0.0.0.0:{0}'.format( os.environ.get( 'SDFS_NAMENODE_PORT', 4000 ) )
+
+# Worker processes, they share the namenode through redis
+workers = int( os.environ.get( 'SDFS_NAMENODE_WORKERS', os.cpu_count() or 1 ) )
+worker_class = 'gthread'
+threads = int( os.environ.get( 'SDFS_NAMENODE_THREADS', 64 ) )
+
+# Connections waiting to be accepted and idle keep-alive connections kept open
+backlog = 2048
+worker_connections = 4096
+keepalive = 75
+
+# Seconds a request may take, a batch of thousands of files takes a while
+timeout = 120
+graceful_timeout = 30
+
+
+def on_starting( server ):
+    """ The workers of a new start wait for a leader to recover the namespace, even if redis kept the last one's """
+    import namenode
+    namenode.prepare()
+
+
+def post_worker_init( worker ):
+    """ Every worker takes part in the leader election and serves once the namespace is recovered """
+    import namenode
+    namenode.start()
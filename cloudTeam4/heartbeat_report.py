@@ -1,9 +1,19 @@
-import redis, json, time
-import requests as r
-from connect import connect_to_host, redis_host_dn
+import redis, json, time, os, socket
+from connect import connect_to_host, get_session, redis_host_dn, namenodes, namenode_for_block
+from block_delta import BlockDelta
+from block_storage import BlockStorage
 
 """
-Send periodic heartbeats and block reports from the datanode
+Send periodic heartbeats and block reports from the datanode. The datanode
+registers with the namenode first, and again whenever a heartbeat is answered
+with register because the namenode does not know it. A block report
+only has the blocks added and removed since the last one the namenode acked,
+the whole block list is sent at start up, every full_report_time and whenever
+the namenode asks for it. A full report lists the blocks on disk, so it holds
+every replica that is there whatever happened to the reports before it.
+
+In a federated cluster the datanode is shared: it registers and heartbeats with
+every namenode, and each namenode is sent the blocks of its own block pool.
 """
 
 # Env to connect to
@@ -15,8 +25,47 @@ heartbeat_time = 5
 # Time that Block Reports are Sent
 block_report_time = 15
 
+# Time that a Full Block Report is Sent
+full_report_time = 3600
 
-def datanode_send_heartbeat(datanode_id):
+# Where the datanode stores its blocks, the heartbeat reports the size and use of that disk
+data_root = os.environ.get( 'SDFS_DATA_ROOT', 'blocks' )
+
+# Only read here, to list the blocks on disk for full reports
+storage = BlockStorage( data_root, fsync_policy='none', preallocate=False )
+
+# Rack or zone of the datanode, replicas of a block are spread over racks
+rack = os.environ.get( 'SDFS_RACK' )
+
+# Address clients and other datanodes reach the datanode on
+datanode_port = int( os.environ.get( 'SDFS_DATANODE_PORT', 5000 ) )
+datanode_address = os.environ.get( 'SDFS_DATANODE_ADDRESS' )
+
+
+def advertised_address():
+    if datanode_address:
+        return datanode_address
+    return "http://{0}:{1}".format( socket.gethostbyname( socket.gethostname() ), datanode_port )
+
+
+def datanode_register(datanode_id, namenode="name"):
+    """
+    Announces the datanode, its address and its disk to the name node 
+
+    :param name: datanode_id 
+    :param type: str
+        The name of the datanode that is registering
+    """
+    print("\nRegistering with the namenode {0}".format( namenode ))
+    route = connect_to_host(namenode, default_env)   + '/register/'
+    payload = dict( datanode_stats(), id=datanode_id, address=advertised_address() )
+    response = get_session( namenode, default_env ).post( route  , json=payload).json()
+    if 'error' in response:
+        raise IOError( response['error'] )
+    print( response['message'] )
+
+
+def datanode_send_heartbeat(datanode_id, namenode="name"):
     """
     Posts a heartbeat to the name node
 
@@ -25,47 +74,112 @@ def datanode_send_heartbeat(datanode_id):
         The name of the datanode that is posting the heartbeat
     """
     print("\nStarting a hearbeat")
-    route = connect_to_host("name", default_env)   + '/hearbeat/'
-    print( r.put( route  , json={'id': datanode_id}).text )
-
-
-def datanode_send_blockreport(datanode_id, block_data):
+    route = connect_to_host(namenode, default_env)   + '/hearbeat/'
+    payload = dict( datanode_stats(), id=datanode_id )
+    response = get_session( namenode, default_env ).put( route  , json=payload).json()
+    print( response.get( 'message', response.get( 'error' ) ) )
+    if response.get('register'):
+        datanode_register(datanode_id, namenode)
+
+
+def datanode_stats():
+    """ Disk size and use, and the blocks being sent or received, for block placement on the namenode """
+    disk = os.statvfs( data_root if os.path.isdir( data_root ) else '.' )
+    capacity = disk.f_blocks * disk.f_frsize
+    stats = {'capacity': capacity, 'used': capacity - disk.f_bavail * disk.f_frsize,
+             'active_transfers': int( r_cache.get( 'active_transfers' ) or 0 )}
+    if rack:
+        stats['rack'] = rack
+    return stats
+
+
+def datanode_send_blockreport(datanode_id, full):
     """
-    Posts a block report to the name node
+    Posts a block report to the name node, the changes since the last acked report
+    or the whole list of blocks on the datanode
 
     :param name: datanode_id 
     :param type: str
         The name of the datanode that is posting the request
 
-    :param name: block_data 
-    :param type: list
-        The list of blocks on the datanode
+    :param name: full 
+    :param type: bool
+        Send every block instead of the changes
+
+    :returns: bool
+        True if a namenode asked for a full report
     """
-    print("\nStarting a block report")
-    route = connect_to_host("name", default_env)   + '/block_report/'
-    payload = {'id': datanode_id, 'block_data': block_data}
-    print( r.put( route  , json=payload).text )
+    print("\nStarting a {0} block report".format( "full" if full else "delta" ))
+    # Changes made from here on go in the next report
+    added, removed = block_delta.take()
+    blocks = sorted( storage.iter_blocks() ) if full else []
+    full_report = False
+    for namenode in namenodes():
+        # each namenode only hears about the blocks of its own pool
+        owned = lambda ids: [ b for b in ids if namenode_for_block( b ) == namenode ]
+        if full:
+            payload = {'id': datanode_id, 'block_data': owned( blocks )}
+        else:
+            payload = {'id': datanode_id, 'added': owned( added ), 'removed': owned( removed )}
+        route = connect_to_host(namenode, default_env)   + '/block_report/'
+        response = get_session( namenode, default_env ).put( route  , json=payload).json()
+        if 'error' in response:
+            # the changes stay in flight and are sent again, to every namenode
+            raise IOError( response['error'] )
+        print( response['message'] )
+        full_report = full_report or response.get('full_report', False)
+    block_delta.ack()
+    return full_report
+
+
+def next_tick( deadline, interval, now ):
+    """ The next deadline after now, ticks missed while busy are skipped instead of sent in a burst """
+    deadline += interval
+    if deadline <= now:
+        deadline = now + interval
+    return deadline
 
 
 def periodically_send_data( datanode_id ):
     """
-    Periodically sends the heartbeat and block report
+    Periodically sends the heartbeat and block report. The deadlines use the 
+    monotonic clock so no tick is missed or sent twice.
     """
+    now = time.monotonic()
+    next_heartbeat, next_report, next_full = now, now, now
     while True:
+        now = time.monotonic()
         # Post the Heartbeat Periodically
-        if int(time.time()) % heartbeat_time == 0:
-            datanode_send_heartbeat(datanode_id)
-        # Post the Block Report Periodically
-        if int(time.time()) % block_report_time == 0:
-            block_data = get_from_memory('block_data')
-            datanode_send_blockreport(datanode_id, block_data)                
-        time.sleep(1)
+        if now >= next_heartbeat:
+            for namenode in namenodes():
+                try:
+                    datanode_send_heartbeat(datanode_id, namenode)
+                except Exception as a:
+                    print( "Heartbeat ERROR: {0}".format( a ))
+            next_heartbeat = next_tick( next_heartbeat, heartbeat_time, now )
+        # Post the Block Report Periodically, a full one when it is due or was asked for
+        if now >= next_report:
+            full = now >= next_full
+            next_report = next_tick( next_report, block_report_time, now )
+            try:
+                if datanode_send_blockreport(datanode_id, full):
+                    # a full report that was asked for goes out right away
+                    next_full, next_report = now, now
+                elif full:
+                    next_full = now + full_report_time
+            except Exception as a:
+                # a failed full report is tried again with the next report
+                print( "Block report ERROR: {0}".format( a ))
+        time.sleep( max( min( next_heartbeat, next_report ) - time.monotonic(), 0 ) )
 
 
 
 # Redis is an In-Memory but Persistent on Disk DB
 r_cache = redis.Redis(host=redis_host_dn,port=6379)
 
+# Blocks added and removed since the last block report
+block_delta = BlockDelta( r_cache )
+
 
 def add_to_memory( obj, var_name ):
     values = json.dumps( obj )
@@ -83,6 +197,13 @@ if __name__ == '__main__':
     print("Hello " +  redis_host_dn)
     datanode_id = get_from_memory('datanode_id')
     
+    for namenode in namenodes():
+        try:
+            datanode_register(datanode_id, namenode)
+        except Exception as a:
+            # the first heartbeat tries again
+            print( "Register ERROR: {0}".format( a ))
+
     # Posts Heart beats and Block reports on a Loop
     periodically_send_data(datanode_id)
     
\ No newline at end of file
@@ -0,0 +1,108 @@
+import time, threading
+
+"""
+Liveness of the datanodes from their heartbeats. A heartbeat only stores the
+monotonic time it arrived and drops a timer in the wheel slot of the time the
+node would go stale. Every tick the wheel expires the timers of one slot. A
+timer whose node was heard from again since it was set is stale itself and is
+skipped, so heartbeats never search or move timers.
+
+A datanode goes
+    alive   heard from within stale_after seconds
+    stale   not heard from for stale_after seconds, no new blocks are placed on it
+    dead    not heard from for dead_after seconds, its replicas are copied elsewhere
+and every change is passed to the listeners as an event.
+"""
+
+alive = 'alive'
+stale = 'stale'
+dead = 'dead'
+
+# Seconds without a heartbeat before a datanode is stale and then dead
+stale_after = 15
+dead_after = 30
+
+# Seconds per slot of the wheel
+tick = 1.0
+
+
+class Liveness:
+    """ Tracks the state of each datanode with one timer wheel """
+
+    def __init__(self, stale_after=stale_after, dead_after=dead_after, tick=tick):
+        self.stale_after = stale_after
+        self.dead_after = dead_after
+        self.tick = tick
+        # one lap of the wheel covers the longest timer
+        self.wheel = [ [] for _ in range( int( max( stale_after, dead_after ) / tick ) + 2 ) ]
+        self.current_tick = int( time.monotonic() / tick )
+        self.last_seen = {}
+        self.states = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread( target=self._run, daemon=True )
+
+    def start(self):
+        # the wheel turns from now, a wheel made long before would run laps at once and expire timers early
+        with self.lock:
+            self.current_tick = int( time.monotonic() / self.tick )
+        self.thread.start()
+        return self
+
+    def subscribe(self, listener):
+        """ listener( datanode, old state, new state ) is called on every change, old state is None for a new node """
+        self.listeners.append( listener )
+
+    def heartbeat(self, datanode, now=None):
+        """ Records a heartbeat, O(1) """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.last_seen[datanode] = now
+            self._schedule( datanode, now, now + self.stale_after, stale )
+            old = self.states.get( datanode )
+            self.states[datanode] = alive
+        if old != alive:
+            self._publish( datanode, old, alive )
+
+    def _schedule(self, datanode, seen, at, state):
+        self.wheel[ int( at / self.tick ) % len( self.wheel ) ].append( ( datanode, seen, state ) )
+
+    def advance(self, now=None):
+        """ Expires the timers of every slot up to now and sends the state changes """
+        now = time.monotonic() if now is None else now
+        changes = []
+        with self.lock:
+            while self.current_tick <= int( now / self.tick ):
+                slot = self.wheel[ self.current_tick % len( self.wheel ) ]
+                self.wheel[ self.current_tick % len( self.wheel ) ] = []
+                self.current_tick += 1
+                for datanode, seen, state in slot:
+                    # heard from since the timer was set
+                    if self.last_seen.get( datanode ) != seen:
+                        continue
+                    old = self.states.get( datanode )
+                    self.states[datanode] = state
+                    changes.append( ( datanode, old, state ) )
+                    if state == stale:
+                        self._schedule( datanode, seen, seen + self.dead_after, dead )
+        for datanode, old, state in changes:
+            self._publish( datanode, old, state )
+
+    def _publish(self, datanode, old, new):
+        for listener in self.listeners:
+            try:
+                listener( datanode, old, new )
+            except Exception as a:
+                print( "Liveness listener ERROR: {0}".format( a ))
+
+    def state(self, datanode):
+        return self.states.get( datanode )
+
+    def alive_nodes(self):
+        with self.lock:
+            return sorted( dn for dn, state in self.states.items() if state == alive )
+
+    def _run(self):
+        while True:
+            time.sleep( self.tick )
+            self.advance()
@@ -0,0 +1,72 @@
+import time, threading
+from collections import OrderedDict
+
+"""
+Client cache of the namenode's answers for files, the blocks of a file and the
+datanodes of each block. An answer is used for ttl seconds and the least
+recently used ones are dropped past max_entries. Every answer carries the
+generation of the file, which the namenode changes when the path is given to
+a new file, so an answer for a file that was deleted and written again is
+never mixed up with one for the new file.
+
+An entry is dropped when a datanode says it does not have a block of the file,
+the next read asks the namenode again.
+"""
+
+# Seconds an answer of the namenode is used before it is asked again
+location_ttl = 60
+
+# Files kept in the cache
+location_entries = 10000
+
+
+class LocationCache:
+    """ TTL and LRU cache of < key: ( directory, file name ), val: namenode answer with its generation > """
+
+    def __init__(self, ttl=location_ttl, max_entries=location_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # < key: ( directory, file name ), val: ( expires, answer ) >, least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'expired': 0, 'invalidated': 0, 'replaced': 0}
+
+    def get(self, key, now=None):
+        """ Returns the cached answer, None if there is none or it expired """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.entries.get( key )
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+            if entry[0] <= now:
+                del self.entries[key]
+                self.counts['expired'] += 1
+                self.counts['misses'] += 1
+                return None
+            self.entries.move_to_end( key )
+            self.counts['hits'] += 1
+            return entry[1]
+
+    def put(self, key, answer, now=None):
+        """ Caches the answer, an answer with another generation than the cached one replaces it """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            old = self.entries.pop( key, None )
+            if old is not None and old[1].get('generation') != answer.get('generation'):
+                self.counts['replaced'] += 1
+            self.entries[key] = ( now + self.ttl, answer )
+            while len( self.entries ) > self.max_entries:
+                self.entries.popitem( last=False )
+
+    def invalidate(self, key):
+        """ Drops the answer, returns True if there was one """
+        with self.lock:
+            if self.entries.pop( key, None ) is None:
+                return False
+            self.counts['invalidated'] += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return dict( self.counts, entries=len( self.entries ) )
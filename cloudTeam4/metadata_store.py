@@ -0,0 +1,708 @@
+import json, time
+import redis
+
+"""
+Metadata store for the namenode. Instead of keeping the whole namespace and
+block map in one JSON blob per structure, every directory, file and block is
+its own Redis key so an operation only touches the keys it needs.
+
+The namespace is a tree of inodes. Each directory has a child index that maps
+a name to the inode of the child, so a path resolves in one lookup per level
+and listing or emptying a directory only reads its own children. Files with
+the same name can live in different directories.
+
+Key layout (all keys are prefixed with "nn:<namespace>:", "nn:default:" for a namenode that is not federated,
+so no namespace's keys start with another's prefix)
+    last_inode              counter, the root directory is inode 0
+    txid                    transaction id of the last namespace edit applied, see edit_log.py
+    dir:<inode>             hash < key: child name, val: "d<inode>" or "f<inode>" >
+    inode:<inode>           hash < type, name, parent and for files the json list of blocks >
+                            an erasure coded file also has its policy and size, a directory may have a policy
+    blocks                  set  < every block id >
+    striped                 hash < key: block id of an erasure coded file, val: inode of the file >
+    block:<block_id>        set  < datanodes holding a replica >
+    members                 hash < key: datanode, val: json of its address, rack and capacity when it registered >
+    datanode_state          hash < key: datanode, val: alive, stale or dead >
+    datanode_events         pub/sub channel of datanode state changes
+    replica_events          pub/sub channel of the blocks a datanode no longer holds
+    datanode_stats          hash < key: datanode, val: json of the disk and load in its last heartbeat >
+    heartbeats              hash < key: datanode, val: wall clock time of its last heartbeat, to any worker >
+    replication_stats       json of the queue depth and copies of the checker's replication manager
+    dn_blocks:<dn>          set  < blocks the datanode holds, kept up to date by its block reports >
+    reporting_dns           set  < datanodes that sent a full report, their deltas can be applied >
+    leader                  token of the worker of the namenode holding the leader lease, see coordination.py
+    namespace_lock          token of the worker holding the namespace lock
+    edits, edits_synced...  the shared edit log the workers append to, see edit_log.py
+"""
+
+# Separates the directories of a path, test\data
+path_sep = '\\'
+
+# Inode of the root directory
+root_inode = 0
+
+# Namespace of a namenode that is not part of a federation
+default_namespace = 'default'
+
+# Keys of the namespace itself, the tree and its blocks. The datanodes, their reports and the block id counter are not
+namespace_keys = ( 'last_inode', 'txid', 'blocks', 'striped' )
+namespace_id_keys = ( 'dir', 'inode', 'block' )
+
+# Keys a namenode that is not federated kept right under "nn:" before it had a namespace of its own,
+# nn:txid and the like, and nn:dir:<inode> and the like with a number after the name
+legacy_keys = ( 'last_inode', 'txid', 'blocks', 'striped', 'members', 'datanode_state', 'datanode_stats',
+                'replication_stats', 'reporting_dns', 'last_block_id' )
+legacy_id_keys = ( 'dir', 'inode', 'block' )
+
+
+class MetadataStore:
+    """ Reads and writes the namenode metadata one key per directory, file and block """
+
+    def __init__(self, r_cache, namespace=None):
+        self.r_cache = r_cache
+        # namenodes of a federated cluster can share one redis
+        self.prefix = 'nn:{0}:'.format( namespace or default_namespace )
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join( str(p) for p in parts )
+
+    # Namespace
+
+    def _new_inode(self):
+        return self.r_cache.incr( self._key('last_inode') )
+
+    def _child(self, dir_inode, name):
+        """ Returns ( type, inode ) of the child, None if there is no such child """
+        entry = self.r_cache.hget( self._key('dir', dir_inode), name )
+        if entry is None:
+            return None
+        entry = _decode( entry )
+        return entry[0], int( entry[1:] )
+
+    def resolve(self, path):
+        """ Walks the tree one level at a time and returns the inode of the directory, None if it does not exist """
+        inode = root_inode
+        for name in split_path( path ):
+            child = self._child( inode, name )
+            if child is None or child[0] != 'd':
+                return None
+            inode = child[1]
+        return inode
+
+    def directory_exists(self, path):
+        return self.resolve( path ) is not None
+
+    def make_directories(self, path):
+        """ Makes the directory and any missing parents, returns False if it already existed """
+        inode = root_inode
+        made = False
+        for name in split_path( path ):
+            child = self._child( inode, name )
+            if child is None:
+                new_inode = self._new_inode()
+                pipe = self.r_cache.pipeline()
+                pipe.hsetnx( self._key('dir', inode), name, 'd{0}'.format( new_inode ) )
+                pipe.hset( self._key('inode', new_inode), mapping={'type': 'dir', 'name': name, 'parent': inode} )
+                created, _ = pipe.execute()
+                if created:
+                    made = True
+                    inode = new_inode
+                    continue
+                # another request made the same directory first
+                self.r_cache.delete( self._key('inode', new_inode) )
+                child = self._child( inode, name )
+            if child[0] != 'd':
+                raise ValueError( "{0} is a file, not a directory".format( name ) )
+            inode = child[1]
+        return made
+
+    def set_policy(self, path, policy):
+        """ Sets the erasure coding policy of the directory, None takes it off. Returns False if there is no such directory """
+        inode = self.resolve( path )
+        if inode is None or inode == root_inode:
+            return False
+        if policy:
+            self.r_cache.hset( self._key('inode', inode), 'policy', policy )
+        else:
+            self.r_cache.hdel( self._key('inode', inode), 'policy' )
+        return True
+
+    def get_policy(self, path):
+        """ The policy set on the directory or else on its nearest parent with one, None if there is none """
+        inode, inodes = root_inode, []
+        for name in split_path( path ):
+            child = self._child( inode, name )
+            if child is None or child[0] != 'd':
+                return None
+            inode = child[1]
+            inodes.append( inode )
+        pipe = self.r_cache.pipeline( transaction=False )
+        for inode in inodes:
+            pipe.hget( self._key('inode', inode), 'policy' )
+        policies = [ _decode( p ) for p in pipe.execute() if p is not None ] if inodes else []
+        return policies[-1] if policies else None
+
+    def list_directory(self, path):
+        """ Returns ( sub directories, files ) of the directory, None if it does not exist """
+        inode = self.resolve( path )
+        if inode is None:
+            return None
+        sub_dirs, files = [], []
+        for name, entry in self.r_cache.hgetall( self._key('dir', inode) ).items():
+            if _decode( entry )[0] == 'd':
+                sub_dirs.append( _decode( name ) )
+            else:
+                files.append( _decode( name ) )
+        return sorted( sub_dirs ), sorted( files )
+
+    def remove_directory(self, path):
+        """
+        Removes the directory if it is empty.
+        Returns None if it does not exist, else the names it still contains (empty when removed)
+        """
+        names = split_path( path )
+        if not names:
+            return None
+        parent = self.resolve( path_sep.join( names[:-1] ) )
+        child = None if parent is None else self._child( parent, names[-1] )
+        if child is None or child[0] != 'd':
+            return None
+        inode = child[1]
+        dir_key = self._key('dir', inode)
+        with self.r_cache.pipeline() as pipe:
+            while True:
+                try:
+                    # nothing can be added to the directory between the check and the delete
+                    pipe.watch( dir_key )
+                    children = sorted( _decode_all( pipe.hkeys( dir_key ) ) )
+                    if children:
+                        pipe.unwatch()
+                        return children
+                    pipe.multi()
+                    pipe.hdel( self._key('dir', parent), names[-1] )
+                    pipe.delete( dir_key, self._key('inode', inode) )
+                    pipe.execute()
+                    return []
+                except redis.WatchError:
+                    continue
+
+    def file_exists(self, directory, file_name):
+        inode = self.resolve( directory )
+        return inode is not None and self._child( inode, file_name ) is not None
+
+    def get_file(self, directory, file_name):
+        """ Returns the list of block ids of the file, None if there is no such file in the directory """
+        found = self.get_files( [ ( directory, file_name ) ] )[0]
+        return found[1] if found is not None else None
+
+    def get_files(self, files):
+        """
+        Looks up many files with one round trip per step for all of them
+
+        :param name: files
+        :param type: list
+            [ ( directory, file name ) ]
+
+        :returns: list
+            ( generation, list of block ids, striping ) of each file, None if there is no such file in the directory.
+            The generation is the inode of the file, a file written again at the same path gets a new one.
+            striping is {'policy': "RS-6-3-1024k", 'size': 1200} for an erasure coded file, None for a replicated one
+        """
+        entries = self._children( files )
+        pipe = self.r_cache.pipeline( transaction=False )
+        for entry in entries:
+            if entry is not None and entry[1][0] == 'f':
+                pipe.hmget( self._key('inode', entry[1][1]), 'blocks', 'policy', 'size' )
+        found = iter( pipe.execute() )
+        results = []
+        for entry in entries:
+            fields = next( found ) if entry is not None and entry[1][0] == 'f' else None
+            if fields is None or fields[0] is None:
+                results.append( None )
+            else:
+                results.append( ( entry[1][1], json.loads( fields[0] ), _striping( *fields[1:] ) ) )
+        return results
+
+    def _children(self, files):
+        """ Returns ( directory inode, ( type, inode ) ) of each ( directory, name ), None if either is missing """
+        dirs = { d: self.resolve( d ) for d in set( d for d, _ in files ) }
+        pipe = self.r_cache.pipeline( transaction=False )
+        for directory, name in files:
+            if dirs[directory] is not None:
+                pipe.hget( self._key('dir', dirs[directory]), name )
+        found = iter( pipe.execute() )
+        entries = []
+        for directory, name in files:
+            entry = next( found ) if dirs[directory] is not None else None
+            if entry is None:
+                entries.append( None )
+            else:
+                entry = _decode( entry )
+                entries.append( ( dirs[directory], ( entry[0], int( entry[1:] ) ) ) )
+        return entries
+
+    def create_file(self, file_name, directory, blocks_and_dns, striping=None):
+        """
+        Adds the file and its blocks with their datanodes, striping is the layout of an erasure coded file.
+        Returns False if the directory does not exist or already has an entry with that name.
+        """
+        return bool( self.create_files( [ ( file_name, directory, blocks_and_dns, striping ) ] )[0] )
+
+    def create_files(self, files):
+        """
+        Adds many files and their blocks in a few pipelined round trips
+
+        :param name: files
+        :param type: list
+            [ ( file name, directory, < key: block id, val: list of datanodes > ) ] or with the
+            striping of an erasure coded file as a fourth item, {'policy': "RS-6-3-1024k", 'size': 1200}
+
+        :returns: list
+            For each file True if it was added, False if the directory already has an entry
+            with that name and None if the directory does not exist
+        """
+        dirs = { d: self.resolve( d ) for d in set( f[1] for f in files ) }
+        wanted = [ i for i, f in enumerate( files ) if dirs[f[1]] is not None ]
+        results = [ None ] * len( files )
+        if not wanted:
+            return results
+        last_inode = self.r_cache.incrby( self._key('last_inode'), len( wanted ) )
+        inodes = dict( zip( wanted, range( last_inode - len( wanted ) + 1, last_inode + 1 ) ) )
+        pipe = self.r_cache.pipeline( transaction=False )
+        for i in wanted:
+            file_name, directory, blocks_and_dns = files[i][:3]
+            striping = files[i][3] if len( files[i] ) > 3 else None
+            blocks = [ int(b) for b in blocks_and_dns ]
+            pipe.hset( self._key('inode', inodes[i]), mapping=dict( {
+                'type': 'file', 'name': file_name, 'parent': dirs[directory], 'blocks': json.dumps( blocks ) }, **( striping or {} ) ) )
+            if striping and blocks:
+                pipe.hset( self._key('striped'), mapping={ b: inodes[i] for b in blocks } )
+            for b, dns in blocks_and_dns.items():
+                if dns:
+                    pipe.sadd( self._key('block', b), *dns )
+                    # until a full report says otherwise the datanodes are taken to hold the block
+                    for dn in dns:
+                        pipe.sadd( self._key('dn_blocks', dn), b )
+            if blocks:
+                pipe.sadd( self._key('blocks'), *blocks )
+        pipe.execute()
+        # Publish the files last so readers never see one without its blocks
+        for i in wanted:
+            file_name, directory = files[i][:2]
+            pipe.hsetnx( self._key('dir', dirs[directory]), file_name, 'f{0}'.format( inodes[i] ) )
+        taken_blocks, taken_keys = [], []
+        for i, created in zip( wanted, pipe.execute() ):
+            results[i] = bool( created )
+            if not created:
+                taken_blocks += [ int(b) for b in files[i][2] ]
+                taken_keys.append( self._key('inode', inodes[i]) )
+        if taken_keys:
+            self._delete_blocks( taken_blocks, *taken_keys )
+        return results
+
+    def delete_file(self, file_name, directory):
+        """ Removes the file and its blocks, returns < key: block id, val: list of datanodes >, None if there is no such file """
+        return self.delete_files( [ ( directory, file_name ) ] )[0]
+
+    def delete_files(self, files):
+        """
+        Removes many files and their blocks in a few pipelined round trips
+
+        :param name: files
+        :param type: list
+            [ ( directory, file name ) ]
+
+        :returns: list
+            < key: block id, val: list of datanodes > of each file, None if there is no such file
+        """
+        entries = [ e if e is not None and e[1][0] == 'f' else None for e in self._children( files ) ]
+        pipe = self.r_cache.pipeline( transaction=False )
+        for ( _, name ), entry in zip( files, entries ):
+            if entry is not None:
+                pipe.hdel( self._key('dir', entry[0]), name )
+        deleted = iter( pipe.execute() )
+        # a file deleted by another request in the meantime is not there anymore
+        entries = [ e if e is not None and next( deleted ) else None for e in entries ]
+        for entry in entries:
+            if entry is not None:
+                pipe.hget( self._key('inode', entry[1][1]), 'blocks' )
+        found = iter( pipe.execute() )
+        file_blocks = [ json.loads( next( found ) or '[]' ) if e is not None else None for e in entries ]
+        all_blocks = [ b for blocks in file_blocks if blocks for b in blocks ]
+        locations = self.get_block_locations( all_blocks )
+        self._delete_blocks( all_blocks, *[ self._key('inode', e[1][1]) for e in entries if e is not None ] )
+        results = []
+        for blocks in file_blocks:
+            if blocks is None:
+                results.append( None )
+            else:
+                results.append( { str(b): locations[str(b)] for b in blocks if locations[str(b)] is not None } )
+        return results
+
+    def _delete_blocks(self, blocks, *keys):
+        pipe = self.r_cache.pipeline()
+        for b in blocks:
+            pipe.delete( self._key('block', b) )
+        if blocks:
+            pipe.srem( self._key('blocks'), *blocks )
+            pipe.hdel( self._key('striped'), *blocks )
+        if keys:
+            pipe.delete( *keys )
+        pipe.execute()
+
+    # Blocks
+
+    def get_block_locations(self, blocks):
+        """
+        Returns < key: block id as str, val: list of datanodes > for the given blocks,
+        a block that is not in the block map maps to None
+        """
+        blocks = [ str(b) for b in blocks ]
+        pipe = self.r_cache.pipeline()
+        for b in blocks:
+            pipe.sismember( self._key('blocks'), b )
+            pipe.smembers( self._key('block', b) )
+        results = pipe.execute()
+        locations = {}
+        for i, b in enumerate( blocks ):
+            known, dns = results[2 * i], results[2 * i + 1]
+            locations[b] = sorted( _decode_all( dns ) ) if known else None
+        return locations
+
+    def get_striping(self, blocks):
+        """
+        Finds the erasure coded files of blocks
+
+        :returns: dict
+            < key: block id as str, val: ( policy, size, list of block ids of the file ) > of the blocks
+            that belong to an erasure coded file, replicated blocks are left out
+        """
+        blocks = [ str(b) for b in blocks ]
+        inodes = self.r_cache.hmget( self._key('striped'), blocks ) if blocks else []
+        files = sorted( set( _decode( i ) for i in inodes if i is not None ) )
+        pipe = self.r_cache.pipeline( transaction=False )
+        for inode in files:
+            pipe.hmget( self._key('inode', inode), 'policy', 'size', 'blocks' )
+        found = {}
+        for inode, ( policy, size, file_blocks ) in zip( files, pipe.execute() ):
+            if file_blocks is not None:
+                found[inode] = ( _decode( policy ), int( size ), json.loads( file_blocks ) )
+        return { b: found[_decode( i )] for b, i in zip( blocks, inodes ) if i is not None and _decode( i ) in found }
+
+    def all_block_ids(self):
+        return [ _decode(b) for b in self.r_cache.sscan_iter( self._key('blocks') ) ]
+
+    def add_block_replicas(self, block, dns):
+        pipe = self.r_cache.pipeline()
+        pipe.sadd( self._key('blocks'), block )
+        if dns:
+            pipe.sadd( self._key('block', block), *dns )
+        pipe.execute()
+
+    def remove_replica_everywhere(self, datanode, blocks):
+        """ Removes the datanode from the replica set of every given block """
+        pipe = self.r_cache.pipeline()
+        for b in blocks:
+            pipe.srem( self._key('block', b), datanode )
+        if blocks:
+            pipe.srem( self._key('dn_blocks', datanode), *blocks )
+            self._publish_removed( pipe, datanode, blocks )
+        pipe.execute()
+
+    def _publish_removed(self, pipe, datanode, blocks):
+        # the checker looks at only the blocks that lost a replica
+        pipe.publish( self._key('replica_events'), json.dumps( {'id': datanode, 'removed': [ str(b) for b in blocks ]} ) )
+
+    # Heartbeats and block reports
+
+    def register_datanode(self, datanode, info):
+        self.r_cache.hset( self._key('members'), datanode, json.dumps( info ) )
+
+    def is_member(self, datanode):
+        return self.r_cache.hexists( self._key('members'), datanode )
+
+    def get_members(self):
+        """ Returns < key: datanode, val: {'address': ..., 'rack': ..., 'capacity': ...} > """
+        members = self.r_cache.hgetall( self._key('members') )
+        return { _decode(dn): json.loads( info ) for dn, info in members.items() }
+
+    def set_datanode_state(self, datanode, state):
+        """ Saves the state of the datanode and publishes the change to every subscriber """
+        pipe = self.r_cache.pipeline()
+        pipe.hset( self._key('datanode_state'), datanode, state )
+        pipe.publish( self._key('datanode_events'), json.dumps( {'id': datanode, 'state': state} ) )
+        pipe.execute()
+
+    def get_datanode_states(self):
+        states = self.r_cache.hgetall( self._key('datanode_state') )
+        return { _decode(dn): _decode(s) for dn, s in states.items() }
+
+    def heartbeat(self, datanode, stats):
+        """ Saves when the datanode was heard from and the disk and load it reported, for every worker of the namenode """
+        pipe = self.r_cache.pipeline( transaction=False )
+        pipe.hset( self._key('heartbeats'), datanode, time.time() )
+        if stats:
+            pipe.hset( self._key('datanode_stats'), datanode, json.dumps( stats ) )
+        pipe.execute()
+
+    def get_heartbeats(self):
+        """ Returns < key: datanode, val: wall clock time of its last heartbeat > """
+        heartbeats = self.r_cache.hgetall( self._key('heartbeats') )
+        return { _decode(dn): float( t ) for dn, t in heartbeats.items() }
+
+    def get_datanode_stats(self):
+        stats = self.r_cache.hgetall( self._key('datanode_stats') )
+        return { _decode(dn): json.loads( s ) for dn, s in stats.items() }
+
+    def set_replication_stats(self, stats):
+        self.r_cache.set( self._key('replication_stats'), json.dumps( stats ) )
+
+    def get_replication_stats(self):
+        stats = self.r_cache.get( self._key('replication_stats') )
+        return json.loads( stats ) if stats else {}
+
+    def datanode_events(self):
+        """ 
+        Returns a pub/sub subscribed to datanode state changes and lost replicas, each message is 
+        {'id': 'dn0', 'state': 'dead'} or {'id': 'dn0', 'removed': ['7', '9']}
+        """
+        events = self.r_cache.pubsub( ignore_subscribe_messages=True )
+        events.subscribe( self._key('datanode_events'), self._key('replica_events') )
+        return events
+
+    def apply_block_delta(self, datanode, added, removed):
+        """ 
+        Adds the datanode to the replicas of the added blocks and takes it off the removed ones.
+        Returns False without changing anything if the datanode has not sent a full report.
+        """
+        if not self.r_cache.sismember( self._key('reporting_dns'), datanode ):
+            return False
+        self._apply_blocks( datanode, added, removed )
+        return True
+
+    def set_full_block_report(self, datanode, blocks):
+        """ Makes the blocks the whole list of the datanode, returns ( number added, number removed ) """
+        blocks = { str(b) for b in blocks }
+        held = set( _decode_all( self.r_cache.smembers( self._key('dn_blocks', datanode) ) ) )
+        # every reported block is added again in case the block map lost it
+        self._apply_blocks( datanode, blocks, held - blocks )
+        self.r_cache.sadd( self._key('reporting_dns'), datanode )
+        return len( blocks - held ), len( held - blocks )
+
+    def _apply_blocks(self, datanode, added, removed):
+        added, removed = [ str(b) for b in added ], [ str(b) for b in removed ]
+        pipe = self.r_cache.pipeline()
+        for b in added:
+            pipe.sismember( self._key('blocks'), b )
+        known = pipe.execute() if added else []
+        for b, is_known in zip( added, known ):
+            # a block of a deleted file is only kept in the index of the datanode
+            if is_known:
+                pipe.sadd( self._key('block', b), datanode )
+        for b in removed:
+            pipe.srem( self._key('block', b), datanode )
+        if added:
+            pipe.sadd( self._key('dn_blocks', datanode), *added )
+        if removed:
+            pipe.srem( self._key('dn_blocks', datanode), *removed )
+            self._publish_removed( pipe, datanode, removed )
+        pipe.execute()
+
+    def drop_datanode(self, datanode):
+        """ 
+        Takes a dead datanode off the replicas of every block it held and forgets its blocks,
+        it has to send a full report when it comes back. Returns the blocks it held.
+        """
+        blocks = _decode_all( self.r_cache.smembers( self._key('dn_blocks', datanode) ) )
+        pipe = self.r_cache.pipeline()
+        for b in blocks:
+            pipe.srem( self._key('block', b), datanode )
+        pipe.delete( self._key('dn_blocks', datanode) )
+        pipe.srem( self._key('reporting_dns'), datanode )
+        pipe.execute()
+        return blocks
+
+    def datanode_blocks(self, datanode):
+        return sorted( _decode_all( self.r_cache.smembers( self._key('dn_blocks', datanode) ) ), key=int )
+
+    # Whole store
+
+    def walk(self, batch=1000):
+        """
+        Yields every directory and file of the tree, parents before their children. The tree
+        is read a level at a time, the children and inodes of up to batch entries per round trip
+
+        :returns: generator
+            ( 'd', path, None, policy ) for a directory and ( 'f', path, < list of block ids >, striping ) for a file,
+            the policy and the striping are None unless the directory or file is erasure coded
+        """
+        level = [ ( root_inode, '' ) ]
+        while level:
+            next_level = []
+            for start in range( 0, len( level ), batch ):
+                pipe = self.r_cache.pipeline( transaction=False )
+                for inode, _ in level[ start:start + batch ]:
+                    pipe.hgetall( self._key('dir', inode) )
+                children = []
+                for ( _, path ), entries in zip( level[ start:start + batch ], pipe.execute() ):
+                    for name, entry in entries.items():
+                        name = _decode( name )
+                        children.append( ( path + path_sep + name if path else name, _decode( entry ) ) )
+                for first in range( 0, len( children ), batch ):
+                    for _, entry in children[ first:first + batch ]:
+                        pipe.hmget( self._key('inode', entry[1:]), 'blocks', 'policy', 'size' )
+                    for ( child_path, entry ), ( blocks, policy, size ) in zip( children[ first:first + batch ], pipe.execute() ):
+                        if entry[0] == 'd':
+                            yield 'd', child_path, None, _decode( policy )
+                            next_level.append( ( int( entry[1:] ), child_path ) )
+                        else:
+                            yield 'f', child_path, json.loads( blocks ), _striping( policy, size )
+            level = next_level
+
+    def dump(self):
+        """ Walks the whole tree, for debugging only """
+        file_dir, directories = {}, []
+        for kind, path, blocks, _ in self.walk():
+            if kind == 'd':
+                directories.append( path )
+            else:
+                file_dir[path] = blocks
+        block_list = self.get_block_locations( self.all_block_ids() )
+        return {'file_dir': file_dir, 'block_list': block_list, 'directories': sorted( directories ) }
+
+    def get_txid(self):
+        txid = self.r_cache.get( self._key('txid') )
+        return int( txid ) if txid else 0
+
+    def set_txid(self, txid):
+        self.r_cache.set( self._key('txid'), txid )
+
+    def restore(self, dirs, files, txid, policies=None, striped=None, batch=10000):
+        """
+        Replaces the namespace with the given one, written in pipelined batches. The datanodes
+        and their reports are kept, a block keeps the replicas the datanodes reported for it
+
+        :param name: dirs
+        :param type: iterable
+            Directory paths, parents before their children
+
+        :param name: files
+        :param type: dict
+            < key: ( directory, file name ), val: list of block ids >
+
+        :param name: policies
+        :param type: dict
+            < key: directory path, val: erasure coding policy >
+
+        :param name: striped
+        :param type: dict
+            < key: ( directory, file name ), val: {'policy': "RS-6-3-1024k", 'size': 1200} > of the erasure coded files
+        """
+        policies, striped = policies or {}, striped or {}
+        self.reset()
+        restored = set()
+        inodes = { '': root_inode }
+        next_inode = root_inode
+        pipe = self.r_cache.pipeline( transaction=False )
+        for path in dirs:
+            names = split_path( path )
+            next_inode += 1
+            inodes[ path_sep.join( names ) ] = next_inode
+            parent = inodes[ path_sep.join( names[:-1] ) ]
+            pipe.hset( self._key('dir', parent), names[-1], 'd{0}'.format( next_inode ) )
+            pipe.hset( self._key('inode', next_inode), mapping={'type': 'dir', 'name': names[-1], 'parent': parent} )
+            if policies.get( path ):
+                pipe.hset( self._key('inode', next_inode), 'policy', policies[path] )
+            if len( pipe ) >= batch:
+                pipe.execute()
+        for ( directory, name ), blocks in files.items():
+            next_inode += 1
+            parent = inodes[ path_sep.join( split_path( directory ) ) ]
+            pipe.hset( self._key('dir', parent), name, 'f{0}'.format( next_inode ) )
+            pipe.hset( self._key('inode', next_inode), mapping=dict( {
+                'type': 'file', 'name': name, 'parent': parent, 'blocks': json.dumps( blocks ) }, **striped.get( ( directory, name ), {} ) ) )
+            if blocks:
+                pipe.sadd( self._key('blocks'), *blocks )
+                restored.update( str( b ) for b in blocks )
+                if ( directory, name ) in striped:
+                    pipe.hset( self._key('striped'), mapping={ b: next_inode for b in blocks } )
+            if len( pipe ) >= batch:
+                pipe.execute()
+        for dn in _decode_all( self.r_cache.smembers( self._key('reporting_dns') ) ):
+            for b in _decode_all( self.r_cache.smembers( self._key('dn_blocks', dn) ) ):
+                if b in restored:
+                    pipe.sadd( self._key('block', b), dn )
+                    if len( pipe ) >= batch:
+                        pipe.execute()
+        pipe.set( self._key('last_inode'), next_inode )
+        pipe.set( self._key('txid'), txid )
+        pipe.execute()
+
+    def reset(self, batch=10000):
+        """ 
+        Deletes the namespace, its tree and blocks. The datanodes, their reports and the block
+        id counter are kept, so are the other namespaces sharing the redis
+        """
+        keys = [ self._key( name ) for name in namespace_keys ]
+        for name in namespace_id_keys:
+            keys += self.r_cache.scan_iter( match=self._key( name ) + ':*', count=batch )
+        for start in range( 0, len( keys ), batch ):
+            self.r_cache.delete( *keys[ start:start + batch ] )
+
+    def migrate_legacy_keys(self, namespaces=(), batch=10000):
+        """
+        Moves the keys of a namenode that kept them right under "nn:" to the default
+        namespace, once. Keys of the namespaces of a federation sharing the redis are
+        left alone. Refuses, with an IOError, when the default namespace already has
+        keys of its own too, so neither copy is lost.
+
+        :param name: namespaces
+        :param type: list
+            The namespaces of the federation, a key under one of them is never moved
+
+        :returns: int
+            The number of keys moved
+        """
+        if self.prefix != 'nn:{0}:'.format( default_namespace ):
+            return 0
+        legacy = []
+        for key in self.r_cache.scan_iter( match='nn:*', count=batch ):
+            key = _decode( key )
+            parts = key.split( ':' )
+            # a key of a namespace has its name after the namespace, one part more than a legacy key
+            if ( len( parts ) == 2 and parts[1] in legacy_keys or
+                 len( parts ) == 3 and parts[1] in legacy_id_keys and parts[2].isdigit() or
+                 len( parts ) == 3 and parts[1] == 'dn_blocks' and parts[1] not in namespaces ):
+                legacy.append( key )
+        if not legacy:
+            return 0
+        if self.r_cache.exists( self._key('txid') ):
+            raise IOError( "Redis has namenode keys under both nn: and {0}, move or delete one of them before starting".format( self.prefix ))
+        for start in range( 0, len( legacy ), batch ):
+            pipe = self.r_cache.pipeline( transaction=False )
+            for key in legacy[ start:start + batch ]:
+                pipe.renamenx( key, self.prefix + key[ len( 'nn:' ): ] )
+            pipe.execute()
+        return len( legacy )
+
+
+def split_path( path ):
+    """ Splits test\\data into its directory names """
+    return [ name for name in path.split( path_sep ) if name ]
+
+
+def _striping( policy, size ):
+    """ The striping of a file from its inode fields, None for a replicated file """
+    if policy is None:
+        return None
+    return {'policy': _decode( policy ), 'size': int( size )}
+
+
+def _decode( value ):
+    if isinstance( value, bytes ):
+        return value.decode('utf-8')
+    return value
+
+
+def _decode_all( values ):
+    return [ _decode(v) for v in values ]
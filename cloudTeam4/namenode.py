@@ -2,12 +2,17 @@ import boto3
 import os, math, sys, random
 from flask import Flask, request, jsonify
 from datetime import datetime
-from dateutil import parser
 import requests as r
-from datetime import timedelta
-import time, redis, json
+import time, redis, json, threading
 from botocore.exceptions import ClientError
-from connect import redis_host_nn
+from connect import redis_host_nn, namespace_id, namenode_for, namenodes, block_pool, block_pool_bits
+from metadata_store import MetadataStore, path_sep
+from block_allocator import BlockIdAllocator
+from liveness import Liveness, alive
+from placement import make_policy
+from edit_log import EditLog, SharedEditLog, Namespace, normalize
+from coordination import Leadership, SharedLock
+from erasure import ErasurePolicy, parse_policy, replicated
 
 """ 
 Namenode is the center piece. It keeps the directory tree 
@@ -31,47 +36,180 @@ bucket_name = 'hdfs-group4'
 # Number of Replicas 
 replica_count = 3
 
+# Picks the datanodes of each block, weighted by how full and how loaded they are or round_robin
+placement = make_policy( os.environ.get( 'SDFS_PLACEMENT', 'weighted' ) )
+
 # App 
 app = Flask("namenode")
 
 # Redis is an In-Memory but Persistent on Disk DB
 r_cache = redis.Redis(host=redis_host_nn,port=6379)
 
+# Files, directories and blocks are kept one key each in redis, under the namespace of this namenode when federated
+store = MetadataStore( r_cache, namespace_id )
+
+# Block ids come from a counter so a file gets all of its ids in one call, from the block pool of the namespace
+block_ids = BlockIdAllocator( r_cache, store.prefix + 'last_block_id', block_pool( namespace_id ), block_pool_bits )
+
+# Every namespace change is logged here before it is acknowledged, the namespace is rebuilt from it on restart.
+# The workers append to it in redis and the leader writes it to disk, see edit_log.py
+edit_log = SharedEditLog( r_cache, store.prefix )
+
+# Namespace changes of every worker reach redis and the edit log in the same order
+namespace_lock = SharedLock( r_cache, store.prefix + 'namespace_lock' )
+
+# The lease that makes one worker the leader, set by start()
+leadership = None
+
+# Seconds between loads of the heartbeats, states and stats of the datanodes by every worker
+cluster_refresh = 1.0
+
 # Listen for Heart Beats 
 @app.route("/hearbeat/", methods=["PUT"])
 def receive_hearbeat():
     """
-    Listen for heart beats from the datanodes and save the most recent heartbeat for each node
+    Listen for heart beats from the datanodes and save the most recent heartbeat for each node.
+    The heartbeat carries the disk and load of the datanode for block placement
+    { "id": "dn0", "capacity": 107374182400, "used": 5368709120, "active_transfers": 2, "rack": "r1" }
+
+    :returns: dict
+        register is True when the datanode is not in the membership table and has to register
+        {'message': "...", 'register': False}
     """
     response = request.data.decode('utf-8') 
-    print( response )
     if response:
         datanode_id = json.loads( response )
         dn = datanode_id['id']
-        dns = NodeAvailability
-        dns.update_heartbeat( dn )
-        heartbeats = dns.get_heartbeat()
-        add_to_memory( heartbeats, 'heartbeats')
-        return 'Received heartbeat from {0} on {1}'.format( dn , heartbeats[dn] )
+        if not store.is_member( dn ):
+            return {'message': "Datanode {0} is not registered".format( dn ), 'register': True}
+        update_datanode_stats( dn, datanode_id )
+        return {'message': 'Received heartbeat from {0} on {1}'.format( dn , datetime.now() ), 'register': False}
     else:
         return jsonify({"error": "ERROR: No heartbeat received" })
 
 
+# Listen for Datanodes joining
+@app.route("/register/", methods=["POST"])
+def register_datanode():
+    """
+    A datanode announces itself when it starts, or when a heartbeat tells it to.
+    It is added to the membership table that placement and clients look datanodes up in
+    { "id": "dn7", "address": "http://10.0.0.17:5000", "capacity": 107374182400, "used": 0, "rack": "r2" }
+
+    :returns: dict
+        {'message': "Registered dn7 at http://10.0.0.17:5000"}
+    """
+    response = request.data.decode('utf-8') 
+    if response:
+        info = json.loads( response )
+        dn, address = info.get('id'), info.get('address')
+        if not dn or not address:
+            return jsonify({"error": "ERROR: A datanode registers with its id and address" })
+        store.register_datanode( dn, { k: info[k] for k in ( 'address', 'rack', 'capacity' ) if k in info } )
+        update_datanode_stats( dn, info )
+        return {'message': "Registered {0} at {1}".format( dn, address )}
+    else:
+        return jsonify({"error": "ERROR: No registration received" })
+
+
+@app.route("/datanodes/", methods=["GET"])
+def list_datanodes():
+    """
+    The membership table, clients and datanodes resolve datanode addresses with it
+
+    :returns: dict
+        {'datanodes': {'dn0': {'address': "http://10.0.0.10:5000", 'rack': "r1", 'state': "alive"}}}
+    """
+    members, states = store.get_members(), store.get_datanode_states()
+    for dn, info in members.items():
+        info['state'] = states.get( dn )
+    return {'datanodes': members}
+
+
+@app.route("/replication/", methods=["GET"])
+def replication_status():
+    """
+    Queue depth and copies of the re-replication in the checker, refreshed every second
+
+    :returns: dict
+        {'queued': 120, 'queued_by_replicas': {'1': 20, '2': 100}, 'pending': 8, 'completed': 340, ...}
+        with the rebuilds of lost blocks of erasure coded files under 'rebuilds'
+    """
+    return store.get_replication_stats()
+
+
+def update_datanode_stats( dn, message ):
+    """
+    A heartbeat or registration goes to redis, where the leader times the datanode out and the other
+    workers load its disk and load for block placement. This worker places blocks with it right away
+    """
+    stats = { k: message[k] for k in ( 'capacity', 'used', 'active_transfers', 'rack' ) if k in message }
+    if stats:
+        placement.update( dn, stats )
+    store.heartbeat( dn, stats )
+
+
+# Listen for corrupt blocks
+@app.route('/bad_block/', methods=['POST'])
+def receive_bad_blocks():
+    """ 
+    A datanode reports blocks whose replica on it failed its checksums
+    { "id": "dn1", "blocks": [33, 34] }
+
+    The replica is dropped from the block list so the checker copies a good replica 
+    in its place. The last replica of a block is kept, a partly good block is better 
+    than none. A block of an erasure coded file is dropped too, the checker rebuilds
+    it from the rest of its group.
+
+    :returns: dict
+        The blocks the datanode should delete
+        {'delete': [33]}
+    """
+    response = request.data.decode('utf-8') 
+    if response:
+        report = json.loads( response )
+        dn = report['id']
+        locations = store.get_block_locations( report['blocks'] )
+        striped = store.get_striping( report['blocks'] )
+        delete = [ int( b ) for b, dns in locations.items() if dns and ( set( dns ) - { dn } or b in striped ) ]
+        kept = [ int( b ) for b, dns in locations.items() if dns is not None and int( b ) not in delete ]
+        store.remove_replica_everywhere( dn, delete )
+        if kept:
+            print( "Corrupt blocks {0} on {1} have no other replica".format( kept, dn ))
+        return { 'delete': delete }
+    else:
+        return jsonify({"error": "ERROR: No bad block report received" })
+
+
 # Listen for Block Reports
 @app.route('/block_report/', methods=['PUT'])
 def listen_for_block_report():
     """ 
-    Listen to the datanode for the block report and receives the id and blocks 
+    Listen to the datanode for the block report and receives the id and blocks.
+    A full report has every block on the datanode
+    { "id": "dn0", "block_data": [3, 4, 7] }
+    a delta only the blocks added and removed since its last acked report
+    { "id": "dn0", "added": [7], "removed": [5] }
+
+    The replica sets of only those blocks are changed in place.
+
+    :returns: dict
+        full_report is True when the namenode does not know the blocks of the datanode, 
+        because it is new, was dead or the namenode restarted, and the delta was not applied
+        {'message': "...", 'full_report': False}
     """
     response = request.data.decode('utf-8') 
     if response:
         datanode = json.loads( response )
         dn = datanode['id']
-        blocks_on_dn = datanode['block_data']
-        block_temp = get_from_memory('block_temp')
-        block_temp[dn] = blocks_on_dn
-        add_to_memory( block_temp, 'block_temp')
-        return "Received block report for {0} on datanode {1} ".format( blocks_on_dn, dn )
+        if 'block_data' in datanode:
+            added, removed = store.set_full_block_report( dn, datanode['block_data'] )
+            return {'message': "Received full block report of {0} blocks from datanode {1}, {2} added {3} removed".format( 
+                        len( datanode['block_data'] ), dn, added, removed ), 'full_report': False}
+        if not store.apply_block_delta( dn, datanode.get('added', []), datanode.get('removed', []) ):
+            return {'message': "Datanode {0} is not known, a full block report is needed".format( dn ), 'full_report': True}
+        return {'message': "Received block report from datanode {0}, added {1} removed {2}".format( 
+                    dn, datanode.get('added', []), datanode.get('removed', []) ), 'full_report': False}
     else:
         return jsonify({"error": "ERROR: No block report received" })
 
@@ -95,6 +233,10 @@ def identify_blocks():
     :param type: int
         The size of file
 
+    :param name: policy
+    :param type: str
+        Optional, an erasure coding policy like RS-6-3 or "replicated" instead of the policy of the directory
+
     :returns: dict
         The block count, block size, and identifying the number of blocks and associted datanodes
         {
@@ -107,6 +249,8 @@ def identify_blocks():
                 ]
             }
         }
+        An erasure coded file gets k + m blocks per group with one datanode each, and its striping
+        "striping": {"policy": "RS-6-3-1024k", "size": 1200}
     """
     try:
         response = request.data.decode('utf-8') 
@@ -116,19 +260,25 @@ def identify_blocks():
             directory = val['directory']
             size =  val['size']
 
-            if directory not in directories:
+            if not_owned( directory ):
+                return jsonify({"error": not_owned( directory )})
+            if not store.directory_exists( directory ):
                 return jsonify({"error": "ERROR: {0} not in directory. Use command mkdir.".format(directory)})
 
-            # Can only write a file that is not allready in the file system
-            file_dir = get_from_memory('file_dir')
-            if file_name not in file_dir: 
-                block_count = decide_number_of_blocks(size)
-                blocks_and_dns = decide_which_nodes( file_name, block_count, directory )
-            else:
-                return jsonify({"error": "ERROR: That file already exists in the system please delete it first: {0}".format( file_name ) })
+            # Can only write a file that is not allready in the directory
+            blocks_and_dns = None
+            policy = file_policy( directory, val.get('policy') )
+            if not store.file_exists( directory, file_name ):
+                block_count = count_blocks( size, policy )
+                blocks_and_dns = decide_which_nodes( file_name, block_count, directory, policy, size )
+            if blocks_and_dns is None:
+                return jsonify({"error": "ERROR: That file already exists in {0} please delete it first: {1}".format( directory, file_name ) })
     except Exception as a:
             return jsonify({"error": "ERROR: {0}".format( str(a) ) })
-    return {'block_count': "{0}".format(block_count), 'block_size': "{0}".format(block_size), 'blocks_and_dns': blocks_and_dns }
+    answer = {'block_count': "{0}".format(block_count), 'block_size': "{0}".format(block_size), 'blocks_and_dns': blocks_and_dns }
+    if policy:
+        answer['striping'] = striping_of( policy, size )
+    return answer
 
 
 
@@ -147,34 +297,32 @@ def send_block_names(directory, file_name):
         The name of the file that the client wants to read from datanodes
 
     :returns: dict
-        The blocks and the associated data nodes for the file
-        { "message": {"3": ["dn0", "dn2"]} }    
+        The blocks and the associated data nodes for the file, the size of every block but the last
+        and the generation of the file, which changes when the file is deleted and written again
+        { "message": {"3": ["dn0", "dn2"]}, "block_size": "13107200", "generation": "12" }    
+        An erasure coded file has its striping too, a lost block of it has no datanodes
+        { "message": {"3": ["dn0"], "4": []}, ..., "striping": {"policy": "RS-6-3-1024k", "size": 1200} }
     """
     try:
-        # lookup file directory with map between file and blocks
-        file_dir = get_from_memory('file_dir')
-        if file_name in file_dir:
-            blocks_and_dir =  file_dir[file_name]
-            if directory in blocks_and_dir:
-                blocks = blocks_and_dir[directory]
-                dn_for_file = dict()
-                block_list = get_from_memory('block_list')
-
-                # for each block add the list of data nodes it resides on to the dict
-                for b in blocks:
-                    b = str(b)
-                    if b in block_list:
-                        dn_list = block_list[b]
-                        dn_for_file.setdefault( b, [] ).extend( dn_list )
-                    else:
-                        # blocks associated w/ file not found in block list
-                        error = "block list: {0}  missing: {1}".format( block_list , b )
-                        return jsonify({"error": "ERROR: Blocks are missing - {0}".format( error )})
-                return { 'message': dn_for_file }
-            else:
-                return jsonify({"error": "ERROR: The file is not in that directory."})
-        else:
+        # resolve the directory and look up the blocks of the file in it
+        found = store.get_files( [ ( directory, file_name ) ] )[0]
+        if found is not None:
+            generation, blocks, striping = found
+            # for each block add the list of data nodes it resides on to the dict
+            dn_for_file = store.get_block_locations( blocks )
+            missing = [ b for b, dns in dn_for_file.items() if dns is None ]
+            if missing:
+                # blocks associated w/ file not found in block list
+                error = "file blocks: {0}  missing: {1}".format( blocks , missing )
+                return jsonify({"error": "ERROR: Blocks are missing - {0}".format( error )})
+            answer = { 'message': dn_for_file, 'block_size': "{0}".format(block_size), 'generation': "{0}".format(generation) }
+            if striping:
+                answer['striping'] = striping
+            return answer
+        elif store.directory_exists( directory ):
             return jsonify({"error": "ERROR: That file could not be found - file: {0}".format( file_name ) })
+        else:
+            return jsonify({"error": "ERROR: The directory {0} does not exist.".format( directory ) })
     except Exception as a:
         return jsonify({"error": str(a) })
 
@@ -199,23 +347,154 @@ def delete_file(directory, file_name):
         { "blocks_and_dns": "{'4': ['dn0', 'dn1'], '5': ['dn1', 'dn2']}"}
     """
     try:
-        file_dir = get_from_memory('file_dir')
-        if file_name in file_dir:
-            blocks_and_dir =  file_dir[file_name]
-            if directory in blocks_and_dir:
-                blocks = blocks_and_dir[directory]
-                blocks_and_dns = delete_from_block_list( blocks )
-                delete_from_file_dir( file_name )
-                return {'blocks_and_dns': blocks_and_dns }
-            else:
-                return jsonify({"error": "ERROR: That file is not in that directory."})
-
+        blocks_and_dns = change_namespace( lambda: store.delete_file( file_name, directory ), lambda done: done is not None,
+                                           'delete', directory=directory, name=file_name )
+        if blocks_and_dns is not None:
+            return {'blocks_and_dns': blocks_and_dns }
         else:
-            return jsonify({"error": "ERROR: That file could not be found - file: {0}  current files: {1}".format( file_name, file_dir ) })
+            return jsonify({"error": "ERROR: That file could not be found in {0} - file: {1}".format( directory, file_name ) })
     except Exception as a:
         return jsonify({"error": "Unkown"})
 
 
+@app.route('/files/', methods =['POST'])
+def identify_blocks_batch():
+    """
+    Name node is asked by Client to write many files at once, every file gets its blocks
+    like /file/ but the namespace is loaded and changed once for the whole batch
+    /files/
+
+    # Payload
+    :param name: files
+    :param type: list
+        [ {"directory": "test", "file_name": "a.txt", "size": 1200} ]
+
+    :returns: dict
+        One result per file in order, an error or what /file/ returns
+        {'results': [ {'block_count': "1", 'block_size': "13107200", 'blocks_and_dns': {"7": ["dn0", "dn1"]}},
+                      {'error': "ERROR: ..."} ]}
+    """
+    try:
+        files = json.loads( request.data.decode('utf-8') )['files']
+        results = [ None ] * len( files )
+        policies = []
+        for f in files:
+            try:
+                policies.append( file_policy( f['directory'], f.get('policy') ) )
+            except ValueError as a:
+                policies.append( a )
+        counts = [ 0 if isinstance( p, ValueError ) else count_blocks( f['size'], p ) for f, p in zip( files, policies ) ]
+        # every block id of the batch in one call
+        next_ids = iter( block_ids.reserve( sum( counts ) ) )
+        planned = []
+        for i, ( f, count, policy ) in enumerate( zip( files, counts, policies ) ):
+            ids = [ next( next_ids ) for _ in range( count ) ]
+            if isinstance( policy, ValueError ):
+                results[i] = {"error": "ERROR: {0}".format( policy )}
+                continue
+            if not_owned( f['directory'] ):
+                results[i] = {"error": not_owned( f['directory'] )}
+                continue
+            try:
+                blocks_and_dns = place_blocks( ids, policy )
+            except IOError as a:
+                results[i] = {"error": "ERROR: {0}".format( a )}
+                continue
+            if not all( blocks_and_dns.values() ):
+                results[i] = {"error": "ERROR: No datanode is available for {0}".format( f['file_name'] )}
+                continue
+            planned.append( ( i, blocks_and_dns, striping_of( policy, f['size'] ) ) )
+        created = change_namespace_batch(
+            lambda: store.create_files( [ ( files[i]['file_name'], files[i]['directory'], plan, striping ) for i, plan, striping in planned ] ),
+            lambda done: [ ( 'create', create_edit( files[i]['directory'], files[i]['file_name'], plan, striping ) )
+                           for ( i, plan, striping ), ok in zip( planned, done ) if ok ] )
+        for ( i, blocks_and_dns, striping ), ok in zip( planned, created ):
+            f = files[i]
+            if ok:
+                results[i] = {'block_count': "{0}".format( len( blocks_and_dns ) ), 'block_size': "{0}".format( block_size ),
+                              'blocks_and_dns': blocks_and_dns}
+                if striping:
+                    results[i]['striping'] = striping
+            elif ok is None:
+                results[i] = {"error": "ERROR: {0} not in directory. Use command mkdir.".format( f['directory'] )}
+            else:
+                results[i] = {"error": "ERROR: That file already exists in {0} please delete it first: {1}".format( f['directory'], f['file_name'] )}
+        return {'results': results}
+    except Exception as a:
+        return jsonify({"error": "ERROR: {0}".format( str(a) ) })
+
+
+@app.route('/files/lookup/', methods =['POST'])
+def send_block_names_batch():
+    """
+    Name node is asked by Client to read many files, every file gets its blocks and
+    datanodes like GET /file/ with one lookup for the whole batch
+    /files/lookup/
+
+    # Payload
+    :param name: files
+    :param type: list
+        [ {"directory": "test", "file_name": "a.txt"} ]
+
+    :returns: dict
+        One result per file in order, an error or the blocks and the associated data nodes
+        {'results': [ {'message': {"3": ["dn0", "dn2"]}, 'generation': "12"}, {'error': "ERROR: ..."} ], 'block_size': "13107200"}
+    """
+    try:
+        files = json.loads( request.data.decode('utf-8') )['files']
+        found = store.get_files( [ ( f['directory'], f['file_name'] ) for f in files ] )
+        locations = store.get_block_locations( [ b for entry in found if entry for b in entry[1] ] )
+        results = []
+        for f, entry in zip( files, found ):
+            if entry is None:
+                results.append({"error": "ERROR: That file could not be found in {0} - file: {1}".format( f['directory'], f['file_name'] )})
+                continue
+            generation, blocks, striping = entry
+            dn_for_file = { str(b): locations[str(b)] for b in blocks }
+            missing = [ b for b, dns in dn_for_file.items() if dns is None ]
+            if missing:
+                results.append({"error": "ERROR: Blocks are missing - file blocks: {0}  missing: {1}".format( blocks, missing )})
+            else:
+                results.append( dict( {'message': dn_for_file, 'generation': "{0}".format( generation )},
+                                      **( {'striping': striping} if striping else {} ) ) )
+        return {'results': results, 'block_size': "{0}".format( block_size )}
+    except Exception as a:
+        return jsonify({"error": "ERROR: {0}".format( str(a) ) })
+
+
+@app.route('/files/', methods =['DELETE'])
+def delete_files():
+    """
+    Name node is asked by client to delete many files, every file answers with its
+    blocks and datanodes like DELETE /file/ and the namespace is changed once
+    /files/
+
+    # Payload
+    :param name: files
+    :param type: list
+        [ {"directory": "test", "file_name": "a.txt"} ]
+
+    :returns: dict
+        One result per file in order
+        {'results': [ {'blocks_and_dns': {'4': ['dn0', 'dn1']}}, {'error': "ERROR: ..."} ]}
+    """
+    try:
+        files = json.loads( request.data.decode('utf-8') )['files']
+        deleted = change_namespace_batch(
+            lambda: store.delete_files( [ ( f['directory'], f['file_name'] ) for f in files ] ),
+            lambda done: [ ( 'delete', {'directory': f['directory'], 'name': f['file_name']} )
+                           for f, blocks in zip( files, done ) if blocks is not None ] )
+        results = []
+        for f, blocks_and_dns in zip( files, deleted ):
+            if blocks_and_dns is None:
+                results.append({"error": "ERROR: That file could not be found in {0} - file: {1}".format( f['directory'], f['file_name'] )})
+            else:
+                results.append({'blocks_and_dns': blocks_and_dns})
+        return {'results': results}
+    except Exception as a:
+        return jsonify({"error": "ERROR: {0}".format( str(a) ) })
+
+
 @app.route('/directories/sub_dir/', methods =['DELETE'])
 def delete_sub():
     try: 
@@ -224,19 +503,14 @@ def delete_sub():
         parent = val['parent']
         sub_directory = val['sub_directory']
 
-        dirs = get_from_memory('file_dir')
-        key = "dir " + sub_directory
-        if key in dirs:
-            subs_and_dir = dirs[key]
-            if parent in subs_and_dir:
-                delete_from_file_dir( key )
-                path = parent + "\\" + sub_directory
-                directories.remove( path )
-                return {'message': "NameNode Sub_directory {0} deleted".format(sub_directory)}
-            else:
-                return jsonify({"error": "ERROR: That sub_directory is not in that directory."})
+        path = parent + path_sep + sub_directory
+        current_dir = change_namespace( lambda: store.remove_directory( path ), lambda done: done == [], 'rmdir', path=path )
+        if current_dir is None:
+            return jsonify({"error": "ERROR: That sub_directory is not in that directory."})
+        elif current_dir:
+            return jsonify({"error": "ERROR: The {0} sub_directory is Not Empty. It currently contains {1}".format( sub_directory, current_dir )})
         else:
-            return jsonify({"error": "ERROR: That file could not be found - file: {0}  current files: {1}".format( sub_directory, dirs ) })
+            return {'message': "NameNode Sub_directory {0} deleted".format(sub_directory)}
     except Exception as a:
         return jsonify({"error": "ERROR: {0}".format( a )})
 
@@ -259,40 +533,23 @@ def delete_directories():
         val = json.loads( response )
         directory = val['directory']
 
-        # Delete directory only if it exits
-        if directory in directories:
-            # Check if the directory is empty
-            file_dir = get_from_memory('file_dir')
-            current_dir = []
-            for file_name, dir_and_blocks in file_dir.items():
-                dirs = dir_and_blocks.keys()
-                for d in dirs:
-                    if d == directory:
-                        current_dir.append( file_name )
-            if len( current_dir ) > 0 :
-                return { 'error': "ERROR: The {0} directory is Not Empty. It currently contains {1}".format( directory, current_dir ) }
-            else:
-                directories.remove(directory)
-                path = directory.split("\\")
-                last_dir = path.pop()
-                dirs = get_from_memory('file_dir')
-                key = "dir " + last_dir
-                if key in dirs:
-                    delete_from_file_dir( key )
-                return { 'message': "Directory {0} removed successfully, with path .".format( key, directory ) }
+        # Delete directory only if it exits and is empty
+        current_dir = change_namespace( lambda: store.remove_directory( directory ), lambda done: done == [], 'rmdir', path=directory )
+        if current_dir is None:
+            return jsonify({"error": "ERROR: The directory {0} does not exist.".format( directory ) })
+        elif len( current_dir ) > 0 :
+            return { 'error': "ERROR: The {0} directory is Not Empty. It currently contains {1}".format( directory, current_dir ) }
         else:
-            return jsonify({"error": "ERROR: The directory {0} does not exist.  Current directories are {1}".format( directory, directories ) })
+            last_dir = directory.split( path_sep ).pop()
+            return { 'message': "Directory {0} removed successfully, with path {1}.".format( last_dir, directory ) }
     else:
         return { 'error': "ERROR: No response." }
 
 
 def get_data_nodes_for_blocks( blocks ):
-    block_list = get_from_memory('block_list')
     dns_with_blocks = set()
-    for b in blocks:
-        b = str(b)
-        if b in block_list:
-            dns = block_list[b]
+    for dns in store.get_block_locations( blocks ).values():
+        if dns:
             dns_with_blocks |= set(dns)
     return list(dns_with_blocks)
 
@@ -309,25 +566,10 @@ def make_directories(directory):
     :returns:  dict
         {'message' : 'Made directory'}
     """
-    if directory not in directories:
-        path = directory.split("\\")
-
-        # Add to directories
-        sub = ""
-        for d in range( len(path) ):
-            if len(sub) > 0:
-                sub += "\\" +  path[d]
-            else:
-                sub = path[d]
-            directories.append(sub)
-
-        # Add to file dir
-        file_dir = get_from_memory('file_dir')
-        parent = path.pop(0)
-        subs = "dir " + '\\'.join(path)
-        if subs not in file_dir:
-            add_sub_to_file_dir(subs, parent)
-
+    if not_owned( directory ):
+        return { 'error': not_owned( directory ) }
+    # Makes each missing level of the path
+    if change_namespace( lambda: store.make_directories( directory ), bool, 'mkdir', path=directory ):
         return { 'message': "Made directory {0}".format( directory ) }
     else:
         return { 'error': "ERROR: The {0} directory allready exists.".format( directory ) }
@@ -350,25 +592,48 @@ def make_sub_directory(parent, directory):
     :returns:  dict
         {'message' : 'Made directory'}
     """
-    if parent not in directories:
-        directories.append(parent)
-    path = parent + '\\' + directory 
-    if path not in directories:
-        directories.append(path)
-    file_dir = get_from_memory('file_dir')
-    if path not in file_dir:
-        directory = "dir " + directory
-        add_sub_to_file_dir(directory, parent)
+    path = parent + path_sep + directory 
+    if not_owned( path ):
+        return { 'error': not_owned( path ) }
+    if change_namespace( lambda: store.make_directories( path ), bool, 'mkdir', path=path ):
         return { 'message': "Made sub directory {0}".format( path ) }
     else:
         return { 'error': "ERROR: The {0} directory allready exists.".format( path ) }
 
     
 
+@app.route('/directories/policy/', methods =['PUT'])
+def set_directory_policy():
+    """
+    Name node sets the erasure coding policy of a directory. New files in it and in its
+    sub directories without a policy of their own are erasure coded, files already written
+    keep their layout. "replicated" replicates the files under an erasure coded parent
+    again and no policy takes the policy of the directory off.
+
+    # Payload
+    { "directory": "test\\cold", "policy": "RS-6-3" }
+
+    :returns: dict
+        {'message': "Policy of test\\cold is RS-6-3-1024k"}
+    """
+    try:
+        val = json.loads( request.data.decode('utf-8') )
+        directory, policy = val['directory'], val.get('policy') or None
+        if not_owned( directory ):
+            return jsonify({"error": not_owned( directory )})
+        if policy and policy != replicated:
+            policy = ErasurePolicy( policy ).name
+        if not change_namespace( lambda: store.set_policy( directory, policy ), bool, 'setpolicy', path=directory, policy=policy ):
+            return jsonify({"error": "ERROR: The directory {0} does not exist.".format( directory ) })
+        return {'message': "Policy of {0} is {1}".format( directory, policy or "the policy of its parent" )}
+    except Exception as a:
+        return jsonify({"error": "ERROR: {0}".format( a )})
+
+
 @app.route('/directories/', methods =['POST'])
 def get_directories():
     """
-    Name node lists all the files of the specified directory
+    Name node lists the sub directories and files of the specified directory
     
     # Payload
     :param name: directory 
@@ -376,7 +641,7 @@ def get_directories():
         The name of the directory
 
     :returns:  dict
-        {'message' : 'DIR: name  -- files'}
+        {'message' : 'DIR: name  -- sub\\  -- files'}
     """
     pretty_print = ""
     response = request.data.decode('utf-8') 
@@ -384,40 +649,21 @@ def get_directories():
         val = json.loads( response )
         directory = val['directory']
 
-        file_dir = get_from_memory('file_dir')
-        pretty_dir = {} 
-        for file_name, dir_and_blocks in file_dir.items():
-            dirs = dir_and_blocks.keys()
-            for d in dirs:
-                if d == directory:
-                    pretty_dir.setdefault( d, [] ).append( file_name )
-        
-        for d , files in pretty_dir.items():
-            pretty_print += "DIR: {0}\n".format( d) 
-            for f in files:
-                pretty_print += "  -- {0}\n".format( f )
+        listing = store.list_directory( directory )
+        if listing is None:
+            return { 'error': "ERROR: The directory {0} does not exist.".format( directory ) }
+        sub_dirs, files = listing
+        pretty_print += "DIR: {0}\n".format( directory ) 
+        policy = store.get_policy( directory )
+        if policy:
+            pretty_print += "POLICY: {0}\n".format( policy )
+        for d in sub_dirs:
+            pretty_print += "  -- {0}{1}\n".format( d, path_sep )
+        for f in files:
+            pretty_print += "  -- {0}\n".format( f )
     return { "message" : pretty_print }
 
 
-def delete_from_block_list(blocks_to_delete):
-    """ Deletes from block list and returns list of blocks and datanodes for client"""
-    block_list = get_from_memory( 'block_list')
-    send_to_client = {}
-    for b in blocks_to_delete:
-        key = str(b)
-        if key in block_list:
-            send_to_client[key] = block_list[key]
-            del block_list[key]
-    add_to_memory( block_list, 'block_list' )
-    return send_to_client
-
-
-def delete_from_file_dir( file_name ):
-    file_dir_l = get_from_memory( 'file_dir')
-    del file_dir_l[file_name]
-    add_to_memory( file_dir_l, 'file_dir' )
-
-
 @app.route('/', methods =['GET'])
 def endpoint_test():
     return "True"
@@ -425,9 +671,7 @@ def endpoint_test():
 
 @app.route('/variables/', methods =['GET'])
 def endpoint_variables():
-    block_list_l = get_from_memory('block_list')
-    file_dir_l = get_from_memory('file_dir')
-    return {'file_dir': file_dir_l, 'block_list': block_list_l , 'directories': directories }
+    return store.dump()
 
 
 def decide_number_of_blocks( size ):
@@ -438,102 +682,194 @@ def decide_number_of_blocks( size ):
     return block_num
     
     
-def add_to_block_list( blocks_and_dns ):
-    block_list = get_from_memory('block_list')
-    for b, dns in blocks_and_dns.items():
-        block =  int(b)
-        if b in block_list:
-            for dn in dns:
-                if dn not in block_list[b]:
-                    block_list[b].append( dn )
-        else:
-            block_list.setdefault( block, dns )
-    add_to_memory( block_list, 'block_list')
+def count_blocks( size, policy=None ):
+    """ Block ids a file of size bytes needs, k + m for every block group of an erasure coded file """
+    if policy is None:
+        return decide_number_of_blocks( size )
+    return math.ceil( size / policy.group_bytes( block_size ) ) * policy.width
 
 
-def add_to_file_dir( file_name, blocks, directory ):
-    """ Adds a given file and list of blocks to file_dir """
-    # Does not add if the file is allready in the file system
-    file_dir_l = get_from_memory('file_dir')
-    if directory not in directories:
-        directories.append( directory )
+def decide_which_nodes( file_name, block_count, directory, policy=None, size=0 ):
+    """
+    Decide which nodes get the file based on number of blocks
+    , the available nodes, and a range of unused block ids
+    """    
+    # Reserve a block id that has not been used for every block at once
+    blocks_and_dns = place_blocks( block_ids.reserve( block_count ), policy )
+    if not all( blocks_and_dns.values() ):
+        raise IOError( "No datanode is available" )
+    print( blocks_and_dns )
+    striping = striping_of( policy, size )
+    # add the file and its blocks in one round trip, None if another writer got there first
+    if not change_namespace( lambda: store.create_file( file_name, directory, blocks_and_dns, striping ), bool, 'create',
+                             **create_edit( directory, file_name, blocks_and_dns, striping ) ):
+        return None
+    return blocks_and_dns
 
-    if file_name not in file_dir_l:
-        file_dir_l[file_name] = { directory: blocks }
-        add_to_memory( file_dir_l, 'file_dir' )
 
-def add_sub_to_file_dir(sub_directory, directory):
-    """ Adds a given sub_directory and list of blocks to file_dir """
-    file_dir_l = get_from_memory('file_dir')
-    if sub_directory not in file_dir_l:
-        file_dir_l[sub_directory] = {directory: sub_directory}
-        add_to_memory(file_dir_l, 'file_dir')
+def place_blocks( ids, policy=None ):
+    """
+    Picks the datanodes of new blocks, distinct available datanodes for the replicas of each block,
+    or for an erasure coded file one datanode per block with every block of a group on a different one
 
-def decide_which_nodes( file_name, block_count, directory ):
+    :returns: dict
+        < key: block id, val: list of datanodes >
     """
-    Decide which nodes get the file based on number of blocks
-    , the available nodes, and the next block id available
-    """    
+    if policy is None:
+        return { b: choose_datanodes( replica_count ) for b in ids }
+    ids = list( ids )
     blocks_and_dns = {}
-    all_blocks_for_file = []
-    for b in range(block_count):
-        replicas = []
-        # Get an available datanode replica for each block
-        for i in range(replica_count):
-            next_dn = get_next_available_dn()
-            replicas.append(next_dn)
-        # Get next available block id that has not been used
-        next_block_id = b  + get_next_block_id() 
-        all_blocks_for_file.append( next_block_id )
-
-        blocks_and_dns.update( { next_block_id : replicas })
-        print( blocks_and_dns )
-    # update local block list and file dir
-    add_to_block_list( blocks_and_dns )
-    add_to_file_dir( file_name, all_blocks_for_file, directory )
+    for start in range( 0, len( ids ), policy.width ):
+        nodes = choose_datanodes( policy.width )
+        if len( nodes ) < policy.width:
+            raise IOError( "Policy {0} needs {1} datanodes, {2} are available".format( policy.name, policy.width, len( nodes ) ) )
+        blocks_and_dns.update( { b: [ dn ] for b, dn in zip( ids[start:start + policy.width], nodes ) } )
     return blocks_and_dns
 
 
-def get_next_available_dn():
-    """ Get the next available node based on heartbeats """
-    next_dn = NodeAvailability.get_next_node()
-    return next_dn
+def file_policy( directory, requested=None ):
+    """ The erasure coding policy of a new file, the one asked for or else the directory's, None to replicate it """
+    return parse_policy( requested if requested is not None else store.get_policy( directory ) )
 
 
-def get_next_block_id():
-    """ Return next block id not used """
-    block_list = get_from_memory( 'block_list' )
-    if len(block_list) > 0:
-        max_block_id = int(max(block_list, key=int))
-        max_block_id += 1
-        return max_block_id
-    else:
-        return 1
+def striping_of( policy, size ):
+    """ What is kept about the layout of an erasure coded file, None for a replicated one """
+    return {'policy': policy.name, 'size': size} if policy else None
 
 
-def add_to_memory( obj, var_name ):
-    values = json.dumps( obj )
-    r_cache.set( var_name, values )
+def create_edit( directory, file_name, blocks_and_dns, striping ):
+    """ Arguments of the create edit of a file """
+    args = {'directory': directory, 'name': file_name, 'blocks': list( blocks_and_dns.items() )}
+    if striping:
+        args['striping'] = striping
+    return args
 
 
-def get_from_memory( var_name ):
-    cached_data =  r_cache.get(var_name)
-    try:
-        cached_data_as_dict = json.loads( cached_data )
-    except TypeError:
-        print('\n\n\n\n\n\n\n\n')
-        print(cached_data)
-        raise
-    return cached_data_as_dict
+def change_namespace( change, done, op, **args ):
+    """
+    Makes a change to the namespace in redis and, if done says it took effect, logs it as an edit.
+    Returns what change returned once the edit is on disk
+
+    :param name: change
+    :param type: function
+        Makes the change through the store
+
+    :param name: done
+    :param type: function
+        done( result of change ) is True if the namespace changed
+    """
+    with namespace_lock:
+        result = change()
+        if not done( result ):
+            return result
+        # the txid in redis moves with the append
+        txid = edit_log.append( op, **args )
+    # many requests share one sync of the log
+    edit_log.sync( txid )
+    return result
+
+
+def change_namespace_batch( change, edits ):
+    """
+    Like change_namespace for many changes made by one call, the edits are synced together
+
+    :param name: edits
+    :param type: function
+        edits( result of change ) returns [ ( op, args ) ] of the changes that took effect
+    """
+    txid = None
+    with namespace_lock:
+        result = change()
+        changes = list( edits( result ) )
+        if changes:
+            txid = edit_log.append_all( changes )
+    if txid is not None:
+        edit_log.sync( txid )
+    return result
+
+
+def not_owned( path ):
+    """ The error for a path that another namenode of the federation owns, None if this namenode owns it """
+    owner = namenode_for( path )
+    if namespace_id is None or owner == namespace_id:
+        return None
+    return "ERROR: {0} belongs to namespace {1}, not {2}".format( path, owner, namespace_id )
+
+
+def choose_datanodes( count, exclude=() ):
+    """ Returns up to count distinct alive datanodes that are not in exclude, picked by the placement policy """
+    nodes = [ dn for dn, avail in NodeAvailability.data_nodes.items() if avail ]
+    return placement.choose( nodes, count, block_size, exclude )
+
+
+def replay_edit( record ):
+    """ Applies one edit of the log to redis through the store """
+    op = record['op']
+    if op == 'mkdir':
+        store.make_directories( record['path'] )
+    elif op == 'rmdir':
+        store.remove_directory( record['path'] )
+    elif op == 'create':
+        store.create_file( record['name'], record['directory'], { int( b ): dns for b, dns in record['blocks'] }, record.get( 'striping' ) )
+    elif op == 'delete':
+        store.delete_file( record['name'], record['directory'] )
+    elif op == 'setpolicy':
+        store.set_policy( record['path'], record['policy'] )
+    store.set_txid( record['txid'] )
+
+
+def recover_namespace( log ):
+    """
+    Brings the namespace in redis up to the edit log the leader opened. If redis kept its data up to
+    an edit after the newest image only the edits it missed are replayed, otherwise
+    it is rebuilt from the newest image and the edits after it. A log that is still
+    empty starts with an image of what redis has.
+    """
+    start = time.monotonic()
+    redis_txid, log_txid = store.get_txid(), log.last_txid
+    if log.is_empty():
+        namespace = Namespace()
+        namespace.txid, namespace.last_block_id = redis_txid, block_ids.last_reserved()
+        for kind, path, blocks, layout in store.walk():
+            if kind == 'd':
+                namespace.dirs.add( path )
+                if layout:
+                    namespace.policies[path] = layout
+            else:
+                directory, _, name = path.rpartition( path_sep )
+                namespace.files[ ( normalize( directory ), name ) ] = blocks
+                if layout:
+                    namespace.striped[ ( normalize( directory ), name ) ] = layout
+        if namespace.txid or namespace.dirs or namespace.files:
+            log.write_image( namespace )
+        print( "Edit log starts at txid {0} with {1} directories and {2} files from redis".format(
+            namespace.txid, len( namespace.dirs ), len( namespace.files ) ))
+        return
+    if redis_txid == log_txid:
+        print( "Namespace in redis is at txid {0}, nothing to replay".format( log_txid ))
+        return
+    if log.image_txid <= redis_txid < log_txid:
+        try:
+            for record in log.read_edits( redis_txid ):
+                replay_edit( record )
+                block_ids.advance_to( max( [ 0 ] + [ int( b ) for b, _ in record.get( 'blocks', [] ) ] ) )
+            print( "Replayed edits {0} to {1} in {2:.2f} s".format( redis_txid + 1, log_txid, time.monotonic() - start ))
+            return
+        except IOError as a:
+            print( "Could not replay the edits after {0}, restoring the image: {1}".format( redis_txid, a ))
+    namespace = log.load_namespace()
+    last_block_id = max( namespace.last_block_id, block_ids.last_reserved() )
+    store.restore( sorted( namespace.dirs, key=lambda p: ( p.count( path_sep ), p ) ), namespace.files, namespace.txid,
+                   namespace.policies, namespace.striped )
+    block_ids.advance_to( last_block_id )
+    print( "Restored {0} directories and {1} files at txid {2} in {3:.2f} s".format(
+        len( namespace.dirs ), len( namespace.files ), namespace.txid, time.monotonic() - start ))
 
 
 class NodeAvailability:
-    """ Knows the next node and available nodes """
-    # Available data nodes < key: datanode name, val: available T or F >
-    data_nodes = {'dn0':True, 'dn1':True, 'dn2':True }
-    next_node = 0
-    heartbeats = {}
-    time_past_heartbeat = 30
+    """ Knows the next node and available nodes, kept up to date by datanode state changes """
+    # Available data nodes < key: datanode name, val: available T or F >, registered datanodes join as they heartbeat
+    data_nodes = {}
     _instance = None
 
     def __new__(cls):
@@ -542,63 +878,105 @@ class NodeAvailability:
             cls._instance = super(NodeAvailability, cls).__new__(cls)
         return cls._instance
 
-    def get_next_node():
-        # Check availability based on heartbeats
-        NodeAvailability.check_node_avail()
-        dn = NodeAvailability.next_node_itr()
-        avail = NodeAvailability.data_nodes[dn]
-        while not avail:
-            dn = NodeAvailability.next_node_itr()
-            avail = NodeAvailability.data_nodes[dn]
-        return dn
-
-    def next_node_itr():
-        if NodeAvailability.next_node == len( NodeAvailability.data_nodes ) - 1:
-            NodeAvailability.next_node = 0
-        else:
-            NodeAvailability.next_node += 1
-        return 'dn'+ str(NodeAvailability.next_node)
+    def update_state( datanode_id, state ):
+        NodeAvailability.data_nodes.update( {datanode_id: state == alive} )
+
+
+def datanode_state_changed( datanode_id, old, new ):
+    """ New blocks only go to alive nodes, the checker hears about the change through the store """
+    print( "Data node {0} is {1}".format( datanode_id, new ))
+    NodeAvailability.update_state( datanode_id, new )
+    store.set_datanode_state( datanode_id, new )
 
-    def update_heartbeat( datanode_id ):
-        NodeAvailability.heartbeats.update( {datanode_id: str(datetime.now())} )
-    
-    def check_node_avail():
-        for k, v in NodeAvailability.heartbeats.items():
-            cur_time = datetime.now()
-            prev_time = parser.parse(v)
-            time_passed =  cur_time - prev_time
-            # Have not heard from node for over 30 sec
-            if time_passed > timedelta(seconds=NodeAvailability.time_past_heartbeat):
-                # Mark as Unavailable
-                NodeAvailability.data_nodes.update( {k: False } )
-            else:
-                NodeAvailability.data_nodes.update( {k: True } )
 
-    def get_heartbeat():
-        NodeAvailability.check_node_avail()
-        return NodeAvailability.heartbeats
+# Heartbeats move datanodes between alive, stale and dead, the timer wheel runs in the leader
+liveness = Liveness()
+liveness.subscribe( datanode_state_changed )
 
 
-# Block List < key: block number, val: list of data node numbers >
-block_list = dict()
+def watch_cluster():
+    """
+    Every worker loads the states and stats of the datanodes, the heartbeats any worker received
+    go to the liveness of the leader. A heartbeat older than a few ticks already is left out,
+    its timer would land in a slot the wheel has passed
+    """
+    seen = {}
+    while True:
+        try:
+            heartbeats, states = store.get_heartbeats(), store.get_datanode_states()
+            for dn, stats in store.get_datanode_stats().items():
+                placement.update( dn, stats )
+            for dn, state in states.items():
+                NodeAvailability.update_state( dn, state )
+            if leadership is not None and leadership.is_leader:
+                now, wall = time.monotonic(), time.time()
+                for dn, heard in heartbeats.items():
+                    age = wall - heard
+                    if seen.get( dn ) != heard and age < liveness.stale_after - 2 * liveness.tick:
+                        liveness.heartbeat( dn, now - max( age, 0 ) )
+            seen = heartbeats
+        except Exception as a:
+            print( "Cluster watch ERROR: {0}".format( a ))
+        time.sleep( cluster_refresh )
+
+
+def lead():
+    """
+    Runs in the worker that became the leader. It opens the edit log, which repairs the newest
+    segment, writes the edits an old leader left in redis and brings the namespace up to the log.
+    The other workers serve requests once it is recovered.
+    """
+    log = EditLog( os.environ.get( 'SDFS_META_DIR', 'namenode_meta' ),
+                   checkpoint_edits=int( os.environ.get( 'SDFS_CHECKPOINT_EDITS', 100000 ) ),
+                   checkpoint_interval=int( os.environ.get( 'SDFS_CHECKPOINT_INTERVAL', 3600 ) ) )
+    log.start()
+    with namespace_lock:
+        # Keys written before the namenode had a namespace of its own move to it once
+        moved = store.migrate_legacy_keys( namenodes() )
+        if moved:
+            print( "Moved {0} keys of the namenode under {1}".format( moved, store.prefix ))
+
+        # Load the namespace from the edit log, block locations come back with the datanodes' full reports
+        edit_log.lead( log )
+        recover_namespace( log )
+        edit_log.publish_synced()
+    edit_log.start_writer()
 
-# Temp data from Block Reports, this updates the block list periodically
-block_temp = dict()
+    # Registered datanodes are taken to be alive until they miss their heartbeats
+    for member in store.get_members():
+        liveness.heartbeat( member )
+    liveness.start()
 
-# File Directory  < key: file_name, val: list of block numbers >
-file_dir = dict()
 
-# Directories 
-directories = []
+def lost_leadership():
+    """ Another worker may write the edit log now, this one stops and gunicorn starts a new worker """
+    print( "Worker {0} lost the leader lease, stopping".format( os.getpid() ))
+    os._exit( 1 )
 
-# Initial heartbeats
-heartbeats = {}
 
-add_to_memory( block_list, 'block_list')
-add_to_memory( block_temp, 'block_temp')
-add_to_memory( file_dir, 'file_dir' )
-add_to_memory( heartbeats, 'heartbeats')
+def prepare():
+    """ Called once before the workers start, they wait for a leader of this start to recover the namespace """
+    edit_log.reset()
+    r_cache.delete( store.prefix + 'leader' )
+
+
+def start():
+    """
+    Starts a worker of the namenode. One worker is elected the leader, writes the edit log and
+    times out datanodes. The checker imports this module too and must neither open the edit log,
+    which truncates a torn last edit while the leader may be appending to it, nor time out datanodes.
+    """
+    global leadership
+    edit_log.start()
+    leadership = Leadership( r_cache, store.prefix + 'leader', lead, lost_leadership ).start()
+    threading.Thread( target=watch_cluster, daemon=True ).start()
+    # requests wait for the namespace the leader recovers
+    while not edit_log.ready():
+        time.sleep( 0.1 )
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0',port=4000,debug=True)
+    # for development only, the namenode is served by gunicorn -c gunicorn.conf.py namenode:app
+    prepare()
+    start()
+    app.run(host='0.0.0.0',port=4000,threaded=True)
@@ -0,0 +1,136 @@
+import threading
+
+"""
+Block placement policies for the namenode. A policy is given the datanodes
+that are alive with the stats of their last heartbeat and picks distinct
+nodes for the replicas of a block.
+
+Heartbeat stats of a datanode
+    {'capacity': bytes of its disk, 'used': bytes used, 'active_transfers': 2, 'rack': 'r1'}
+
+A node that has not sent its stats yet is treated like an average node. No
+policy places a block on a node that has no room left for it.
+"""
+
+# Only nodes with at most this many transfers more than the least loaded node are considered
+load_slack = 5
+
+# Share of its disk a node is taken to be fuller by for each transfer it has in flight
+load_cost = 0.02
+
+
+class PlacementPolicy:
+    """ Picks the datanodes for the replicas of a block """
+
+    def __init__(self):
+        self.stats = {}
+        # blocks placed on each node since its last heartbeat
+        self.scheduled = {}
+        self.lock = threading.Lock()
+
+    def update(self, datanode, stats):
+        """ New heartbeat stats, the blocks scheduled before it are now in its transfers or used bytes """
+        with self.lock:
+            self.stats[datanode] = stats
+            self.scheduled[datanode] = 0
+
+    def room(self, dn, block_size):
+        """ False if the node reported a disk without room for one more block after the ones placed since """
+        stats = self.stats.get( dn )
+        if not stats or not stats.get('capacity'):
+            return True
+        return stats['capacity'] - stats.get('used', 0) - self.scheduled.get( dn, 0 ) * block_size > block_size
+
+    def choose(self, nodes, count, block_size, exclude=()):
+        """
+        Returns up to count distinct datanodes out of nodes, none of them in exclude
+
+        :param name: nodes
+        :param type: list
+            The datanodes that are alive
+        """
+        candidates = sorted( dn for dn in set( nodes ) if dn not in exclude )
+        with self.lock:
+            chosen = self._choose( candidates, min( count, len( candidates ) ), block_size )
+            for dn in chosen:
+                self.scheduled[dn] = self.scheduled.get( dn, 0 ) + 1
+        return chosen
+
+    def _choose(self, candidates, count, block_size):
+        raise NotImplementedError
+
+
+class RoundRobinPolicy(PlacementPolicy):
+    """ 
+    Takes the nodes in turn, the policy the namenode used to have but never the same node 
+    twice for a block and never a node that is full 
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.next_node = 0
+
+    def _choose(self, candidates, count, block_size):
+        candidates = [ dn for dn in candidates if self.room( dn, block_size ) ]
+        count = min( count, len( candidates ) )
+        if not candidates:
+            return []
+        start = self.next_node % len( candidates )
+        self.next_node += 1
+        return [ candidates[ ( start + i ) % len( candidates ) ] for i in range( count ) ]
+
+
+class WeightedPolicy(PlacementPolicy):
+    """
+    For each replica only the nodes within load_slack transfers of the least
+    loaded one are considered, so a node that is slow or busy serving reads is
+    not piled on. Of those it takes the node whose disk is the least full, each
+    transfer in flight counting as load_cost of the disk, so the nodes fill up
+    evenly whatever their size and a busy node still gets its share of blocks.
+    Replicas go to as many different racks as there are.
+    """
+
+    def fill(self, dn, block_size, default_fill):
+        """ Share of the disk used once the blocks placed since the last heartbeat are written """
+        stats = self.stats.get( dn )
+        if not stats or not stats.get('capacity'):
+            return default_fill
+        return ( stats.get('used', 0) + self.scheduled.get( dn, 0 ) * block_size ) / stats['capacity']
+
+    def load(self, dn):
+        """ Transfers in flight, blocks placed since the last heartbeat count as transfers """
+        stats = self.stats.get( dn ) or {}
+        return stats.get('active_transfers', 0) + self.scheduled.get( dn, 0 )
+
+    def _choose(self, candidates, count, block_size):
+        reported = [ self.stats[dn] for dn in candidates if ( self.stats.get( dn ) or {} ).get('capacity') ]
+        default_fill = sum( s.get('used', 0) / s['capacity'] for s in reported ) / len( reported ) if reported else 0.0
+        candidates = [ dn for dn in candidates if self.room( dn, block_size ) ]
+        loads = { dn: self.load( dn ) for dn in candidates }
+        costs = { dn: self.fill( dn, block_size, default_fill ) + load_cost * loads[dn] for dn in candidates }
+        chosen, racks = [], set()
+        while len( chosen ) < count:
+            left = [ dn for dn in candidates if dn not in chosen ]
+            if not left:
+                break
+            # a rack that has no replica yet is used first
+            new_rack = [ dn for dn in left if self.rack( dn ) not in racks ]
+            left = new_rack or left
+            least = min( loads[d] for d in left )
+            dn = min( ( d for d in left if loads[d] <= least + load_slack ), key=lambda d: costs[d] )
+            chosen.append( dn )
+            racks.add( self.rack( dn ) )
+        return chosen
+
+    def rack(self, dn):
+        return ( self.stats.get( dn ) or {} ).get('rack')
+
+
+policies = {'round_robin': RoundRobinPolicy, 'weighted': WeightedPolicy}
+
+
+def make_policy( name ):
+    """ Returns a new policy by name, round_robin or weighted """
+    if name not in policies:
+        raise ValueError( "Unknown placement policy {0}, use one of {1}".format( name, sorted( policies ) ) )
+    return policies[name]()
@@ -0,0 +1,135 @@
+import time, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+"""
+Replica selection for client reads. The client keeps a moving average of how
+long each datanode takes to start answering and how often it fails, and reads
+from the fastest healthy replica first. If that replica has not started
+answering by the p95 of recent answer times, the read is hedged with a second
+replica and the first one to finish wins.
+"""
+
+# Weight of the newest sample in the moving averages
+ewma_weight = 0.2
+
+# Datanodes failing more often than this are only read when nothing else is left
+unhealthy_error_rate = 0.5
+
+# Answer times kept to work out the p95 hedge deadline
+latency_samples = 256
+
+# Answer times needed before the p95 is trusted
+min_latency_samples = 20
+
+# Hedge deadline in seconds until there are enough samples, and its bounds after
+default_hedge_delay = 0.5
+min_hedge_delay = 0.01
+max_hedge_delay = 5.0
+
+# Threads running the block requests, a hedged read uses two
+hedge_pool = ThreadPoolExecutor( max_workers=32 )
+
+
+class ReplicaSelector:
+    """ Tracks latency and errors per datanode and orders replicas fastest healthy first """
+
+    def __init__(self):
+        self.latency = {}
+        self.error_rate = {}
+        self.samples = deque( maxlen=latency_samples )
+        self.lock = threading.Lock()
+
+    def record_latency(self, dn, seconds, answered=True):
+        """ Adds an answer time, answered is False for a replica that was hedged and had not answered yet """
+        with self.lock:
+            if dn in self.latency:
+                self.latency[dn] += ewma_weight * ( seconds - self.latency[dn] )
+            else:
+                self.latency[dn] = seconds
+            if answered:
+                self.error_rate[dn] = ( 1 - ewma_weight ) * self.error_rate.get( dn, 0.0 )
+                self.samples.append( seconds )
+
+    def record_error(self, dn):
+        with self.lock:
+            self.error_rate[dn] = ( 1 - ewma_weight ) * self.error_rate.get( dn, 0.0 ) + ewma_weight
+
+    def rank(self, nodes):
+        """ Healthy before unhealthy, then fastest first. A datanode never read from is tried early. """
+        with self.lock:
+            return sorted( nodes, key=lambda dn: ( self.error_rate.get( dn, 0.0 ) > unhealthy_error_rate,
+                                                   self.latency.get( dn, 0.0 ) ) )
+
+    def hedge_delay(self):
+        """ Seconds to wait for the first replica before asking a second one, the p95 of recent answer times """
+        with self.lock:
+            if len( self.samples ) < min_latency_samples:
+                return default_hedge_delay
+            ordered = sorted( self.samples )
+        p95 = ordered[ int( 0.95 * ( len( ordered ) - 1 ) ) ]
+        return min( max( p95, min_hedge_delay ), max_hedge_delay )
+
+    def stats(self):
+        with self.lock:
+            return { dn: {'latency': self.latency.get( dn ), 'error_rate': self.error_rate.get( dn, 0.0 )}
+                     for dn in set( self.latency ) | set( self.error_rate ) }
+
+
+def hedged_read( block_id, nodes, fetch, selector ):
+    """
+    Reads a block from the best replica, hedging with the next one if it is slow to answer
+
+    :param name: fetch
+    :param type: function
+        fetch( dn, block_id, started, cancelled ) returns the bytes of the block. It calls
+        started() once the datanode starts answering and stops early if cancelled is set.
+
+    :returns: bytes
+        The block from whichever replica finished first
+    """
+    ranked = selector.rank( nodes )
+    pending = {}
+    answered = threading.Event()
+    cancelled = threading.Event()
+
+    def timed_fetch( dn ):
+        begin = time.monotonic()
+        def started():
+            selector.record_latency( dn, time.monotonic() - begin )
+            answered.set()
+        try:
+            return fetch( dn, block_id, started, cancelled )
+        finally:
+            # a failed replica is replaced right away instead of waiting for the deadline
+            answered.set()
+
+    def launch():
+        dn = ranked.pop( 0 )
+        pending[ hedge_pool.submit( timed_fetch, dn ) ] = dn
+
+    launch()
+    # Hedge when the first replica has not started answering by the deadline
+    delay = selector.hedge_delay()
+    if ranked and not answered.wait( delay ):
+        slow_dn = pending[ next( iter( pending ) ) ]
+        print( "Block {0} is slow on {1}, also reading it from {2}".format( block_id, slow_dn, ranked[0] ))
+        # the slow replica took at least the deadline, so it is not picked first next time
+        selector.record_latency( slow_dn, delay, answered=False )
+        launch()
+    try:
+        while pending:
+            done, _ = wait( pending, return_when=FIRST_COMPLETED )
+            for future in done:
+                dn = pending.pop( future )
+                try:
+                    return future.result()
+                except Exception as a:
+                    print( "Could not read block {0} from {1}: {2}".format( block_id, dn, a ))
+                    selector.record_error( dn )
+            if not pending and ranked:
+                launch()
+    finally:
+        # the slower replica stops sending
+        cancelled.set()
+    raise IOError( "No datanode could send block {0}".format( block_id ) )
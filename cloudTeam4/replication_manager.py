@@ -0,0 +1,346 @@
+import heapq, itertools, threading, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Re-replication for the checker. Under replicated blocks wait in a priority
+queue, the block with the fewest live replicas first. Every round the manager
+starts as many copies as the per node limits allow, each from a replica with
+few copies going out to a node picked by the placement policy that has few
+coming in. A started copy stays pending until the block map shows the new
+replica, and is retried from the queue if it fails or times out. A block is
+never queued or copied twice at once.
+
+Blocks of erasure coded files have a single replica and are not copied. A lost
+one is rebuilt by a new datanode from the rest of its group, see RebuildManager.
+"""
+
+# Copies a datanode may send and receive at the same time
+max_streams_per_source = 2
+max_streams_per_target = 2
+
+# Seconds a copy may take before it is tried again, and how many times a block is tried
+copy_timeout = 120
+max_attempts = 3
+
+# Queued blocks looked at in a round that cannot start because their nodes are busy, the rest wait
+schedule_lookahead = 500
+
+
+class ReplicationManager:
+    """ Queues under replicated blocks and copies them within per node limits """
+
+    def __init__(self, replication_factor, choose_target, send_copy, locate,
+                 per_source=max_streams_per_source, per_target=max_streams_per_target,
+                 timeout=copy_timeout, attempts=max_attempts):
+        """
+        :param name: choose_target
+        :param type: function
+            choose_target( exclude ) returns an alive datanode not in exclude, or None
+
+        :param name: send_copy
+        :param type: function
+            send_copy( source, target, block_id ) asks the source to copy the block to the target,
+            returns True once the source has sent it
+
+        :param name: locate
+        :param type: function
+            locate( block_ids ) returns < key: block id, val: list of datanodes with a replica >
+        """
+        self.replication_factor = replication_factor
+        self.choose_target = choose_target
+        self.send_copy = send_copy
+        self.locate = locate
+        self.per_source = per_source
+        self.per_target = per_target
+        self.timeout = timeout
+        self.attempts = attempts
+        self.alive = lambda dn: True
+        # live replicas of the under replicated blocks as of the last scan and the copies since
+        self.replicas = {}
+        # heap of ( live replicas, order, block id ), queued holds the replicas each block was queued with
+        self.queue = []
+        self.queued = {}
+        self.order = itertools.count()
+        # < key: block id, val: {'source', 'target', 'deadline', 'attempt'} >
+        self.pending = {}
+        self.tries = Counter()
+        self.outgoing = Counter()
+        self.incoming = Counter()
+        self.counts = Counter()
+        # blocks that gave up and should be looked at again with their replicas as they are now
+        self.rescan = set()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor( max_workers=32 )
+
+    def scan(self, block_list, full=True):
+        """ 
+        Queues every block of the block list that has fewer replicas than it should. 
+        With full False the block list holds only some blocks and the others are left as they are.
+        """
+        lost = []
+        with self.lock:
+            if full:
+                self.replicas = { b: dns for b, dns in self.replicas.items() if b in self.pending }
+            for block, dns in block_list.items():
+                live = [ dn for dn in dns if self.alive( dn ) ]
+                if len( live ) >= self.replication_factor or block in self.pending:
+                    continue
+                if not live:
+                    lost.append( block )
+                    continue
+                self.replicas[block] = live
+                self._push( block, len( live ) )
+        if lost:
+            print( "Blocks with no live replica to copy from {0}".format( lost ))
+        return lost
+
+    def _push(self, block, live_count):
+        # a block already queued is pushed again only if it lost more replicas, the older entry is skipped
+        if block in self.queued and self.queued[block] <= live_count:
+            return
+        self.queued[block] = live_count
+        heapq.heappush( self.queue, ( live_count, next( self.order ), block ) )
+
+    def node_dead(self, dn):
+        """ Pending copies to or from a dead datanode are tried again """
+        with self.lock:
+            for block, copy in list( self.pending.items() ):
+                if dn in ( copy['source'], copy['target'] ):
+                    self._retry( block, "{0} is dead".format( dn ) )
+
+    def check_pending(self):
+        """ Finishes pending copies the block map shows, retries the ones that timed out """
+        with self.lock:
+            blocks = list( self.pending )
+        if not blocks:
+            return
+        locations = self.locate( blocks )
+        now = time.monotonic()
+        with self.lock:
+            for block in blocks:
+                copy = self.pending.get( block )
+                if copy is None:
+                    continue
+                dns = locations.get( block )
+                if dns is None:
+                    # the file was deleted
+                    self._finish( block )
+                    self.replicas.pop( block, None )
+                elif copy['target'] in dns:
+                    self._finish( block )
+                    self.counts['completed'] += 1
+                    live = [ dn for dn in dns if self.alive( dn ) ]
+                    if len( live ) < self.replication_factor:
+                        self.replicas[block] = live
+                        self._push( block, len( live ) )
+                    else:
+                        self.replicas.pop( block, None )
+                elif now > copy['deadline']:
+                    self.counts['timed_out'] += 1
+                    self._retry( block, "no replica on {0} after {1} s".format( copy['target'], self.timeout ) )
+
+    def _finish(self, block):
+        self.pending.pop( block )
+        self.tries.pop( block, None )
+
+    def _retry(self, block, reason):
+        copy = self.pending.pop( block )
+        print( "Copy of block {0} from {1} to {2} failed: {3}".format( block, copy['source'], copy['target'], reason ))
+        replicas = [ dn for dn in self.replicas.get( block, [] ) if self.alive( dn ) ]
+        if self.tries[block] >= self.attempts or not replicas:
+            # the block is looked at again with its replicas as they are then
+            self.counts['failed'] += 1
+            self.tries.pop( block )
+            self.replicas.pop( block, None )
+            self.rescan.add( block )
+            return
+        self.counts['retried'] += 1
+        self.replicas[block] = replicas
+        self._push( block, len( replicas ) )
+
+    def schedule(self):
+        """ Starts copies for queued blocks, most urgent first, as long as the node limits allow """
+        started, deferred = 0, []
+        with self.lock:
+            while self.queue:
+                live_count, _, block = heapq.heappop( self.queue )
+                if self.queued.get( block ) != live_count:
+                    # replaced by a more urgent entry
+                    continue
+                dns = [ dn for dn in self.replicas.get( block, [] ) if self.alive( dn ) ]
+                if not dns or len( dns ) >= self.replication_factor or block in self.pending:
+                    del self.queued[block]
+                    continue
+                sources = [ dn for dn in dns if self.outgoing[dn] < self.per_source ]
+                busy = [ dn for dn, n in self.incoming.items() if n >= self.per_target ]
+                target = self.choose_target( dns + busy ) if sources else None
+                if target is None:
+                    deferred.append( ( live_count, block ) )
+                    if len( deferred ) >= schedule_lookahead:
+                        break
+                    continue
+                source = min( sources, key=lambda dn: self.outgoing[dn] )
+                del self.queued[block]
+                self._start( block, source, target )
+                started += 1
+            for live_count, block in deferred:
+                heapq.heappush( self.queue, ( live_count, next( self.order ), block ) )
+        return started
+
+    def _start(self, block, source, target):
+        self.tries[block] += 1
+        self.pending[block] = {'source': source, 'target': target, 'attempt': self.tries[block],
+                               'deadline': time.monotonic() + self.timeout}
+        self.outgoing[source] += 1
+        self.incoming[target] += 1
+        print( "Copy block {0} from {1} to {2}".format( block, source, target ))
+        self.pool.submit( self._copy, block, source, target )
+
+    def _copy(self, block, source, target):
+        try:
+            sent = self.send_copy( source, target, block )
+        except Exception as a:
+            print( "Could not forward the under replicated block {0}: {1}".format( block, a ))
+            sent = False
+        with self.lock:
+            self.outgoing[source] -= 1
+            self.incoming[target] -= 1
+            copy = self.pending.get( block )
+            if not sent and copy and copy['target'] == target:
+                self._retry( block, "the source could not send it" )
+
+    def take_rescan(self):
+        """ Returns the blocks to look at again and forgets them """
+        with self.lock:
+            blocks, self.rescan = self.rescan, set()
+        return blocks
+
+    def stats(self):
+        """ Queue depth by live replicas, copies in flight and totals """
+        with self.lock:
+            by_replicas = Counter( self.queued.values() )
+            return {'queued': len( self.queued ), 'queued_by_replicas': { str(k): v for k, v in sorted( by_replicas.items() ) },
+                    'pending': len( self.pending ), 'completed': self.counts['completed'],
+                    'retried': self.counts['retried'], 'timed_out': self.counts['timed_out'], 'failed': self.counts['failed']}
+
+
+class RebuildManager:
+    """ Rebuilds lost blocks of erasure coded files on new datanodes, a few at a time per datanode """
+
+    def __init__(self, choose_target, send_rebuild, locate, per_target=max_streams_per_target, timeout=copy_timeout):
+        """
+        :param name: choose_target
+        :param type: function
+            choose_target( exclude ) returns an alive datanode not in exclude, or None
+
+        :param name: send_rebuild
+        :param type: function
+            send_rebuild( target, block_id, group, policy, size ) asks the target to rebuild the block
+            from the rest of the group, returns True once it has
+
+        :param name: locate
+        :param type: function
+            locate( block_ids ) returns < key: block id, val: list of datanodes with a replica >
+        """
+        self.choose_target = choose_target
+        self.send_rebuild = send_rebuild
+        self.locate = locate
+        self.per_target = per_target
+        self.timeout = timeout
+        # < key: block id, val: {'target', 'deadline'} >
+        self.pending = {}
+        self.incoming = Counter()
+        self.counts = Counter()
+        self.waiting = 0
+        # blocks not rebuilt yet that should be looked at again, with their group as it is now
+        self.rescan = set()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor( max_workers=32 )
+
+    def scan(self, lost):
+        """
+        Starts rebuilds of lost blocks as far as the datanode limits allow, the others are looked at again
+
+        :param name: lost
+        :param type: dict
+            < key: block id, val: ( [ ( block id, live datanodes ) of every block of the group ], policy, bytes in the group ) >
+        """
+        waiting = 0
+        with self.lock:
+            for block, ( group, policy, size ) in lost.items():
+                if block in self.pending:
+                    continue
+                # a group keeps its blocks on distinct datanodes, counting the ones being rebuilt
+                busy = [ dn for dn, n in self.incoming.items() if n >= self.per_target ]
+                rebuilding = [ self.pending[b]['target'] for b, _ in group if b in self.pending ]
+                target = self.choose_target( [ dn for _, dns in group for dn in dns ] + rebuilding + busy )
+                if target is None:
+                    waiting += 1
+                    self.rescan.add( block )
+                    continue
+                self.pending[block] = {'target': target, 'deadline': time.monotonic() + self.timeout}
+                self.incoming[target] += 1
+                print( "Rebuild block {0} of {1} on {2}".format( block, policy, target ))
+                self.pool.submit( self._rebuild, block, target, group, policy, size )
+            self.waiting = waiting
+        return waiting
+
+    def _rebuild(self, block, target, group, policy, size):
+        try:
+            rebuilt = self.send_rebuild( target, block, group, policy, size )
+        except Exception as a:
+            print( "Could not rebuild block {0}: {1}".format( block, a ))
+            rebuilt = False
+        with self.lock:
+            self.incoming[target] -= 1
+            copy = self.pending.get( block )
+            if not rebuilt and copy and copy['target'] == target:
+                self.pending.pop( block )
+                self.counts['failed'] += 1
+                self.rescan.add( block )
+
+    def node_dead(self, dn):
+        """ Rebuilds on a dead datanode are started again """
+        with self.lock:
+            for block, copy in list( self.pending.items() ):
+                if copy['target'] == dn:
+                    self.pending.pop( block )
+                    self.counts['failed'] += 1
+                    self.rescan.add( block )
+
+    def check_pending(self):
+        """ Finishes rebuilds the block map shows, drops the ones that timed out """
+        with self.lock:
+            blocks = list( self.pending )
+        if not blocks:
+            return
+        locations = self.locate( blocks )
+        now = time.monotonic()
+        with self.lock:
+            for block in blocks:
+                copy = self.pending.get( block )
+                if copy is None:
+                    continue
+                dns = locations.get( block )
+                if dns is None:
+                    # the file was deleted
+                    self.pending.pop( block )
+                elif copy['target'] in dns:
+                    self.pending.pop( block )
+                    self.counts['completed'] += 1
+                elif now > copy['deadline']:
+                    self.pending.pop( block )
+                    self.counts['timed_out'] += 1
+                    self.rescan.add( block )
+
+    def take_rescan(self):
+        """ Returns the blocks to look at again and forgets them """
+        with self.lock:
+            blocks, self.rescan = self.rescan, set()
+        return blocks
+
+    def stats(self):
+        with self.lock:
+            return {'pending': len( self.pending ), 'waiting': self.waiting, 'completed': self.counts['completed'],
+                    'timed_out': self.counts['timed_out'], 'failed': self.counts['failed']}
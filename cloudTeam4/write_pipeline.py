@@ -0,0 +1,84 @@
+import queue, threading
+
+"""
+Write pipeline between datanodes. While a datanode is still receiving a block
+it hands every chunk to the next datanode in the pipeline, which does the same
+for the one after it. Each datanode answers only after the rest of the chain has
+answered, so the ack that reaches the client covers every replica and replication
+costs about one block transfer instead of one per replica.
+"""
+
+# Chunks that may wait for the next datanode before the sender blocks
+max_pending_chunks = 16
+
+# Seconds to wait for the next datanode to ack after the last chunk
+ack_timeout = 120
+
+# Queued instead of a chunk when the upstream write failed
+_abort = object()
+
+
+class PipelineForwarder:
+    """ Streams the chunks of one block to the next datanode of the pipeline """
+
+    def __init__(self, route, copy_nodes, next_node, session, headers=None):
+        self.route = route
+        # headers of the block, like its codec, passed on with it
+        self.headers = dict( headers or {} )
+        self.headers['Content-Type'] = 'application/octet-stream'
+        self.session = session
+        self.copy_nodes = copy_nodes
+        self.next_node = next_node
+        self.chunks = queue.Queue( maxsize=max_pending_chunks )
+        self.done = threading.Event()
+        self.ack = None
+        self.thread = threading.Thread( target=self._send, daemon=True )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _body(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if chunk is _abort:
+                raise IOError( "Upstream write of the block failed" )
+            yield chunk
+
+    def _send(self):
+        """ Runs the request to the next datanode, the body is sent as chunks arrive """
+        try:
+            response = self.session.post( self.route, data=self._body(), params={'copy_node': self.copy_nodes},
+                               headers=self.headers )
+            self.ack = response.json()
+        except Exception as a:
+            self.ack = {'error': "ERROR: {0}".format( str(a) )}
+        finally:
+            self.done.set()
+
+    def send(self, chunk):
+        """ Queues a chunk for the next datanode, dropped if that datanode already failed """
+        while not self.done.is_set():
+            try:
+                self.chunks.put( chunk, timeout=0.5 )
+                return
+            except queue.Full:
+                continue
+
+    def abort(self):
+        """ Breaks off the request so the next datanode does not keep a partial block """
+        self.send( _abort )
+
+    def finish(self):
+        """
+        Ends the block and waits for the rest of the pipeline
+
+        :returns: dict
+            The ack of the next datanode, {'replicas': ['dn1', 'dn2']} or {'error': ...}
+        """
+        self.send( None )
+        if not self.done.wait( ack_timeout ):
+            return {'error': "ERROR: No ack from {0} after {1} seconds".format( self.next_node, ack_timeout )}
+        return self.ack